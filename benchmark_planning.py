@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Benchmarks the planning side of the pipeline (everything that runs before feat) on synthetic studies of growing size
+For each number of subjects, a synthetic study is created with synthetic_study.py and each step is timed in a fresh
+process, so that indexes and catalogs kept in memory by one step don't speed up the next one
+Reports the wall time, the throughput and the peak memory of each step
+
+Example:
+    python benchmark_planning.py --scales 10 50 200 --nsessions 2 --nruns 3
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import directory_struct_utils
+import get_level1_jobs
+import get_level2_jobs
+import mk_all_level3_fsf
+import mk_level1_fsf_bbr
+import mk_level2_fsf
+import setup_utils
+import synthetic_study
+
+STUDYID = 'bench'
+MODELNAME = 'bench'
+
+# steps in the order they are run; each one is a function of (basedir, specificruns, max_fsfs) in BENCHMARKS
+BENCHMARK_NAMES = ['study_info', 'level1_jobs', 'level2_jobs', 'level3_fsf', 'confounds', 'fsf_level1',
+                   'fsf_level2']
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='benchmark_planning')
+
+    parser.add_argument('--scales', dest='scales', type=int, nargs='+',
+                        default=[10, 50, 200], help='Numbers of subjects of the synthetic studies')
+    parser.add_argument('--nsessions', dest='nsessions', type=int,
+                        default=0, help='Number of sessions per subject (0 for no session folders)')
+    parser.add_argument('--tasks', dest='tasks', nargs='+',
+                        default=['flanker'], help='Task names')
+    parser.add_argument('--nruns', dest='nruns', type=int,
+                        default=2, help='Number of runs per task')
+    parser.add_argument('--nconfounds', dest='nconfounds', type=int,
+                        default=200, help='Number of columns in each fmriprep confounds file')
+    parser.add_argument('--benchmarks', dest='benchmarks', nargs='+', choices=BENCHMARK_NAMES,
+                        default=BENCHMARK_NAMES, help='Steps to benchmark')
+    parser.add_argument('--max-fsfs', dest='max_fsfs', type=int,
+                        default=200, help='Maximum number of fsf\'s to create in the fsf_level1/fsf_level2 steps')
+    parser.add_argument('--workdir', dest='workdir',
+                        default=None, help='Directory in which to create the synthetic studies (default: a temporary '
+                                           'directory that is removed afterwards)')
+    parser.add_argument('--keep-catalog', dest='keep_catalog', action='store_true',
+                        default=False, help='Keep the study catalog between steps (benchmarks warm runs)')
+    parser.add_argument('--json', dest='json_out',
+                        default=None, help='Also write the results to this JSON file')
+    # used internally to run a single step in a child process
+    parser.add_argument('--run-one', dest='run_one', nargs=2, metavar=('BASEDIR', 'BENCHMARK'),
+                        default=None, help=argparse.SUPPRESS)
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def count_runs(specificruns):
+    """Returns a list of (sub, ses, task, run) tuples in specificruns; ses is '' if there are no sessions"""
+    runs = []
+    for sub in sorted(specificruns):
+        for key, value in sorted(specificruns[sub].items()):
+            if key.startswith('ses-'):
+                for task, task_runs in sorted(value.items()):
+                    for run in task_runs:
+                        runs.append((sub, key, task, run))
+            else:
+                for run in value:
+                    runs.append((sub, '', key, run))
+    return runs
+
+
+def bench_study_info(basedir, specificruns, max_fsfs):
+    study_info, hasSessions = directory_struct_utils.get_study_info(os.path.join(basedir, STUDYID))
+    return len(count_runs(study_info))
+
+
+def bench_level1_jobs(basedir, specificruns, max_fsfs):
+    existing_feat_files, jobs, rerun_feat_files = get_level1_jobs.get_level1_jobs(STUDYID, basedir, MODELNAME,
+                                                                                  specificruns, specificruns, True)
+    return len(jobs)
+
+
+def bench_level2_jobs(basedir, specificruns, max_fsfs):
+    # specificruns is passed in so that a job is planned for every task, even though the gfeat directories exist
+    argv = ['--studyid', STUDYID, '--basedir', basedir, '-m', MODELNAME, '--nofeat', '-s', json.dumps(specificruns)]
+    # get_level2_jobs builds the mk_level2_fsf arguments from sys.argv
+    sys.argv = ['get_level2_jobs.py'] + argv
+    existing_feat_files, jobs, rerun_feat_files = get_level2_jobs.main(argv)
+    return len(jobs)
+
+
+def bench_level3_fsf(basedir, specificruns, max_fsfs):
+    existing_copes, all_copes, rerun_copes = mk_all_level3_fsf.main(['--studyid', STUDYID, '--basedir', basedir,
+                                                                     '-m', MODELNAME, '--nofeat'])
+    return len(all_copes)
+
+
+def bench_confounds(basedir, specificruns, max_fsfs):
+    hasSessions = any(key.startswith('ses-') for sub in specificruns for key in specificruns[sub])
+    setup_utils.generate_confounds_files(STUDYID, basedir, specificruns, MODELNAME, hasSessions)
+    return len(count_runs(specificruns))
+
+
+def bench_fsf_level1(basedir, specificruns, max_fsfs):
+    model_params = setup_utils.model_params_json_to_list(STUDYID, basedir, MODELNAME)
+    nfsfs = 0
+    for sub, ses, task, run in count_runs(specificruns)[:max_fsfs]:
+        argv = model_params + ['--sub', sub[len('sub-'):], '--taskname', task, '--runname', run]
+        if ses:
+            argv += ['--sesname', ses[len('ses-'):]]
+        mk_level1_fsf_bbr.mk_level1_fsf_bbr(mk_level1_fsf_bbr.parse_command_line(argv))
+        nfsfs += 1
+    return nfsfs
+
+
+def bench_fsf_level2(basedir, specificruns, max_fsfs):
+    tasks = {}
+    for sub, ses, task, run in count_runs(specificruns):
+        tasks.setdefault((sub, ses, task), []).append(run)
+    nfsfs = 0
+    for (sub, ses, task), runs in sorted(tasks.items())[:max_fsfs]:
+        argv = ['--studyid', STUDYID, '--basedir', basedir, '-m', MODELNAME, '--sub', sub[len('sub-'):],
+                '--taskname', task, '--runs'] + runs
+        if ses:
+            argv += ['--sesname', ses[len('ses-'):]]
+        mk_level2_fsf.mk_level2_fsf(mk_level2_fsf.parse_command_line(argv))
+        nfsfs += 1
+    return nfsfs
+
+
+BENCHMARKS = {
+    'study_info': bench_study_info,
+    'level1_jobs': bench_level1_jobs,
+    'level2_jobs': bench_level2_jobs,
+    'level3_fsf': bench_level3_fsf,
+    'confounds': bench_confounds,
+    'fsf_level1': bench_fsf_level1,
+    'fsf_level2': bench_fsf_level2,
+}
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0 / 1024.0
+    return maxrss / 1024.0
+
+
+def run_one(basedir, name):
+    """Runs a single step in this process and prints the result as JSON on the last line of stdout"""
+    with open(os.path.join(basedir, STUDYID, 'model', 'level1', 'model-%s' % MODELNAME, 'model_params.json')) as f:
+        specificruns = json.load(f)['specificruns']
+    baseline_rss = get_peak_rss_mb()
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        nitems = BENCHMARKS[name](basedir, specificruns, max_fsfs=int(os.environ.get('BENCHMARK_MAX_FSFS', '200')))
+    wall = time.perf_counter() - start
+    peak_rss = get_peak_rss_mb()
+    print(json.dumps({'benchmark': name, 'items': nitems, 'wall': wall, 'peak_rss_mb': peak_rss,
+                      'rss_delta_mb': peak_rss - baseline_rss}))
+
+
+def run_in_child(basedir, name, max_fsfs):
+    env = dict(os.environ, BENCHMARK_MAX_FSFS=str(max_fsfs))
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', basedir, name],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, env=env,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        print("WARNING: %s failed:\n%s" % (name, proc.stderr.strip() or proc.stdout.strip()))
+        return None
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def reset_outputs(basedir, keep_catalog):
+    """Removes what the previous step created, so that each step sees the same study"""
+    studydir = os.path.join(basedir, STUDYID)
+    catalog = os.path.join(studydir, '.fmri_pipeline_catalog.sqlite')
+    if not keep_catalog and os.path.exists(catalog):
+        os.remove(catalog)
+    level3 = os.path.join(studydir, 'model', 'level3')
+    if os.path.exists(level3):
+        shutil.rmtree(level3)
+
+
+def main(argv=None):
+    args = parse_command_line(argv)
+
+    if args.run_one is not None:
+        run_one(*args.run_one)
+        return
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='fmri_pipeline_bench_')
+    results = []
+    print('%8s  %-12s %8s %10s %10s %12s %12s' % ('subjects', 'benchmark', 'items', 'wall (s)', 'items/s',
+                                                 'peak RSS MB', 'step RSS MB'))
+    try:
+        for nsubs in args.scales:
+            basedir = os.path.join(workdir, 'subs-%d' % nsubs)
+            if not os.path.exists(os.path.join(basedir, STUDYID)):
+                synthetic_study.make_study(STUDYID, basedir, MODELNAME, nsubs=nsubs, nsessions=args.nsessions,
+                                           tasks=args.tasks, nruns=args.nruns, nconfounds=args.nconfounds,
+                                           featdirs=True)
+            for name in args.benchmarks:
+                reset_outputs(basedir, args.keep_catalog)
+                result = run_in_child(basedir, name, args.max_fsfs)
+                if result is None:
+                    continue
+                result['subjects'] = nsubs
+                results.append(result)
+                rate = result['items'] / result['wall'] if result['wall'] > 0 else float('inf')
+                print('%8d  %-12s %8d %10.3f %10.1f %12.1f %12.1f' % (nsubs, name, result['items'], result['wall'],
+                                                                      rate, result['peak_rss_mb'],
+                                                                      result['rss_delta_mb']))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json_out is not None:
+        with open(args.json_out, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
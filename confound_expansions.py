@@ -0,0 +1,180 @@
+"""
+Expansions of the confounds listed in confounds.json, computed from the fmriprep confounds file of each run
+confounds.json can declare, next to the list of confounds:
+    "expansions": {
+        "derivatives": ["trans_x", ...],                               temporal derivative (backward difference) of
+                                                                       each column, named <column>_derivative1
+        "squares": ["trans_x", "trans_x_derivative1", ...],            square of each column, named <column>_power2
+        "spikes": {"framewise_displacement": 0.5, "std_dvars": 1.5},   one column per volume over any of the
+                                                                       thresholds, with 1 at that volume (spike_NN)
+        "acompcor": 6                                                  first N aCompCor components (a_comp_cor_NN)
+    }
+Ex: the Friston-24 expansion of the 6 motion parameters lists them in "confounds" and "derivatives", and both the
+parameters and their derivatives in "squares".
+Columns that fmriprep already computed (e.g. trans_x_derivative1) are taken from the file; the others are computed with
+NumPy on the columns read from the file, in the same pass that writes the confounds file (see
+setup_utils.generate_confounds_files).
+"""
+
+import numpy as np
+import pandas as pd
+
+EXPANSION_KEYS = ['derivatives', 'squares', 'spikes', 'acompcor']
+
+DERIVATIVE_SUFFIX = '_derivative1'
+SQUARE_SUFFIX = '_power2'
+ACOMPCOR_PREFIX = 'a_comp_cor_'
+SPIKE_PREFIX = 'spike_'
+
+
+def check_expansions(expansions):
+    """Returns an error message if the expansions of confounds.json are invalid, None otherwise"""
+    if not isinstance(expansions, dict):
+        return '"expansions" should be a JSON object'
+    for key in expansions:
+        if key not in EXPANSION_KEYS:
+            return 'unknown expansion "%s" (expected one of %s)' % (key, ', '.join(EXPANSION_KEYS))
+    for key in ['derivatives', 'squares']:
+        columns = expansions.get(key, [])
+        if not isinstance(columns, list) or not all(isinstance(column, str) for column in columns):
+            return '"%s" should be a list of column names' % key
+    spikes = expansions.get('spikes', {})
+    if not isinstance(spikes, dict) or not all(isinstance(threshold, (int, float)) and not isinstance(threshold, bool)
+                                               for threshold in spikes.values()):
+        return '"spikes" should map column names to thresholds, e.g. {"framewise_displacement": 0.5}'
+    acompcor = expansions.get('acompcor', 0)
+    if not isinstance(acompcor, int) or isinstance(acompcor, bool) or acompcor < 0:
+        return '"acompcor" should be a number of components'
+    return None
+
+
+def get_num_columns(expansions):
+    """Returns the number of columns the expansions add, without the spike columns (their number depends on the run)"""
+    if not expansions:
+        return 0
+    return len(expansions.get('derivatives', [])) + len(expansions.get('squares', [])) + expansions.get('acompcor', 0)
+
+
+def get_acompcor_columns(n):
+    return ['%s%02d' % (ACOMPCOR_PREFIX, i) for i in range(n)]
+
+
+def _get_base_column(column):
+    # column that a derived column is computed from (trans_x_derivative1_power2 -> trans_x)
+    for suffix in [SQUARE_SUFFIX, DERIVATIVE_SUFFIX]:
+        if column.endswith(suffix):
+            column = column[:-len(suffix)]
+    return column
+
+
+def get_source_columns(confounds_list, expansions):
+    """Returns the columns to read from the fmriprep confounds file: the confounds, the columns the expansions are made
+    of (both the derived columns, which fmriprep may already have, and the columns they are computed from), the
+    columns compared to the spike thresholds and the aCompCor components"""
+    columns = list(confounds_list)
+    if expansions:
+        for column in list(expansions.get('derivatives', [])) + list(expansions.get('squares', [])):
+            columns += [column + DERIVATIVE_SUFFIX, column + SQUARE_SUFFIX, column, _get_base_column(column)]
+        columns += list(expansions.get('spikes', {}).keys())
+        columns += get_acompcor_columns(expansions.get('acompcor', 0))
+    return _unique(columns)
+
+
+def get_required_columns(confounds_list, expansions):
+    """Returns the columns that the fmriprep confounds file of every run should have: the confounds, the columns the
+    derivatives and squares are computed from, the columns compared to the spike thresholds and the aCompCor components
+    (derived columns that fmriprep didn't compute are computed, so they aren't required)"""
+    columns = list(confounds_list)
+    if expansions:
+        for column in list(expansions.get('derivatives', [])) + list(expansions.get('squares', [])):
+            columns.append(_get_base_column(column))
+        columns += list(expansions.get('spikes', {}).keys())
+        columns += get_acompcor_columns(expansions.get('acompcor', 0))
+    return _unique(columns)
+
+
+def _unique(columns):
+    unique = []
+    seen = set()
+    for column in columns:
+        if column not in seen:
+            seen.add(column)
+            unique.append(column)
+    return unique
+
+
+def _get_values(df, computed, column):
+    # values of a column, from the file or computed from the column it is derived from (None if neither exists)
+    if column in computed:
+        return computed[column]
+    if column in df.columns:
+        return df[column].values.astype(float)
+    for suffix, compute in [(SQUARE_SUFFIX, np.square), (DERIVATIVE_SUFFIX, _derivative)]:
+        if column.endswith(suffix):
+            values = _get_values(df, computed, column[:-len(suffix)])
+            if values is not None:
+                computed[column] = compute(values)
+                return computed[column]
+    return None
+
+
+def _derivative(values):
+    # backward difference, like fmriprep's *_derivative1 columns (the first volume has none)
+    derivative = np.empty_like(values)
+    derivative[0] = np.nan
+    derivative[1:] = values[1:] - values[:-1]
+    return derivative
+
+
+def get_spikes(df, spikes):
+    """Returns an array with a column for each volume over any of the spike thresholds (1 at that volume, 0 elsewhere)
+
+    Args:
+        df (pandas.DataFrame): columns of the fmriprep confounds file
+        spikes (dict): column names as keys and thresholds as values; missing values (e.g. the framewise displacement
+            of the first volume) are never over a threshold
+    """
+    over = np.zeros(len(df), dtype=bool)
+    for column, threshold in spikes.items():
+        if column in df.columns:
+            with np.errstate(invalid='ignore'):
+                over |= df[column].values.astype(float) > threshold
+    volumes = np.flatnonzero(over)
+    spike_columns = np.zeros((len(df), len(volumes)), dtype=int)
+    spike_columns[volumes, np.arange(len(volumes))] = 1
+    return spike_columns
+
+
+def expand_confounds(df, confounds_list, expansions):
+    """Selects the confounds and adds the expansions
+
+    Args:
+        df (pandas.DataFrame): columns of the fmriprep confounds file (see get_source_columns)
+        confounds_list (list): confounds listed in confounds.json
+        expansions (dict): expansions of confounds.json (see check_expansions), or None
+    Returns:
+        pandas.DataFrame with the confounds, then the derivatives, squares, aCompCor components and spike columns;
+        columns that are missing from the file (and can't be computed) are NaN
+    """
+    cf = df.reindex(columns=confounds_list)
+    if not expansions:
+        return cf
+    computed = {}
+    added = []
+    for column in list(expansions.get('derivatives', [])):
+        added.append(column + DERIVATIVE_SUFFIX)
+    for column in list(expansions.get('squares', [])):
+        added.append(column + SQUARE_SUFFIX)
+    added += get_acompcor_columns(expansions.get('acompcor', 0))
+    columns = {}
+    for column in added:
+        if column in cf.columns or column in columns:
+            continue
+        values = _get_values(df, computed, column)
+        columns[column] = values if values is not None else np.full(len(df), np.nan)
+    spike_columns = get_spikes(df, expansions.get('spikes', {}))
+    for i in range(spike_columns.shape[1]):
+        columns['%s%02d' % (SPIKE_PREFIX, i)] = spike_columns[:, i]
+    if len(columns) == 0:
+        return cf
+    return pd.concat([cf, pd.DataFrame(columns, index=df.index)], axis=1)
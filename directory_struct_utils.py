@@ -4,9 +4,22 @@ Gets information about the fmriprep directory structure
 
 # Created by Alice Xue, 06/2018
 
+from concurrent.futures import ThreadPoolExecutor
 import os
+import re
 import sys
 
+import study_catalog
+
+# matches a single BIDS key-value entity in a file name, e.g. 'task-flanker' or 'space-MNI152NLin2009cAsym'
+_BIDS_ENTITY_RE = re.compile(r'^([a-zA-Z]+)-([a-zA-Z0-9+]+)$')
+
+# BIDS index for each fmriprep directory, keyed by the path of the fmriprep directory
+_bids_indexes = {}
+
+# number of threads used to list subject and session directories, unless set by FMRI_PIPELINE_DISCOVERY_WORKERS
+DEFAULT_DISCOVERY_WORKERS = 8
+
 
 def get_fmriprep_dir(studydir):
     """Checks for fmriprep directory under studydir
@@ -25,6 +38,275 @@ def get_fmriprep_dir(studydir):
         sys.exit(-1)
 
 
+def parse_bids_filename(filename):
+    """Parses a BIDS file name into its entities
+
+    Args:
+        filename (str): name of file (without the directory), e.g.
+            'sub-01_task-flanker_run-1_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'
+    Returns:
+        dictionary with the entity keys (sub, ses, task, run, space, desc, ...) as keys and their labels as values,
+        'suffix' (the last token that is not a key-value pair, e.g. 'bold') and 'extension' (e.g. '.nii.gz')
+
+    """
+    i = filename.find('.')
+    if i > -1:
+        stem = filename[:i]
+        extension = filename[i:]
+    else:
+        stem = filename
+        extension = ''
+    entities = {'suffix': '', 'extension': extension}
+    for token in stem.split('_'):
+        m = _BIDS_ENTITY_RE.match(token)
+        if m:
+            entities[m.group(1)] = m.group(2)
+        elif token != '':
+            entities['suffix'] = token
+    return entities
+
+
+def is_preproc_bold(filename):
+    """Returns True if filename is a preprocessed functional file from fmriprep (excludes brain masks)"""
+    return ('preproc' in filename) and ('bold' in filename) and ('brain' not in filename)
+
+
+def _scandir(path):
+    """Lists a directory in a single system call
+
+    Args:
+        path (str): path of directory
+    Returns:
+        list of (name, is_dir) tuples, or an empty list if path is not a directory
+
+    """
+    try:
+        with os.scandir(path) as it:
+            return [(entry.name, entry.is_dir()) for entry in it]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _task_runs_from_listing(listing):
+    """Gets dictionary with task names as keys and sorted lists of runs as the values
+
+    Args:
+        listing: list of (filename, entities) tuples, where entities is the output of parse_bids_filename
+    Returns:
+        dictionary (as stated above), based on the preprocessed functional files in listing
+
+    """
+    task_runs = {}
+    for f, entities in listing:
+        if is_preproc_bold(f) and 'task' in entities and 'run' in entities:
+            runs = task_runs.setdefault(entities['task'], [])
+            if entities['run'] not in runs:
+                runs.append(entities['run'])
+    for task in task_runs:
+        list.sort(task_runs[task])
+    return task_runs
+
+
+def _copy_task_runs(task_runs):
+    return {task: runs[:] for task, runs in task_runs.items()}
+
+
+class BidsIndex(object):
+    """Index of the anat and func files in an fmriprep directory, keyed by BIDS entities
+
+    Each directory is listed at most once, the first time it is needed, and every file name is parsed once into its
+    entities. Subjects are scanned lazily, so looking up the files of one subject does not walk the whole study.
+
+    Args:
+        fmriprep_dir (str): path of fmriprep directory
+        scandir: function that takes a directory path and returns a list of (name, is_dir) tuples
+    """
+
+    def __init__(self, fmriprep_dir, scandir=None):
+        self.fmriprep_dir = fmriprep_dir
+        self.catalog = None  # study_catalog.StudyCatalog the listings come from, if any
+        self._scandir = scandir if scandir is not None else _scandir
+        self._subs = None
+        self._sessions = {}  # sub -> list of sessions (without prefix 'ses-')
+        self._subdirs = {}  # sub -> names of directories directly under the subject folder
+        self._listings = {}  # (sub, ses, datatype) -> list of (filename, entities)
+        self._runfiles = {}  # (sub, ses) -> {(task, run): list of func file names}
+        self._task_runs = {}  # (sub, ses) -> {task: sorted list of runs}
+
+    def get_all_subs(self):
+        """Returns sorted list of subject IDs (not including the prefix 'sub-')"""
+        if self._subs is None:
+            subs = []
+            for name, is_dir in self._scandir(self.fmriprep_dir):
+                if is_dir and name.startswith('sub-'):
+                    subs.append(name[len('sub-'):])
+            list.sort(subs)
+            self._subs = subs
+        return self._subs
+
+    def _read_subject(self, sub):
+        subdirs = []
+        sessions = []
+        for name, is_dir in self._scandir(os.path.join(self.fmriprep_dir, 'sub-' + sub)):
+            if is_dir:
+                subdirs.append(name)
+                if name.startswith('ses-'):
+                    sessions.append(name[len('ses-'):])
+        list.sort(sessions)
+        return sessions, subdirs
+
+    def _scan_subject(self, sub):
+        if sub not in self._subdirs:
+            self._sessions[sub], self._subdirs[sub] = self._read_subject(sub)
+
+    def get_sessions(self, sub):
+        """Returns sorted list of sessions (not including the prefix 'ses-') for a subject"""
+        self._scan_subject(sub)
+        return self._sessions[sub]
+
+    def get_dir(self, sub, ses='', datatype='func'):
+        """Returns the path of the anat or func directory of a subject (and session, if ses is not empty)"""
+        path = os.path.join(self.fmriprep_dir, 'sub-' + sub)
+        if ses:
+            path = os.path.join(path, 'ses-' + ses)
+        return os.path.join(path, datatype)
+
+    def _read_listing(self, sub, ses, datatype):
+        # only list the directory if the subject (or session) folder actually contains it
+        if (ses == '' and datatype in self._subdirs[sub]) or (ses != '' and ses in self._sessions[sub]):
+            names = [name for name, is_dir in self._scandir(self.get_dir(sub, ses, datatype)) if not is_dir]
+        else:
+            names = []
+        return [(name, parse_bids_filename(name)) for name in sorted(names)]
+
+    def _get_listing(self, sub, ses, datatype):
+        key = (sub, ses, datatype)
+        if key not in self._listings:
+            self._scan_subject(sub)
+            self._listings[key] = self._read_listing(sub, ses, datatype)
+        return self._listings[key]
+
+    def prefetch(self, nworkers=1):
+        """Lists the folder and the func directories of every subject, running up to nworkers scans at a time
+
+        On shared filesystems (Lustre, NFS, GPFS) each directory listing can take milliseconds, so listing the
+        subjects (and then their sessions) concurrently reduces the wall time roughly by the number of workers.
+
+        Args:
+            nworkers (int): number of threads; with 1 (or less) nothing is prefetched and directories are listed
+                when they are first needed
+        """
+        if nworkers <= 1:
+            return
+        subs = self.get_all_subs()
+        with ThreadPoolExecutor(max_workers=nworkers) as pool:
+            # the threads only list and parse; the results are stored by this thread
+            todo = [sub for sub in subs if sub not in self._subdirs]
+            for sub, (sessions, subdirs) in zip(todo, pool.map(self._read_subject, todo)):
+                self._sessions[sub] = sessions
+                self._subdirs[sub] = subdirs
+            keys = []
+            for sub in subs:
+                for ses in [''] + self._sessions[sub]:
+                    if (sub, ses, 'func') not in self._listings:
+                        keys.append((sub, ses, 'func'))
+            for key, listing in zip(keys, pool.map(lambda k: self._read_listing(*k), keys)):
+                self._listings[key] = listing
+
+    def list_files(self, sub, ses='', datatype='func'):
+        """Returns the sorted names of the files in the anat or func directory of a subject (and session)"""
+        return [name for name, entities in self._get_listing(sub, ses, datatype)]
+
+    def _index_func(self, sub, ses):
+        key = (sub, ses)
+        if key not in self._runfiles:
+            runfiles = {}
+            for name, entities in self._get_listing(sub, ses, 'func'):
+                if 'task' in entities and 'run' in entities:
+                    runfiles.setdefault((entities['task'], entities['run']), []).append(name)
+            self._runfiles[key] = runfiles
+            self._task_runs[key] = _task_runs_from_listing(self._get_listing(sub, ses, 'func'))
+
+    def get_task_runs(self, sub, ses=''):
+        """Returns dictionary with task names as keys and sorted lists of runs as values for a subject (and session)
+
+        Only runs with a preprocessed functional file are included.
+        """
+        self._index_func(sub, ses)
+        return self._task_runs[(sub, ses)]
+
+    def get_runs(self, sub, ses, task):
+        """Returns sorted list of runs of a task for a subject (and session)"""
+        return self.get_task_runs(sub, ses).get(task, [])
+
+    def get_run_files(self, sub, ses, task, run):
+        """Returns the names of all files in the func directory that belong to a single run"""
+        self._index_func(sub, ses)
+        return self._runfiles[(sub, ses)].get((task, run), [])
+
+    def find_files(self, sub, ses='', datatype='func', **entities):
+        """Returns the names of the files in the anat or func directory whose entities match those given
+
+        Ex: find_files('01', '', 'anat', desc='preproc', suffix='T1w')
+        """
+        matches = []
+        for name, file_entities in self._get_listing(sub, ses, datatype):
+            if all(file_entities.get(key) == value for key, value in entities.items()):
+                matches.append(name)
+        return matches
+
+    def has_sessions(self):
+        """Returns True if the func directories are under session folders
+
+        Like get_study_info, this is determined by the first subject: if it has no runs directly under the subject
+        folder, the study is assumed to have sessions.
+        """
+        subs = self.get_all_subs()
+        if len(subs) == 0:
+            return False
+        return len(self.get_task_runs(subs[0])) == 0
+
+    def get_study_info(self):
+        """Returns the structure of the fmriprep directory and whether the study has sessions (see get_study_info)"""
+        hasSessions = self.has_sessions()
+        info = {}
+        for sub in self.get_all_subs():
+            # the lists of runs are copied so that callers can modify study_info without changing the index
+            if hasSessions:
+                info['sub-' + sub] = {}
+                for ses in self.get_sessions(sub):
+                    info['sub-' + sub]['ses-' + ses] = _copy_task_runs(self.get_task_runs(sub, ses))
+            else:
+                info['sub-' + sub] = _copy_task_runs(self.get_task_runs(sub))
+        return info, hasSessions
+
+
+def get_bids_index(studydir, refresh=False, use_catalog=False):
+    """Gets the BIDS index of the fmriprep directory under studydir
+
+    The index is built once per process and reused by later calls.
+
+    Args:
+        studydir (str): path of parent directory of fmriprep directory (basedir + studyid)
+        refresh (bool): rebuild the index instead of reusing an existing one
+        use_catalog (bool): if a new index is built, reuse the directory listings stored in the study catalog (see
+            study_catalog.py) for directories that have not changed since they were last listed
+    Returns:
+        BidsIndex object
+
+    """
+    fmriprep = os.path.abspath(get_fmriprep_dir(studydir))
+    if refresh or fmriprep not in _bids_indexes:
+        if use_catalog:
+            catalog = study_catalog.open_catalog(studydir)
+            index = BidsIndex(fmriprep, scandir=catalog.scandir)
+            index.catalog = catalog
+        else:
+            index = BidsIndex(fmriprep)
+        _bids_indexes[fmriprep] = index
+    return _bids_indexes[fmriprep]
+
+
 def get_all_subs(studydir):
     """Gets list of subject IDs (not including the prefix 'sub-')
 
@@ -34,17 +316,7 @@ def get_all_subs(studydir):
         sorted list of subjects
 
     """
-    fmriprep = get_fmriprep_dir(studydir)
-    all_subs = []
-    if os.path.exists(fmriprep):
-        folders = os.listdir(fmriprep)
-        for folder in folders:
-            if os.path.isdir(os.path.join(fmriprep, folder)) and folder.startswith('sub-'):
-                i = folder.find('-')
-                sub = folder[i + 1:]
-                all_subs.append(sub)
-        list.sort(all_subs)
-    return all_subs
+    return get_bids_index(studydir, use_catalog=True).get_all_subs()[:]
 
 
 def get_runs(funcdir, task):
@@ -59,21 +331,7 @@ def get_runs(funcdir, task):
         sorted list of run names for the given task and subject (subject is specified in funcdir)
 
     """
-    runs = []
-    files = os.listdir(funcdir)
-    for f in files:
-        if ('preproc' in f) and ('bold' in f) and ('brain' not in f):
-            flag = '_task-' + task + '_run-'
-            if flag in f:
-                i1 = f.find(flag) + len(flag)
-                tmp = f[i1:]
-                i2 = tmp.find('_')
-                run = tmp[:i2]
-                if i1 > -1 and i2 > 0:
-                    if run not in runs:
-                        runs.append(run)
-    list.sort(runs)
-    return runs
+    return get_task_runs(funcdir).get(task, [])
 
 
 def get_task_runs(funcdir):
@@ -87,65 +345,67 @@ def get_task_runs(funcdir):
         dictionary (as stated above)
 
     """
-    task_runs = {}
-    if os.path.exists(funcdir):
-        files = os.listdir(funcdir)
-        for f in files:
-            if ('preproc' in f) and ('bold' in f) and ('brain' not in f):
-                # find task name
-                flag = '_task-'
-                if flag in f:
-                    i1 = f.find(flag) + len(flag)
-                    tmp = f[i1:]
-                    i2 = tmp.find('_run-')
-                    task = tmp[:i2]
-                    if i1 > -1 and i2 > -1:
-                        if task not in task_runs.keys():
-                            # find runs for this task
-                            task_runs[task] = get_runs(funcdir, task)
-    return task_runs
+    names = [name for name, is_dir in _scandir(funcdir) if not is_dir]
+    return _task_runs_from_listing([(name, parse_bids_filename(name)) for name in names])
 
 
 """
-Return structure of fmriprep directory (see documentation below) and whether studydir BIDS directory has sessions 
+Return structure of fmriprep directory (see documentation below) and whether studydir BIDS directory has sessions
 """
 
 
-def get_study_info(studydir):
-    hasSessions = False
-    study_info = get_study_info_sessions_unknown(studydir, hasSessions)
-    if len(study_info.keys()) > 0:
-        if len(study_info[list(study_info.keys())[0]]) == 0:  # if empty
-            hasSessions = True
-            study_info = get_study_info_sessions_unknown(studydir, hasSessions)
+def get_study_info(studydir, use_catalog=True, nworkers=None):
+    index = get_bids_index(studydir, use_catalog=use_catalog)
+    index.prefetch(get_discovery_workers(nworkers))
+    study_info, hasSessions = index.get_study_info()
+    if index.catalog is not None:
+        index.catalog.record_runs(index)
+        index.catalog.commit()
     return study_info, hasSessions
 
 
-def get_study_info_sessions_unknown(studydir, hasSessions):
+def get_discovery_workers(nworkers=None):
+    """Gets the number of threads used to scan subject and session directories
+
+    Args:
+        nworkers (int): number of threads; if None, the environment variable FMRI_PIPELINE_DISCOVERY_WORKERS is used
+            (or DEFAULT_DISCOVERY_WORKERS if it isn't set)
+    Returns:
+        number of threads (at least 1)
+
+    """
+    if nworkers is None:
+        try:
+            nworkers = int(os.environ.get('FMRI_PIPELINE_DISCOVERY_WORKERS', DEFAULT_DISCOVERY_WORKERS))
+        except ValueError:
+            print("WARNING: FMRI_PIPELINE_DISCOVERY_WORKERS must be an integer. Using %d threads." %
+                  DEFAULT_DISCOVERY_WORKERS)
+            nworkers = DEFAULT_DISCOVERY_WORKERS
+    return max(1, nworkers)
+
+
+def get_study_info_sessions_unknown(studydir, hasSessions, nworkers=None):
     """Gets the structure of the fmriprep directory
 
     Args:
         studydir (str): path of parent directory of fmriprep directory (basedir + studyid)
         hasSessions: True if there are sessions for this study
+        nworkers (int): number of threads used to scan the subject and session directories (see
+            get_discovery_workers)
     Returns:
         nested dictionary with subject IDs as the keys and then sessions (if they exist), task names, and list of runs
 
     """
-    fmriprep = get_fmriprep_dir(studydir)
-    all_subs = get_all_subs(studydir)
+    index = get_bids_index(studydir)
+    index.prefetch(get_discovery_workers(nworkers))
     info = {}
-    for sub in all_subs:
-        subdir = os.path.join(fmriprep, 'sub-' + sub)
-        files = os.listdir(subdir)
+    for sub in index.get_all_subs():
         info['sub-' + sub] = {}
         if hasSessions:
             # info = {'sub-01':{'ses-01':{...}}}
-            for f in files:  # session folders
-                if os.path.isdir(os.path.join(subdir, f)) and f.startswith('ses-'):
-                    funcdir = os.path.join(subdir, f, 'func')
-                    info['sub-' + sub][f] = get_task_runs(funcdir)
+            for ses in index.get_sessions(sub):
+                info['sub-' + sub]['ses-' + ses] = _copy_task_runs(index.get_task_runs(sub, ses))
         else:
             # info = {'sub-01':{'taskname':{...}}}
-            funcdir = os.path.join(subdir, 'func')
-            info['sub-' + sub] = get_task_runs(funcdir)
+            info['sub-' + sub] = _copy_task_runs(index.get_task_runs(sub))
     return info
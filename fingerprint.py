@@ -0,0 +1,151 @@
+"""
+Fingerprints of the inputs of an fsf, so that a feat output is only made again when its inputs change (make-style)
+Each generated fsf ends with a comment line that holds the fingerprint: a hash of the settings of the job (the
+arguments of mk_level1_fsf_bbr, mk_level2_fsf or mk_level3_fsf) and of every file the fsf was made from (preprocessed
+BOLD, EV files, confounds file, stubs, model files, design.fsf's of the outputs of the level below), along with the
+size, mtime and hash of each of those files. The planners (get_level1_jobs, get_level2_jobs, mk_all_level3_fsf,
+job_graph) compare the fingerprint of an existing output with the current state of its inputs without creating the fsf
+again. The fingerprint of an output is read from the copy of the fsf that feat saves in it (design.fsf), not from the
+fsf next to it, which is written again whenever the job is planned again (e.g. with --nofeat, or when feat writes to
+X+.feat because X.feat wasn't removed) and so can be newer than the output.
+Small files are hashed, so touching a file without changing it doesn't count as a change; large files (images) are
+compared by size and mtime only.
+"""
+
+import hashlib
+import json
+import os
+
+FINGERPRINT_COMMENT = '# fmri-pipeline fingerprint: '
+
+# files up to this size (bytes) are hashed; larger files are compared by size and mtime
+HASH_MAX_SIZE = 16 * 1024 * 1024
+
+
+def _hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def get_file_state(path, old_state=None):
+    """
+    Args:
+        path (str): path of an input file
+        old_state (list): state of the file when the fingerprint was made; if the size and mtime didn't change, its
+            hash is reused instead of reading the file again
+    Returns:
+        [path, size, mtime in ns, hash] ([path, None, None, None] if the file doesn't exist, and hash is None for files
+        larger than HASH_MAX_SIZE)
+    """
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return [path, None, None, None]
+    if old_state is not None and old_state[1] == st.st_size and old_state[2] == st.st_mtime_ns:
+        return [path, st.st_size, st.st_mtime_ns, old_state[3]]
+    digest = None
+    if st.st_size <= HASH_MAX_SIZE:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        digest = sha1.hexdigest()
+    return [path, st.st_size, st.st_mtime_ns, digest]
+
+
+class Fingerprint(object):
+    """Fingerprint of the settings and input files of an fsf
+
+    Args:
+        settings (dict): settings of the job; values must be JSON serializable
+    """
+
+    def __init__(self, settings):
+        self.settings_hash = _hash(json.dumps(settings, sort_keys=True))
+        self.inputs = []
+        self._paths = set()
+
+    def add(self, path, old_state=None):
+        """Adds an input file (files that don't exist are added too, so that creating them counts as a change)"""
+        path = os.path.normpath(path)
+        if path in self._paths:
+            return
+        self._paths.add(path)
+        self.inputs.append(get_file_state(path, old_state))
+
+    def digest(self):
+        # hashed files are identified by their contents, the others by their size and mtime
+        inputs = sorted([path, digest] if digest is not None else [path, size, mtime]
+                        for path, size, mtime, digest in self.inputs)
+        return _hash(json.dumps([self.settings_hash, inputs]))
+
+    def comment(self):
+        """Returns the comment line that is added to the fsf"""
+        return FINGERPRINT_COMMENT + json.dumps({'digest': self.digest(), 'settings': self.settings_hash,
+                                                 'inputs': self.inputs}) + '\n'
+
+
+def read_fingerprint(fsfname):
+    """
+    Args:
+        fsfname (str): path of an fsf
+    Returns:
+        dictionary with the digest, the hash of the settings and the states of the input files, or None if the fsf
+        doesn't exist or has no fingerprint (e.g. it was made by an older version of the pipeline)
+    """
+    fingerprint = None
+    try:
+        with open(fsfname, 'r') as f:
+            for line in f:
+                if line.startswith(FINGERPRINT_COMMENT):
+                    fingerprint = line[len(FINGERPRINT_COMMENT):]
+    except (IOError, OSError):
+        return None
+    if fingerprint is None:
+        return None
+    try:
+        return json.loads(fingerprint)
+    except ValueError:
+        return None
+
+
+def is_up_to_date(fsfname, settings):
+    """Checks whether the inputs of an fsf changed since it was made
+
+    Args:
+        fsfname (str): path of an existing fsf
+        settings (dict): current settings of the job that makes the fsf
+    Returns:
+        True if the settings and input files are the same as when the fsf was made, False if they changed, or None if
+        the fsf has no fingerprint
+    """
+    stored = read_fingerprint(fsfname)
+    if stored is None:
+        return None
+    fingerprint = Fingerprint(settings)
+    if fingerprint.settings_hash != stored['settings']:
+        return False
+    for old_state in stored['inputs']:
+        fingerprint.add(old_state[0], old_state)
+    return fingerprint.digest() == stored['digest']
+
+
+def get_output_fsfname(featdir):
+    """Returns the path of the copy of the fsf that feat saves in its output directory (.feat or .gfeat)"""
+    return os.path.join(featdir, 'design.fsf')
+
+
+def is_output_up_to_date(featdir, fsfname, settings):
+    """Checks whether the inputs of an existing feat output changed since it was made
+
+    Args:
+        featdir (str): path of the .feat or .gfeat directory
+        fsfname (str): path of the fsf next to it, used if feat didn't get as far as saving design.fsf in featdir
+        settings (dict): current settings of the job that makes the fsf
+    Returns:
+        True if the settings and input files are the same as when the output was made, False if they changed, or None
+        if its fsf has no fingerprint
+    """
+    output_fsfname = get_output_fsfname(featdir)
+    if os.path.exists(output_fsfname):
+        fsfname = output_fsfname
+    return is_up_to_date(fsfname, settings)
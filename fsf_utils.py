@@ -0,0 +1,184 @@
+"""
+Builds FSL design (.fsf) files from the design_level*.stub templates
+The default stub and the custom stub of a model are parsed once per process into an FsfTemplate (and parsed again
+only if one of them changes). Each fsf is an FsfDocument: it starts from the settings of the template, the generator
+sets the settings of the run/task/cope, and the whole file is written at once.
+"""
+
+from collections import OrderedDict
+import os
+
+FSF_HEADER = '# Automatically generated by mk_fsf.py\n'
+CUSTOM_SETTING_COMMENT = '# From custom stub file\n'
+ADDITIONAL_SETTINGS_COMMENT = '\n### Additional settings from custom stub file ###\n'
+GENERATED_PART_COMMENT = '\n\n### AUTOMATICALLY GENERATED PART###\n\n'
+
+# templates keyed by (stubfilename, customstubfilename, overrides), see get_template
+_templates = {}
+
+
+def _get_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def read_stub(stubfilename):
+    """
+    Args:
+        stubfilename (str): path of an fsf stub file
+    Returns:
+        list of (setting, llist) tuples, one per line of the stub; setting is None for lines that don't set a setting
+        and llist is the line split on spaces (so that ' '.join(llist) gives back the line)
+    """
+    lines = []
+    with open(stubfilename, 'r') as stubfile:
+        for line in stubfile:
+            llist = line.split(' ')
+            if len(line) > 3 and llist[0] == 'set':
+                lines.append((llist[1], llist))
+            else:
+                lines.append((None, [line]))
+    return lines
+
+
+def read_custom_stub(customstubfilename):
+    """
+    Args:
+        customstubfilename (str): path of a custom stub file (design_level<N>_custom.stub)
+    Returns:
+        OrderedDict with the settings ('fmri(mc)' for example) as keys and the values as they appear in the file
+        (including the newline) as values; empty if the file doesn't exist
+    """
+    customsettings = OrderedDict()
+    if customstubfilename and os.path.exists(customstubfilename):
+        with open(customstubfilename, 'r') as customstubfile:
+            for line in customstubfile:
+                llist = line.split(' ')
+                if len(line) > 3 and llist[0] == 'set':
+                    customsettings[llist[1]] = llist[2]
+    return customsettings
+
+
+def read_settings(fsfname):
+    """
+    Args:
+        fsfname (str): path of an fsf file
+    Returns:
+        OrderedDict with the value of every setting in the fsf (without the newline); if a setting is set more than
+        once, the last value is kept, as in FSL
+    """
+    settings = OrderedDict()
+    with open(fsfname, 'r') as fsffile:
+        for line in fsffile:
+            llist = line.split(' ', 2)
+            if len(llist) == 3 and llist[0] == 'set':
+                settings[llist[1]] = llist[2].strip()
+    return settings
+
+
+class FsfTemplate(object):
+    """Default stub merged with the custom stub of a model, rendered once
+
+    Args:
+        stubfilename (str): path of the default stub (design_level<N>.stub)
+        customstubfilename (str): path of the custom stub of the model; ignored if it doesn't exist
+        overrides (OrderedDict): settings that replace the values of the stub without being marked as custom
+            (e.g. the settings that --randomise requires at level 3)
+    """
+
+    def __init__(self, stubfilename, customstubfilename='', overrides=None):
+        self.stubfilename = stubfilename
+        self.customstubfilename = customstubfilename
+        self.customsettings = read_custom_stub(customstubfilename)
+        if len(self.customsettings) > 0:
+            print('Found custom fsf stub')
+        overrides = overrides or OrderedDict()
+        self.settings = OrderedDict()  # value of each setting in the stub part, without the newline
+
+        chunks = [FSF_HEADER]
+        remaining = OrderedDict(self.customsettings)
+        for setting, llist in read_stub(stubfilename):
+            if setting is not None:
+                if setting in overrides:
+                    llist = llist[:]
+                    llist[2] = str(overrides[setting]) + ('\n' if llist[2].endswith('\n') else '')
+                elif setting in remaining:
+                    # setting in default stub file shows up in custom stub file
+                    chunks.append(CUSTOM_SETTING_COMMENT)
+                    llist = llist[:]
+                    llist[2] = remaining.pop(setting)
+                self.settings[setting] = llist[2].strip()
+            chunks.append(' '.join(llist))
+
+        # settings in the custom stub file that aren't in the default stub
+        if len(remaining) > 0:
+            chunks.append(ADDITIONAL_SETTINGS_COMMENT)
+            for setting, value in remaining.items():
+                chunks.append('set ' + setting + ' ' + value)
+                self.settings[setting] = value.strip()
+        self.text = ''.join(chunks)
+
+    def document(self):
+        """Returns a new FsfDocument that starts with the settings of this template"""
+        return FsfDocument(self)
+
+
+class FsfDocument(object):
+    """A single fsf file, kept in memory until save() is called
+
+    settings is an OrderedDict with the value of every setting in the document; since FSL reads the fsf in order,
+    the value of a setting that is set more than once is the last one.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.settings = OrderedDict(template.settings)
+        self._chunks = [template.text]
+
+    def get(self, setting, default=None):
+        return self.settings.get(setting, default)
+
+    def set(self, setting, value):
+        """Adds 'set <setting> <value>' to the document
+
+        Args:
+            setting (str): name of the setting, e.g. 'fmri(npts)'
+            value: value of the setting, written with str(); strings that need quotes must include them
+        """
+        value = str(value)
+        self._chunks.append('set %s %s\n' % (setting, value))
+        self.settings[setting] = value
+
+    def write(self, text):
+        """Adds text (comments, blank lines) to the document as is"""
+        self._chunks.append(text)
+
+    def start_generated_part(self):
+        self._chunks.append(GENERATED_PART_COMMENT)
+
+    def getvalue(self):
+        return ''.join(self._chunks)
+
+    def save(self, filename):
+        """Writes the document to filename in a single write"""
+        with open(filename, 'w') as outfile:
+            outfile.write(self.getvalue())
+
+
+def get_template(stubfilename, customstubfilename='', overrides=None):
+    """Gets the template for a stub and custom stub, parsing them only the first time or if either file changed
+
+    Args:
+        stubfilename (str): path of the default stub (design_level<N>.stub)
+        customstubfilename (str): path of the custom stub of the model
+        overrides (OrderedDict): settings that replace the values of the stub (see FsfTemplate)
+    Returns:
+        FsfTemplate object
+    """
+    key = (stubfilename, customstubfilename, tuple((overrides or {}).items()))
+    mtimes = (_get_mtime(stubfilename), _get_mtime(customstubfilename) if customstubfilename else None)
+    if key not in _templates or _templates[key][0] != mtimes:
+        _templates[key] = (mtimes, FsfTemplate(stubfilename, customstubfilename, overrides))
+    return _templates[key][1]
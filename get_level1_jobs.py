@@ -1,5 +1,5 @@
 """
-Gets a list of level 1 feats to create (excludes feats that already exist)
+Gets a list of level 1 feats to create (excludes feats that already exist, unless the inputs of their fsf changed)
 The list of jobs is used by run_level1.py and passed to run_feat_job.py as a dictionary
 run_feat_job.py calls mk_level1_fsf_bbr.py
 """
@@ -12,7 +12,10 @@ import json
 import os
 
 import directory_struct_utils
+import fingerprint
+import mk_level1_fsf_bbr
 import setup_utils
+import study_catalog
 
 
 def parse_command_line(argv):
@@ -51,6 +54,42 @@ def add_args(args, sub, task, run, nofeat):
     return args
 
 
+def is_out_of_date(feat_file, args, parser):
+    """Checks whether the inputs of an existing feat changed since it was made (see fingerprint.py)
+
+    Args:
+        feat_file (str): path of the .feat directory, next to its fsf
+        args (list): arguments of the job that would make the fsf again
+        parser (argparse.ArgumentParser): argument parser of mk_level1_fsf_bbr
+    Returns:
+        True if the fingerprint changed; False if it didn't or if the fsf has no fingerprint
+    """
+    settings = mk_level1_fsf_bbr.get_fingerprint_settings(parser.parse_args(args))
+    if fingerprint.is_output_up_to_date(feat_file, feat_file[:-len('.feat')] + '.fsf', settings) is False:
+        print("WARNING: The inputs of %s changed since it was made, it will be run again" % feat_file)
+        return True
+    return False
+
+
+def prefetch_func_headers(studydir, runs):
+    """Reads the headers of the preprocessed func files of the given runs into the study catalog
+
+    Args:
+        studydir: path of parent directory of fmriprep directory (basedir + studyid)
+        runs: list of (sub, ses, task, run), where sub and ses don't include the prefixes and ses is '' if there are no
+            sessions
+    """
+    index = directory_struct_utils.get_bids_index(studydir, use_catalog=True)
+    index.prefetch(directory_struct_utils.get_discovery_workers())
+    paths = []
+    for sub, ses, task, run in runs:
+        funcdir = index.get_dir(sub, ses, 'func')
+        for name in index.get_run_files(sub, ses, task, run):
+            if directory_struct_utils.is_preproc_bold(name) and name.endswith('.nii.gz'):
+                paths.append(os.path.join(funcdir, name))
+    study_catalog.open_catalog(studydir).prefetch_nifti_headers(paths)
+
+
 def main(argv=None):
     sys_args = parse_command_line(argv)
     print(json.dumps(sys_args))
@@ -78,6 +117,10 @@ def get_level1_jobs(studyid, basedir, modelname, specificruns, sys_args_specific
         specificruns (dict): from model_params.json
         sys_args_specificruns (dict): passed into the program through the command line (sys.args)
         nofeat: boolean; don't run Feat if True, run Feat if False
+    Returns:
+        the existing feat dirs that are kept (up to date, and other feat dirs next to them, e.g. X+.feat), the list of
+        jobs, and the existing feat dirs of the jobs that are run again (their inputs changed, or they were passed in
+        through the command line); feat doesn't overwrite those, it writes to a new X+.feat instead
     """
     # gets parameters set in model_param.json
     setup_utils.model_params_json_to_namespace(studyid, basedir, modelname)
@@ -85,8 +128,10 @@ def get_level1_jobs(studyid, basedir, modelname, specificruns, sys_args_specific
     # gets dictionary of study information
     study_info = specificruns
     hasSessions = False
+    studydir = os.path.join(basedir, studyid)
+    # existing feat files are looked up through the study catalog, which only lists directories that changed
+    catalog = study_catalog.open_catalog(studydir)
     if specificruns == {}:  # if specificruns in model_params was empty
-        studydir = os.path.join(basedir, studyid)
         study_info, hasSessions = directory_struct_utils.get_study_info(studydir)
     else:
         l1 = list(study_info.keys())
@@ -102,8 +147,11 @@ def get_level1_jobs(studyid, basedir, modelname, specificruns, sys_args_specific
     # created a deep copy of study_info (want to remove runs from the copy and not the original)
     study_info_copy = copy.deepcopy(study_info)
 
+    parser = mk_level1_fsf_bbr.get_parser()  # parses the arguments of existing feats to check their fingerprints
     existing_feat_files = []
+    rerun_feat_files = []
     jobs = []  # list of list of arguments to run mk_level1_fsf_bbr on
+    job_runs = []  # (sub, ses, task, run) of each job
     subs = sorted(study_info.keys())
     # iterate through each subject, session, task, and runs
     for subid in subs:
@@ -121,22 +169,23 @@ def get_level1_jobs(studyid, basedir, modelname, specificruns, sys_args_specific
                         model_subdir = '%s/model/level1/model-%s/%s/%s/task-%s_run-%s' % (
                             os.path.join(basedir, studyid), modelname, subid, ses, task, run)
                         feat_file = "%s/%s_%s_task-%s_run-%s.feat" % (model_subdir, subid, ses, task, run)
-                        if sys_args_specificruns == {} and os.path.exists(
-                                feat_file):
-                            # if subject didn't pass in specificruns and a feat file for this run exists
+                        args = sys_argv[:]  # copies over the list of model params
+                        args = add_args(args, sub, task, run, nofeat)  # adds subject, task, and run
+                        args.append('--ses')  # adds session
+                        args.append(sesname)
+                        if sys_args_specificruns == {} and catalog.output_exists(
+                                1, feat_file) and not is_out_of_date(feat_file, args, parser):
+                            # if subject didn't pass in specificruns and an up to date feat file for this run exists
                             existing_feat_files.append(feat_file)
                             print("WARNING: Existing feat file found: %s" % feat_file)
                             runs_copy = study_info_copy[subid][ses][task]
                             runs_copy.remove(run)  # removes the run since a feat file for it already exists
                         else:  # if subject passed in specificruns
-                            if os.path.exists(feat_file):
-                                existing_feat_files.append(feat_file)
+                            if catalog.output_exists(1, feat_file):
+                                rerun_feat_files.append(feat_file)
                                 print("WARNING: Existing feat file found: %s" % feat_file)
-                            args = sys_argv[:]  # copies over the list of model params
-                            args = add_args(args, sub, task, run, nofeat)  # adds subject, task, and run
-                            args.append('--ses')  # adds session
-                            args.append(sesname)
                             jobs.append(args)  # each list 'args' specifies the arguments to run mk_level1_fsf_bbr on
+                            job_runs.append((sub, sesname, task, run))
                     if len(study_info_copy[subid][ses][task]) == 0:  # if there are no runs for this task
                         del study_info_copy[subid][ses][task]  # remove the task from the dictionary
                     if len(study_info_copy[subid][ses]) == 0:  # if there are no tasks for this session
@@ -151,19 +200,21 @@ def get_level1_jobs(studyid, basedir, modelname, specificruns, sys_args_specific
                     model_subdir = '%s/model/level1/model-%s/%s/task-%s_run-%s' % (
                         os.path.join(basedir, studyid), modelname, subid, task, run)
                     feat_file = "%s/%s_task-%s_run-%s.feat" % (model_subdir, subid, task, run)
-                    if sys_args_specificruns == {} and os.path.exists(
-                            feat_file):  # if subject didn't pass in specificruns and a feat file for this run exists
+                    args = sys_argv[:]
+                    args = add_args(args, sub, task, run, nofeat)
+                    # if subject didn't pass in specificruns and an up to date feat file for this run exists
+                    if sys_args_specificruns == {} and catalog.output_exists(
+                            1, feat_file) and not is_out_of_date(feat_file, args, parser):
                         existing_feat_files.append(feat_file)
                         print("WARNING: Existing feat file found: %s" % feat_file)
                         runs_copy = study_info_copy[subid][task]
                         runs_copy.remove(run)  # removes the run since a feat file for it already exists
                     else:  # if subject passed in specificruns
-                        if os.path.exists(feat_file):
-                            existing_feat_files.append(feat_file)
+                        if catalog.output_exists(1, feat_file):
+                            rerun_feat_files.append(feat_file)
                             print("WARNING: Existing feat file found: %s" % feat_file)
-                        args = sys_argv[:]
-                        args = add_args(args, sub, task, run, nofeat)
                         jobs.append(args)
+                        job_runs.append((sub, '', task, run))
                 if len(study_info_copy[subid][task]) == 0:  # if there are no runs for this task
                     del study_info_copy[subid][task]  # remove the task from the dictionary
         if len(study_info_copy[subid]) == 0:  # if there are no sessions or tasks for this subject left
@@ -171,11 +222,12 @@ def get_level1_jobs(studyid, basedir, modelname, specificruns, sys_args_specific
 
     additional_existing_feat_files = []
     # get additional existing feat files - any with + characters in their name
-    for feat_file in existing_feat_files:
+    for feat_file in existing_feat_files + rerun_feat_files:
         upper_feat_dir = os.path.dirname(feat_file)
-        dircontents = os.listdir(upper_feat_dir)
+        dircontents = [name for name, is_dir in catalog.scandir(upper_feat_dir)]
         for f in dircontents:
-            if os.path.join(upper_feat_dir, f) not in existing_feat_files and len(os.path.split(f)) > 0 and \
+            if os.path.join(upper_feat_dir, f) not in existing_feat_files + rerun_feat_files and \
+                    len(os.path.split(f)) > 0 and \
                     os.path.split(f)[-1]:  # get file NAME without path
                 filename = os.path.split(f)[-1]
                 if filename.endswith('.feat'):
@@ -183,20 +235,25 @@ def get_level1_jobs(studyid, basedir, modelname, specificruns, sys_args_specific
                     print("WARNING: Existing feat file found: %s" % (os.path.join(upper_feat_dir, f)))
 
     existing_feat_files = existing_feat_files + additional_existing_feat_files
+    catalog.commit()
+
+    # fill the header cache for the preprocessed func files of all jobs in one parallel pass, so that the jobs get the
+    # TR and number of timepoints from the cache
+    prefetch_func_headers(studydir, job_runs)
 
     if len(study_info_copy.keys()) == 0:
         print("WARNING: All runs for all subjects have been run on this model. Remove the feat files if you want to "
               "rerun them.")
-        return existing_feat_files, jobs
+        return existing_feat_files, jobs, rerun_feat_files
     elif sys_args_specificruns == {} and len(existing_feat_files) != 0:
         # if the user didn't pass in specificruns and existing feat files were found
         print("WARNING: Some subjects' runs have already been run on this model. If you want to rerun these subjects, "
               "remove their feat directories first. To run the remaining subjects, rerun run_level1.py and add:")
         print("-s \'%s\'" % (json.dumps(study_info_copy)))
-        return existing_feat_files, jobs
+        return existing_feat_files, jobs, rerun_feat_files
     else:  # no existing feat files were found
         print(len(jobs), "jobs")
-        return existing_feat_files, jobs
+        return existing_feat_files, jobs, rerun_feat_files
 
 
 if __name__ == '__main__':
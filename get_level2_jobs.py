@@ -11,7 +11,10 @@ import json
 import os
 import sys
 
+import fingerprint
+import mk_level2_fsf
 import setup_utils
+import study_catalog
 
 
 def parse_command_line(argv):
@@ -52,6 +55,23 @@ def add_args(args, sub, task, runs, nofeat):
     return args
 
 
+def is_out_of_date(feat_file, args, parser):
+    """Checks whether the inputs of an existing gfeat changed since it was made (see fingerprint.py)
+
+    Args:
+        feat_file (str): path of the .gfeat directory, next to its fsf
+        args (list): arguments of the job that would make the fsf again
+        parser (argparse.ArgumentParser): argument parser of mk_level2_fsf
+    Returns:
+        True if the fingerprint changed; False if it didn't or if the fsf has no fingerprint
+    """
+    settings = mk_level2_fsf.get_fingerprint_settings(parser.parse_args(args))
+    if fingerprint.is_output_up_to_date(feat_file, feat_file[:-len('.gfeat')] + '.fsf', settings) is False:
+        print("WARNING: The inputs of %s changed since it was made, it will be run again" % feat_file)
+        return True
+    return False
+
+
 def main(argv=None):
     args = parse_command_line(argv)
     print(args)
@@ -82,10 +102,14 @@ def main(argv=None):
 
     study_info_copy = copy.deepcopy(study_info)
 
+    # existing feat files are looked up through the study catalog, which only lists directories that changed
+    catalog = study_catalog.open_catalog(os.path.join(basedir, studyid))
+
     sys_argv = sys.argv[:]  # copy over the arguments passed in through the command line
     # remove the parameters that are not passed to mk_level2_fsf (keep everything that IS passed to mk_level2_fsf)
     params_to_remove = ['--email', '-e', '-A', '--account', '-t', '--time', '-N', '--nodes', '-s', '--specificruns',
-                        '--outdir', '-M', '--mem']
+                        '--outdir', '-M', '--mem', '--fsf-workers', '--jobs-per-task', '--cpus-per-task',
+                        '--max-array-size', '--array-throttle', '--queue-workers']
     for param in params_to_remove:
         if param in sys_argv:
             i = sys_argv.index(param)
@@ -94,9 +118,13 @@ def main(argv=None):
     if '--nofeat' in sys_argv:
         i = sys_argv.index('--nofeat')
         del sys_argv[i]
+    if '--resume' in sys_argv:
+        del sys_argv[sys_argv.index('--resume')]
     del sys_argv[0]
 
+    parser = mk_level2_fsf.get_parser()  # parses the arguments of existing feats to check their fingerprints
     existing_feat_files = []
+    rerun_feat_files = []  # existing gfeats of the jobs that are run again (feat writes to X+.gfeat instead)
     jobs = []  # list of list of arguments to run mk_level2_fsf on
     subs = sorted(study_info.keys())
     # iterate through each subject, session, task, and runs
@@ -112,22 +140,23 @@ def main(argv=None):
                     model_subdir = '%s/model/level2/model-%s/%s/%s/task-%s' % (
                         os.path.join(basedir, studyid), modelname, subid, ses, task)
                     feat_file = "%s/%s_%s_task-%s.gfeat" % (model_subdir, subid, ses, task)
-                    if sys_args_specificruns == {} and os.path.exists(
-                            feat_file):  # if subject didn't pass in specificruns and a feat file for this task exists
+                    runs = study_info[subid][ses][task]
+                    list.sort(runs)
+                    args = sys_argv[:]  # copies over the list of arguments passed into the command line
+                    args = add_args(args, sub, task, runs, nofeat)
+                    args.append('--ses')
+                    args.append(sesname)
+                    # if subject didn't pass in specificruns and an up to date feat file for this task exists
+                    if sys_args_specificruns == {} and catalog.output_exists(2, feat_file) and \
+                            not is_out_of_date(feat_file, args, parser):
                         print("WARNING: Existing feat file found: %s" % feat_file)
                         existing_feat_files.append(feat_file)
                         tasks_copy = study_info_copy[subid][ses]
                         tasks_copy.pop(task, None)  # removes the task from study_info_copy if a feat file was found
                     else:  # if subject passed in specificruns
-                        if os.path.exists(feat_file):
-                            existing_feat_files.append(feat_file)
+                        if catalog.output_exists(2, feat_file):
+                            rerun_feat_files.append(feat_file)
                             print("WARNING: Existing feat file found: %s" % feat_file)
-                        runs = study_info[subid][ses][task]
-                        list.sort(runs)
-                        args = sys_argv[:]  # copies over the list of arguments passed into the command line
-                        args = add_args(args, sub, task, runs, nofeat)
-                        args.append('--ses')
-                        args.append(sesname)
                         jobs.append(args)
                 if len(study_info_copy[subid][ses].keys()) == 0:  # if there are no tasks for this session
                     del study_info_copy[subid][ses]  # remove the session
@@ -140,30 +169,32 @@ def main(argv=None):
                 model_subdir = '%s/model/level2/model-%s/%s/task-%s' % (
                     os.path.join(basedir, studyid), modelname, subid, task)
                 feat_file = "%s/%s_task-%s.gfeat" % (model_subdir, subid, task)
-                if sys_args_specificruns == {} and os.path.exists(feat_file):
+                runs = study_info[subid][task]
+                list.sort(runs)
+                args = sys_argv[:]
+                args = add_args(args, sub, task, runs, nofeat)
+                if sys_args_specificruns == {} and catalog.output_exists(2, feat_file) and \
+                        not is_out_of_date(feat_file, args, parser):
                     print("WARNING: Existing feat file found: %s" % feat_file)
                     existing_feat_files.append(feat_file)
                     tasks_copy = study_info_copy[subid]
                     tasks_copy.pop(task, None)  # remove the task from the dictionary if a feat file was found
                 else:
-                    if os.path.exists(feat_file):
-                        existing_feat_files.append(feat_file)
+                    if catalog.output_exists(2, feat_file):
+                        rerun_feat_files.append(feat_file)
                         print("WARNING: Existing feat file found: %s" % feat_file)
-                    runs = study_info[subid][task]
-                    list.sort(runs)
-                    args = sys_argv[:]
-                    args = add_args(args, sub, task, runs, nofeat)
                     jobs.append(args)
             if len(study_info_copy[subid].keys()) == 0:  # if there are no tasks for this subject
                 del study_info_copy[subid]  # remove the subject from the dictionary
 
     additional_existing_feat_files = []
     # get additional existing feat files - any with + characters in their name
-    for feat_file in existing_feat_files:
+    for feat_file in existing_feat_files + rerun_feat_files:
         upper_feat_dir = os.path.dirname(feat_file)
-        dircontents = os.listdir(upper_feat_dir)
+        dircontents = [name for name, is_dir in catalog.scandir(upper_feat_dir)]
         for f in dircontents:
-            if os.path.join(upper_feat_dir, f) not in existing_feat_files and len(os.path.split(f)) > 0 and \
+            if os.path.join(upper_feat_dir, f) not in existing_feat_files + rerun_feat_files and \
+                    len(os.path.split(f)) > 0 and \
                     os.path.split(f)[-1]:  # get file NAME without path
                 filename = os.path.split(f)[-1]
                 if filename.endswith('.gfeat'):
@@ -171,22 +202,23 @@ def main(argv=None):
                     print("WARNING: Existing feat file found: %s" % (os.path.join(upper_feat_dir, f)))
 
     existing_feat_files = existing_feat_files + additional_existing_feat_files
+    catalog.commit()
 
     if len(study_info_copy.keys()) == 0:
         print(
             "WARNING: All tasks for all subjects have been run on this model. Remove the feat files if you want to "
             "rerun them.")
-        return existing_feat_files, jobs
+        return existing_feat_files, jobs, rerun_feat_files
     elif sys_args_specificruns == {} and len(
             existing_feat_files) != 0:  # if the user didn't pass in specificruns and existing feat files were found
         print(
             "WARNING: Some subjects' tasks have already been run on this model. If you want to rerun these subjects, "
             "remove their feat directories first. To run the remaining subjects, rerun run_level2.py and add:")
         print("-s \'%s\'" % (json.dumps(study_info_copy)))
-        return existing_feat_files, jobs
+        return existing_feat_files, jobs, rerun_feat_files
     else:  # no existing feat files were found
         print(len(jobs), "jobs")
-        return existing_feat_files, jobs
+        return existing_feat_files, jobs, rerun_feat_files
 
 
 if __name__ == '__main__':
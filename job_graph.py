@@ -0,0 +1,323 @@
+"""
+Graph of the feat jobs of a whole analysis: level 1 runs, level 2 subject/task jobs and level 3 copes
+A level 2 job depends on the level 1 jobs of its runs and a level 3 job depends on the level 2 jobs of its task, so
+each job is released as soon as its own inputs are done instead of waiting for every job of the level before it.
+A level 3 job is released once the level 2 jobs of its task have finished, even if some of them failed; only the
+subjects whose level 2 job succeeded are added to its fsf (see mk_level3_fsf.py --complete-inputs).
+The fsf's of level 2 and level 3 jobs are only created when the jobs are released, since they need the outputs of the
+jobs they depend on.
+Used by run_pipeline.py, which submits the graph to slurm (with --dependency) or runs it with local_executor.py
+"""
+
+import os
+
+import fingerprint
+import get_level1_jobs
+import get_level2_jobs
+import job_manifest
+import job_state
+import local_executor
+import mk_level2_fsf
+import mk_level3_fsf
+import model_spec
+import run_feat_job
+import slurm_utils
+import study_catalog
+
+
+class GraphJob(object):
+    """A job of the graph
+
+    Args:
+        name (str): unique name of the job, e.g. level2_sub-01_ses-01_task-flanker
+        level (int): level of analysis
+        job (list): arguments for mk_level1_fsf_bbr, mk_level2_fsf or mk_level3_fsf
+        deps (list): names of the jobs that must finish before this job is released
+        dep_mode (str): 'ok' if the jobs in deps must succeed or 'any' if they only need to finish (a level 3 cope
+            includes the subjects whose level 2 jobs succeeded)
+    """
+
+    def __init__(self, name, level, job, deps=(), dep_mode='ok'):
+        self.name = name
+        self.level = level
+        self.job = job
+        self.deps = list(deps)
+        self.dep_mode = dep_mode
+        self.index = None  # index of the job in the manifest of its level
+
+
+def _get_arg(job, flag, default=''):
+    if flag in job:
+        return job[job.index(flag) + 1]
+    return default
+
+
+def _get_subid_ses(sub, ses):
+    return 'sub-%s' % sub + ('_ses-%s' % ses if ses else '')
+
+
+def build_graph(studyid, basedir, modelname, specificruns, sys_args_specificruns, subids=(), randomise=False,
+                resume=False):
+    """Plans the level 1, level 2 and level 3 jobs of an analysis and the dependencies between them
+
+    If sys_args_specificruns is empty, runs whose level 1 feat exists are not run again, unless the inputs of their
+    fsf changed (see fingerprint.py). A level 2 (or level 3) job is skipped if its gfeat exists, the inputs of its fsf
+    didn't change and none of the jobs it depends on are run again.
+    With resume, the recorded state of each job is used instead (see job_state.py): jobs that succeeded or are still
+    queued or running are skipped, and jobs that failed or were never run are run again, along with the jobs that
+    depend on them.
+
+    Args:
+        studyid (str): name of the study (parent directory of fmriprep)
+        basedir (str): path of the directory above the study directory
+        modelname (str): name of model (not including "model-")
+        specificruns (dict): runs to analyze
+        sys_args_specificruns (dict): runs passed in through the command line ({} if none were)
+        subids (list): subjects to include in level 3 (not including "sub-"); all subjects if empty
+        randomise (bool): use randomise for the level 3 stats
+        resume (bool): only run the jobs that failed or were never run
+    Returns:
+        list of GraphJob objects, level 1 jobs first, then level 2, then level 3
+    """
+    studydir = os.path.join(basedir, studyid)
+    catalog = study_catalog.open_catalog(studydir)
+    spec = model_spec.get_model_spec(studyid, basedir, modelname)
+    common = ['--studyid', studyid, '--basedir', basedir, '-m', modelname]
+
+    # level 1: one job per run
+    if resume:
+        # plan every run, then keep the runs that have to be run again
+        _, level1_jobs, _ = get_level1_jobs.get_level1_jobs(studyid, basedir, modelname, specificruns, specificruns,
+                                                            False)
+        level1_jobs = [job for job in level1_jobs if job_state.get_job_status(job, 1)[0] in ['failed', 'missing']]
+    else:
+        _, level1_jobs, _ = get_level1_jobs.get_level1_jobs(studyid, basedir, modelname, specificruns,
+                                                            sys_args_specificruns, False)
+    graph = []
+    level1_names = {}  # (sub, ses, task) -> names of the level 1 jobs of its runs
+    for job in level1_jobs:
+        sub, ses, task, run = (_get_arg(job, '--sub'), _get_arg(job, '--ses'), _get_arg(job, '--taskname'),
+                               _get_arg(job, '--runname'))
+        name = 'level1_%s_task-%s_run-%s' % (_get_subid_ses(sub, ses), task, run)
+        graph.append(GraphJob(name, 1, job))
+        level1_names.setdefault((sub, ses, task), []).append(name)
+
+    # level 2: one job per subject, session and task, released once the level 1 jobs of its runs succeed
+    level2_names = {}  # (ses, task) -> (sub, name of the level 2 job)
+    level2_tasks = set()  # (ses, task) of all subjects, including those whose gfeat exists
+    for subid in sorted(specificruns.keys()):
+        sub = subid[len('sub-'):]
+        if any(key.startswith('ses-') for key in specificruns[subid]):
+            task_runs = [(ses[len('ses-'):], task, runs) for ses in sorted(specificruns[subid])
+                         for task, runs in sorted(specificruns[subid][ses].items())]
+        else:
+            task_runs = [('', task, runs) for task, runs in sorted(specificruns[subid].items())]
+        for ses, task, runs in task_runs:
+            level2_tasks.add((ses, task))
+            deps = level1_names.get((sub, ses, task), [])
+            job = get_level2_jobs.add_args(common[:], sub, task, sorted(runs), False)
+            if ses:
+                job += ['--ses', ses]
+            if len(deps) == 0 and _is_done(catalog, job, 2, resume):
+                continue
+            name = 'level2_%s_task-%s' % (_get_subid_ses(sub, ses), task)
+            graph.append(GraphJob(name, 2, job, deps, 'ok'))
+            level2_names.setdefault((ses, task), []).append((sub, name))
+
+    # level 3: one job per session, task and cope, released once the level 2 jobs of its subjects have finished
+    for ses, task in sorted(level2_tasks):
+        ncopes = spec.get_ncopes(task)
+        if ncopes is None:
+            print("WARNING: Task name %s was not found in %s, no level 3 jobs were planned for it" % (
+                task, spec.condition_key_file))
+            continue
+        deps = [name for sub, name in level2_names.get((ses, task), []) if len(subids) == 0 or sub in subids]
+        for copenum in range(1, ncopes + 1):
+            cope_name = '%stask-%s_cope-%03d' % ('ses-%s_' % ses if ses else '', task, copenum)
+            # the cope is released once the level 2 jobs have finished, so only the subjects whose job succeeded are
+            # added to its fsf
+            job = common + ['--taskname', task, '--copes', str(copenum), '--complete-inputs']
+            if ses:
+                job += ['--sesname', ses]
+            if len(subids) > 0:
+                job += ['--subs'] + list(subids)
+            if randomise:
+                job.append('--randomise')
+            if len(deps) == 0 and _is_done(catalog, job, 3, resume):
+                continue
+            graph.append(GraphJob('level3_' + cope_name, 3, job, deps, 'any'))
+    catalog.commit()
+
+    for level in [1, 2, 3]:
+        for i, graph_job in enumerate(graph_job for graph_job in graph if graph_job.level == level):
+            graph_job.index = i
+    return graph
+
+
+def _is_done(catalog, job, level, resume):
+    # whether a level 2 or level 3 job whose inputs are not run again can be skipped
+    featdir = os.path.normpath(job_state.get_job_output(job, level)[1])
+    if resume:
+        return job_state.get_job_status(job, level)[0] in ['done', 'active']
+    if catalog.output_exists(level, featdir) and not _is_out_of_date(job, level, featdir):
+        if level == 2:
+            print("WARNING: Existing feat file found: %s" % featdir)
+        else:
+            print("WARNING: Existing cope found here: %s" % featdir)
+        return True
+    return False
+
+
+def _is_out_of_date(job, level, featdir):
+    # whether the inputs of an existing level 2 or level 3 output changed since it was made (see fingerprint.py)
+    if level == 2:
+        a = mk_level2_fsf.get_parser().parse_args(job)
+        fsfname = featdir[:-len('.gfeat')] + '.fsf'
+        settings = mk_level2_fsf.get_fingerprint_settings(a)
+    else:
+        a = mk_level3_fsf.get_parser().parse_args(job)
+        fsfname = mk_level3_fsf.get_fsfname(a, a.copes[0])
+        settings = mk_level3_fsf.get_fingerprint_settings(a, mk_level3_fsf.get_sublist(a), a.copes[0])
+    if fingerprint.is_output_up_to_date(featdir, fsfname, settings) is False:
+        print("WARNING: The inputs of %s changed since it was made, it will be run again" % featdir)
+        return True
+    return False
+
+
+def get_existing_outputs(graph):
+    """Returns the outputs of the jobs of the graph that exist (feat would not overwrite them)"""
+    featdirs = [job_state.get_job_output(graph_job.job, graph_job.level)[1] for graph_job in graph]
+    return [featdir for featdir in featdirs if os.path.exists(featdir)]
+
+
+def get_level_jobs(graph, level):
+    """Returns the GraphJobs of a level, in the order of their indices"""
+    return [graph_job for graph_job in graph if graph_job.level == level]
+
+
+def submit_graph(graph, outputdir, jobname, account, nodes, times, mem, email, max_array_size=None, throttle=0):
+    """Submits the graph to slurm: one job array for level 1, one job per level 2 job and one job array per level 3
+    task, each with a --dependency on the jobs it needs
+
+    Args:
+        graph (list): GraphJob objects returned by build_graph
+        outputdir (str): directory in which the manifests, sbatch files and sbatch output are saved
+        jobname (str): name of the slurm jobs (the level is appended)
+        account (str): slurm account
+        nodes (int): number of nodes
+        times (dict): time limit of each job of each level (hh:mm:ss), with the levels as keys
+        mem (int): memory allocation of each job in MB
+        email (str): email to send job updates to
+        max_array_size (int): maximum number of tasks of each job array (see slurm_utils.submit_array)
+        throttle (int): maximum number of tasks of a job array that run at the same time (0 for no limit)
+    Returns:
+        dictionary with the names of the GraphJobs as keys and the IDs of their slurm jobs as values
+    Raises:
+        FileNotFoundError if sbatch is not found
+    """
+    fmripipelinedir = os.path.dirname(os.path.abspath(__file__))
+    sbatch_paths = {}
+    outputs = {}
+    for level in [1, 2, 3]:
+        level_jobs = get_level_jobs(graph, level)
+        if len(level_jobs) == 0:
+            continue
+        leveldir = os.path.join(outputdir, 'level%d' % level)
+        if not os.path.exists(leveldir):
+            os.makedirs(leveldir)
+        manifest_path = job_manifest.write_manifest(leveldir, [graph_job.job for graph_job in level_jobs], level,
+                                                    time=times[level], mem=mem)
+        command = "python %s --manifest %s -i %s --level %d" % (
+            os.path.join(fmripipelinedir, 'run_feat_job.py'), manifest_path, slurm_utils.ARRAY_TASK_INDEX, level)
+        sbatch_paths[level] = os.path.join(leveldir, 'run_level%d.sbatch' % level)
+        outputs[level] = os.path.join(leveldir, '%s_%%a.o' % jobname)
+        slurm_utils.write_sbatch(sbatch_paths[level], '%s-level%d' % (jobname, level), account, nodes, times[level],
+                                 mem, email, len(level_jobs), outputs[level], command)
+
+    # array indices start at 0 in each submitted array; the index of the job in the manifest is exported as the offset
+    # of the array (see slurm_utils.submit_array), so that no index goes over the MaxArraySize of the cluster
+    slurm_ids = {}
+    level1_jobs = get_level_jobs(graph, 1)
+    if len(level1_jobs) > 0:
+        task_ids = slurm_utils.submit_array(sbatch_paths[1], len(level1_jobs), max_array_size, throttle,
+                                            output=outputs[1])
+        for graph_job in level1_jobs:
+            slurm_ids[graph_job.name] = task_ids[graph_job.index]
+        print('Submitted %d level 1 jobs (job %s)' % (
+            len(level1_jobs), ' '.join(sorted(set(task_id.split('_')[0] for task_id in task_ids)))))
+
+    level2_jobs = get_level_jobs(graph, 2)
+    for graph_job in level2_jobs:
+        dependency = None
+        if len(graph_job.deps) > 0:
+            dependency = 'afterok:' + ':'.join(slurm_ids[dep] for dep in graph_job.deps)
+        slurm_ids[graph_job.name] = slurm_utils.submit(sbatch_paths[2], array='0', dependency=dependency,
+                                                       export={'FMRI_PIPELINE_ARRAY_OFFSET': graph_job.index},
+                                                       output=outputs[2].replace('%a', '%A'))
+    if len(level2_jobs) > 0:
+        print('Submitted %d level 2 jobs' % len(level2_jobs))
+
+    # the copes of a task have the same dependencies, so they are submitted together as an array
+    level3_jobs = get_level_jobs(graph, 3)
+    groups = []
+    for graph_job in level3_jobs:
+        if len(groups) > 0 and groups[-1][-1].deps == graph_job.deps:
+            groups[-1].append(graph_job)
+        else:
+            groups.append([graph_job])
+    for group in groups:
+        dependency = None
+        if len(group[0].deps) > 0:
+            dependency = 'afterany:' + ':'.join(slurm_ids[dep] for dep in group[0].deps)
+        task_ids = slurm_utils.submit_array(sbatch_paths[3], len(group), max_array_size, throttle, dependency,
+                                            outputs[3], offset=group[0].index)
+        for graph_job, task_id in zip(group, task_ids):
+            slurm_ids[graph_job.name] = task_id
+    if len(level3_jobs) > 0:
+        print('Submitted %d level 3 jobs in %d arrays' % (len(level3_jobs), len(groups)))
+
+    for level in [1, 2, 3]:
+        level_jobs = get_level_jobs(graph, level)
+        job_state.record_queued([graph_job.job for graph_job in level_jobs], level,
+                                [slurm_ids[graph_job.name] for graph_job in level_jobs])
+    return slurm_ids
+
+
+def _prepare(graph_job):
+    # creates the fsf of a level 2 or level 3 job once the jobs it depends on are done
+    return run_feat_job.get_feat_commands([graph_job.job], graph_job.level)[0]
+
+
+def run_graph_locally(graph, logdir, mem, parallel=True, fsf_workers=1):
+    """Runs the graph on the local machine with local_executor, releasing each job once the jobs it needs are done
+
+    Args:
+        graph (list): GraphJob objects returned by build_graph
+        logdir (str): directory in which the log of each job is written
+        mem (int): memory each job needs in MB
+        parallel (bool): if False, the jobs are run one at a time
+        fsf_workers (int): number of processes that create the fsf's of the level 1 jobs
+    Returns:
+        dictionary with the names of the jobs as keys and their exit codes as values (None for skipped jobs)
+    """
+    for level in [1, 2, 3]:
+        job_state.record_queued([graph_job.job for graph_job in get_level_jobs(graph, level)], level)
+    level1_jobs = get_level_jobs(graph, 1)
+    # the level 1 fsf's don't depend on other jobs, so they are all created now
+    level1_commands = run_feat_job.get_feat_commands([graph_job.job for graph_job in level1_jobs], 1, fsf_workers) \
+        if len(level1_jobs) > 0 else []
+    local_jobs = []
+    for graph_job, commands in zip(level1_jobs, level1_commands):
+        cost = local_executor.estimate_cost(commands) if commands is not None else 0.0
+        local_jobs.append(local_executor.LocalJob(graph_job.name, commands, mem, cost, priority=1,
+                                                  prepare=(lambda: None) if commands is None else None,
+                                                  **local_executor.get_state_hooks(graph_job.job, 1)))
+    for graph_job in graph:
+        if graph_job.level == 1:
+            continue
+        # jobs of later levels start first once they are ready, so that results come out as early as possible
+        local_jobs.append(local_executor.LocalJob(graph_job.name, None, mem, deps=graph_job.deps,
+                                                  dep_mode=graph_job.dep_mode, priority=graph_job.level,
+                                                  prepare=lambda graph_job=graph_job: _prepare(graph_job),
+                                                  **local_executor.get_state_hooks(graph_job.job, graph_job.level)))
+    return local_executor.run_jobs(local_jobs, logdir, max_jobs=None if parallel else 1)
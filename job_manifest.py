@@ -0,0 +1,114 @@
+"""
+Job manifest: the list of jobs of a job array, written to a file that each array task reads a single job from
+The manifest (jobs.jsonl) is a JSON-lines file. Its first line is a header with the level and the arguments that all
+jobs share (the model params), and each following line holds the remaining arguments of one job. A separate index
+file (jobs.jsonl.idx) holds the byte offset of each job's line as an 8-byte integer, so job i is found with two seeks
+instead of parsing every job.
+"""
+
+import json
+import os
+import struct
+
+MANIFEST_FILENAME = 'jobs.jsonl'
+INDEX_SUFFIX = '.idx'
+
+_OFFSET = struct.Struct('<Q')
+
+
+def _get_shared_args(jobs):
+    """Returns the longest list of arguments that every job starts with (jobs that aren't lists share nothing)"""
+    if len(jobs) == 0 or not all(isinstance(job, list) for job in jobs):
+        return []
+    shared = jobs[0]
+    for job in jobs[1:]:
+        n = 0
+        while n < len(shared) and n < len(job) and shared[n] == job[n]:
+            n += 1
+        shared = shared[:n]
+    return list(shared)
+
+
+def write_manifest(outputdir, jobs, level, filename=MANIFEST_FILENAME, time=None, mem=None):
+    """Writes the jobs of a job array to outputdir/jobs.jsonl and its index
+
+    Args:
+        outputdir (str): directory of the job array (where the sbatch file and the output are saved)
+        jobs (list): jobs to run; each job is a list of arguments (levels 1 and 2) or the path of an fsf (level 3)
+        level (int): level of analysis
+        filename (str): name of the manifest, if several job arrays are saved to outputdir
+        time (str): time limit of each job (hh:mm:ss), saved in the header so that failed jobs can be retried with
+            more time (see retry_jobs.py)
+        mem (int): memory allocation of each job in MB, saved in the header
+    Returns:
+        path of the manifest
+    """
+    manifest_path = os.path.join(outputdir, filename)
+    shared = _get_shared_args(jobs)
+    header = {'level': level, 'njobs': len(jobs), 'shared': shared}
+    if time is not None:
+        header['time'] = time
+    if mem is not None:
+        header['mem'] = mem
+    offsets = []
+    with open(manifest_path, 'wb') as f:
+        f.write((json.dumps(header) + '\n').encode('utf-8'))
+        for job in jobs:
+            offsets.append(f.tell())
+            row = job[len(shared):] if len(shared) > 0 else job
+            f.write((json.dumps(row) + '\n').encode('utf-8'))
+    with open(manifest_path + INDEX_SUFFIX, 'wb') as f:
+        f.write(b''.join(_OFFSET.pack(offset) for offset in offsets))
+    return manifest_path
+
+
+def read_header(manifest_path):
+    """Returns the header of a manifest: dictionary with 'level', 'njobs', 'shared' and, if they were saved, 'time' and
+    'mem'"""
+    with open(manifest_path, 'rb') as f:
+        return json.loads(f.readline().decode('utf-8'))
+
+
+def read_job(manifest_path, i):
+    """Reads a single job from a manifest
+
+    Args:
+        manifest_path (str): path of jobs.jsonl
+        i (int): index of the job (e.g. $SLURM_ARRAY_TASK_ID)
+    Returns:
+        the job as it was passed to write_manifest
+    Raises:
+        IndexError if there is no job i in the manifest, ValueError if the index of the manifest is truncated
+    """
+    with open(manifest_path, 'rb') as f:
+        header = json.loads(f.readline().decode('utf-8'))
+        # checked before seeking, since seeking to a negative offset raises an OSError
+        if not 0 <= i < header['njobs']:
+            raise IndexError('%s has no job %d, it has %d jobs' % (manifest_path, i, header['njobs']))
+        with open(manifest_path + INDEX_SUFFIX, 'rb') as index:
+            index.seek(i * _OFFSET.size)
+            data = index.read(_OFFSET.size)
+        if len(data) < _OFFSET.size:
+            raise ValueError('%s%s is shorter than the %d jobs of %s' % (manifest_path, INDEX_SUFFIX, header['njobs'],
+                                                                        manifest_path))
+        f.seek(_OFFSET.unpack(data)[0])
+        row = json.loads(f.readline().decode('utf-8'))
+    if len(header['shared']) > 0:
+        return header['shared'] + row
+    return row
+
+
+def read_jobs(manifest_path):
+    """Reads all the jobs of a manifest, in order"""
+    with open(manifest_path, 'rb') as f:
+        header = json.loads(f.readline().decode('utf-8'))
+        rows = [json.loads(line.decode('utf-8')) for line in f]
+    if len(header['shared']) > 0:
+        return [header['shared'] + row for row in rows]
+    return rows
+
+
+def remove_manifest(manifest_path):
+    for path in [manifest_path, manifest_path + INDEX_SUFFIX]:
+        if os.path.exists(path):
+            os.remove(path)
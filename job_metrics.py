@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+Runtime metrics of the commands that run feat: wall time, CPU time, peak memory and bytes read and written
+Each command is waited for with wait4, which returns the resource usage of the command and of the processes it waited
+for (feat runs most of its work in child processes). The I/O counters are read from /proc/<pid>/io while the
+command is a zombie, just before it is reaped, so they include the I/O of its children too. The /proc counters are
+only available on Linux; elsewhere they are left out.
+The metrics of each job are appended as a JSON line to <studyid>/.fmri_pipeline_metrics.jsonl along with the
+subject, session, task, run and host of the job. Each record is written with a single write to a file opened in
+append mode, so jobs running at the same time don't need a lock.
+Run this script to summarize the metrics of a study: throughput, tail latencies and the slowest subjects of each level.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+METRICS_FILENAME = '.fmri_pipeline_metrics.jsonl'
+
+# fields of /proc/<pid>/io that are recorded (bytes)
+_IO_FIELDS = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Summarize the runtime metrics of the feat jobs of a study')
+
+    parser.add_argument('--studyid', dest='studyid',
+                        required=True, help='Study ID')
+    parser.add_argument('--basedir', dest='basedir',
+                        required=True, help='Base directory (above studyid directory)')
+    parser.add_argument('-m', '--modelname', dest='modelname',
+                        default='', help='Only summarize the jobs of this model')
+    parser.add_argument('--level', dest='level', type=int, choices=[1, 2, 3],
+                        default=None, help='Only summarize the jobs of this level')
+    parser.add_argument('--top', dest='top', type=int,
+                        default=5, help='Number of slowest subjects to list for each level. Defaults to 5.')
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def _get_arg(job, flag, default=''):
+    if flag in job:
+        return job[job.index(flag) + 1]
+    return default
+
+
+def read_proc_io(pid):
+    """
+    Args:
+        pid: process ID, or 'self'
+    Returns:
+        dictionary with the I/O counters of the process (bytes), or None if /proc/<pid>/io can't be read
+    """
+    try:
+        with open('/proc/%s/io' % pid, 'r') as f:
+            counters = dict(line.split(':', 1) for line in f if ':' in line)
+    except (IOError, OSError):
+        return None
+    return dict((field, int(counters[field])) for field in _IO_FIELDS if field in counters)
+
+
+def _get_usage(rusage, wall, io):
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    max_rss_mb = rusage.ru_maxrss / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+    usage = {'wall_s': wall, 'user_s': rusage.ru_utime, 'sys_s': rusage.ru_stime, 'max_rss_mb': max_rss_mb}
+    if io is not None:
+        usage.update(io)
+    return usage
+
+
+def poll(proc, start):
+    """Checks whether a process started with subprocess.Popen finished, and measures what it used if it did
+
+    Args:
+        proc (subprocess.Popen): the process
+        start (float): time.time() when the process was started
+    Returns:
+        None if the process is still running, otherwise tuple of its exit code and its usage (see run)
+    """
+    return _wait(proc, start, os.WNOHANG)
+
+
+def wait(proc, start):
+    """Waits for a process started with subprocess.Popen and measures what it used (see poll)"""
+    return _wait(proc, start, 0)
+
+
+def _get_exit_code(status):
+    # exit code of a wait status, negative for a signal like Popen.returncode (os.waitstatus_to_exitcode needs 3.9)
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return -os.WTERMSIG(status)
+
+
+def _wait(proc, start, options):
+    io = None
+    if hasattr(os, 'waitid'):
+        # the process is left a zombie (WNOWAIT) so that its I/O counters can still be read before it is reaped
+        try:
+            if os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT | options) is None:
+                return None
+            io = read_proc_io(proc.pid)
+        except ChildProcessError:
+            pass
+    try:
+        pid, status, rusage = os.wait4(proc.pid, options)
+    except ChildProcessError:  # already reaped
+        proc.wait()
+        return proc.returncode, None
+    if pid == 0:
+        return None
+    proc.returncode = _get_exit_code(status)
+    return proc.returncode, _get_usage(rusage, time.time() - start, io)
+
+
+def run(args, **kwargs):
+    """Runs a command and measures what it used
+
+    Args:
+        args (list): the command
+        kwargs: other arguments of subprocess.Popen
+    Returns:
+        tuple of the exit code and a dictionary with 'wall_s', 'user_s', 'sys_s' (seconds), 'max_rss_mb' and, on
+        Linux, the I/O counters of the command and its children ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+    """
+    start = time.time()
+    proc = subprocess.Popen(args, **kwargs)
+    return wait(proc, start)
+
+
+def combine_usages(usages):
+    """Adds up the usages of the commands of a job (the peak memory is the largest of them); None if there are none"""
+    usages = [usage for usage in usages if usage is not None]
+    if len(usages) == 0:
+        return None
+    combined = {}
+    for usage in usages:
+        for field, value in usage.items():
+            if field == 'max_rss_mb':
+                combined[field] = max(combined.get(field, 0), value)
+            else:
+                combined[field] = combined.get(field, 0) + value
+    return combined
+
+
+def get_job_labels(job, level):
+    """Gets the study directory, model, subject, session, task, run and cope of a job
+
+    Args:
+        job: list of arguments for mk_level1_fsf_bbr, mk_level2_fsf or mk_level3_fsf, or path of a level 3 fsf
+        level (int): level of analysis
+    Returns:
+        tuple of the study directory and a dictionary of labels ('' for labels that don't apply to the job)
+    """
+    labels = {'model': '', 'sub': '', 'ses': '', 'task': '', 'run': '', 'cope': ''}
+    if level == 3 and not isinstance(job, list):
+        # .../model/level3/model-<model>[/ses-<ses>]/task-<task>/[ses-<ses>_]task-<task>_cope-<NNN>.fsf
+        parts = os.path.abspath(job).split(os.sep)
+        level3 = len(parts) - 1 - parts[::-1].index('level3')
+        labels['model'] = parts[level3 + 1][len('model-'):]
+        labels['task'] = parts[-2][len('task-'):]
+        if parts[level3 + 2].startswith('ses-'):
+            labels['ses'] = parts[level3 + 2][len('ses-'):]
+        labels['cope'] = parts[-1][parts[-1].find('_cope-') + len('_cope-'):-len('.fsf')]
+        return os.sep.join(parts[:level3 - 1]), labels
+
+    studydir = os.path.join(_get_arg(job, '--basedir'), _get_arg(job, '--studyid'))
+    labels['model'] = _get_arg(job, '--modelname', _get_arg(job, '-m'))
+    labels['sub'] = _get_arg(job, '--sub')
+    labels['ses'] = _get_arg(job, '--ses', _get_arg(job, '--sesname'))
+    labels['task'] = _get_arg(job, '--taskname')
+    labels['run'] = _get_arg(job, '--runname')
+    if level == 3 and _get_arg(job, '--copes'):
+        labels['cope'] = '%03d' % int(_get_arg(job, '--copes'))
+    return studydir, labels
+
+
+def record(studydir, level, labels, exitcode, usage):
+    """Appends the metrics of a job to the metrics store of a study
+
+    Args:
+        studydir (str): path of parent directory of fmriprep directory (basedir + studyid)
+        level (int): level of analysis
+        labels (dict): model, sub, ses, task, run and cope of the job
+        exitcode (int): exit code of the job
+        usage (dict): usage of the job (see run), None if it wasn't measured
+    """
+    if usage is None:
+        return
+    row = {'time': time.time(), 'level': level, 'host': socket.gethostname(), 'exit_code': exitcode,
+           'slurm_job_id': os.environ.get('SLURM_JOB_ID', '')}
+    row.update(labels)
+    row.update(usage)
+    line = (json.dumps(row) + '\n').encode('utf-8')
+    try:
+        fd = os.open(os.path.join(studydir, METRICS_FILENAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as e:
+        print("WARNING: Could not record the metrics of the job: %s" % e)
+
+
+def record_job(job, level, exitcode, usage):
+    """Appends the metrics of a job (see get_job_labels) to the metrics store of its study"""
+    studydir, labels = get_job_labels(job, level)
+    record(studydir, level, labels, exitcode, usage)
+
+
+def call(args, studydir, level, labels):
+    """Runs a command like subprocess.call and appends its metrics to the metrics store of the study
+
+    Returns:
+        exit code of the command
+    """
+    exitcode, usage = run(args)
+    record(studydir, level, labels, exitcode, usage)
+    return exitcode
+
+
+def read_metrics(studydir):
+    """Reads the metrics store of a study; lines that can't be parsed (e.g. cut off by a crash) are skipped"""
+    rows = []
+    path = os.path.join(studydir, METRICS_FILENAME)
+    if not os.path.exists(path):
+        return rows
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                continue
+    return rows
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    k = (len(values) - 1) * percentile / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def _get_job_name(row):
+    name = 'sub-%s' % row['sub'] if row.get('sub') else ''
+    for label, prefix in [('ses', 'ses-'), ('task', 'task-'), ('run', 'run-'), ('cope', 'cope-')]:
+        if row.get(label):
+            name += ('_' if name else '') + prefix + row[label]
+    return name
+
+
+def summarize(rows, top=5):
+    """Prints the throughput, tail latencies and slowest subjects of each level
+
+    Args:
+        rows (list): records of the metrics store
+        top (int): number of slowest subjects to list for each level
+    """
+    for level in sorted(set(row['level'] for row in rows)):
+        level_rows = [row for row in rows if row['level'] == level]
+        walls = [row['wall_s'] for row in level_rows]
+        failed = len([row for row in level_rows if row['exit_code'] != 0])
+        # jobs per hour between the start of the first job and the end of the last one
+        span = max(row['time'] for row in level_rows) - min(row['time'] - row['wall_s'] for row in level_rows)
+        print('\nLevel %d: %d jobs (%d failed) on %d hosts' % (level, len(level_rows), failed,
+                                                               len(set(row['host'] for row in level_rows))))
+        print('\tThroughput: %.1f jobs per hour over %s' % (len(level_rows) * 3600.0 / max(span, 1),
+                                                             _format_duration(span)))
+        print('\tWall time: p50 %s, p90 %s, p99 %s, max %s, total %.1f hours' % (
+            _format_duration(_percentile(walls, 50)), _format_duration(_percentile(walls, 90)),
+            _format_duration(_percentile(walls, 99)), _format_duration(max(walls)), sum(walls) / 3600.0))
+        cpu = sum(row['user_s'] + row['sys_s'] for row in level_rows)
+        print('\tCPU time: %.1f hours (%.0f%% of the wall time)' % (cpu / 3600.0, 100.0 * cpu / max(sum(walls), 1)))
+        rss = [row['max_rss_mb'] for row in level_rows]
+        print('\tPeak memory: p50 %.0f MB, p90 %.0f MB, max %.0f MB' % (_percentile(rss, 50), _percentile(rss, 90),
+                                                                       max(rss)))
+        written = [row['write_bytes'] for row in level_rows if 'write_bytes' in row]
+        if len(written) > 0:
+            print('\tWritten to disk: %.2f GB (%.0f MB per job)' % (sum(written) / 1073741824.0,
+                                                                    sum(written) / 1048576.0 / len(written)))
+
+        # subjects whose jobs took the longest in total (level 3 jobs are per cope, so they are listed by job)
+        totals = {}
+        for row in level_rows:
+            key = 'sub-%s' % row['sub'] if row.get('sub') else _get_job_name(row)
+            total, slowest = totals.get(key, (0.0, None))
+            if slowest is None or row['wall_s'] > slowest['wall_s']:
+                slowest = row
+            totals[key] = (total + row['wall_s'], slowest)
+        print('\tSlowest %s:' % ('subjects' if level < 3 else 'jobs'))
+        for key, (total, slowest) in sorted(totals.items(), key=lambda item: -item[1][0])[:top]:
+            if level == 3:
+                print('\t\t%s: %s' % (key, _format_duration(total)))
+                continue
+            print('\t\t%s: %s in total, slowest job %s (%s)' % (key, _format_duration(total), _get_job_name(slowest),
+                                                                _format_duration(slowest['wall_s'])))
+
+
+def main(argv=None):
+    args = parse_command_line(argv)
+    rows = read_metrics(os.path.join(args.basedir, args.studyid))
+    if args.modelname:
+        rows = [row for row in rows if row.get('model') == args.modelname]
+    if args.level is not None:
+        rows = [row for row in rows if row['level'] == args.level]
+    if len(rows) == 0:
+        print('No metrics were recorded for these jobs.')
+        return
+    summarize(rows, args.top)
+
+
+if __name__ == '__main__':
+    main()
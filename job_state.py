@@ -0,0 +1,382 @@
+"""
+Records the state of each feat job (queued, running, succeeded or failed) so that a rerun can tell finished outputs
+from partial ones
+The state of each job is a small JSON file under <studyid>/.fmri_pipeline_state, named after the output directory of
+the job (.feat or .gfeat). Each file is replaced atomically by the process that runs the job, so array tasks never
+write to the same file and no locking is needed on shared filesystems.
+A job succeeded if feat exited with 0 and its output passes the checks of openfmri_utils.check_featdir (stats
+directory, zstat files, no errors in report.log).
+"""
+
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import time
+
+import model_spec
+from openfmri_utils import check_featdir
+
+STATE_DIRNAME = '.fmri_pipeline_state'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+_REPORT_ERROR = re.compile(r'\berror\b', re.IGNORECASE)
+
+# state store of each study directory, keyed by the path of the study directory
+_stores = {}
+
+
+def _get_arg(job, flag, default=''):
+    if flag in job:
+        return job[job.index(flag) + 1]
+    return default
+
+
+def get_job_output(job, level):
+    """Gets the output directory of a job (the directory that feat creates)
+
+    Args:
+        job: list of arguments for mk_level1_fsf_bbr, mk_level2_fsf or mk_level3_fsf (with a single cope), or path of a
+            level 3 fsf
+        level (int): level of analysis
+    Returns:
+        tuple of the study directory, the path of the .feat or .gfeat directory and the task name
+    """
+    if level == 3 and not isinstance(job, list):
+        # level 3 fsf's are saved next to their gfeats: .../task-<task>/[ses-<ses>_]task-<task>_cope-<NNN>.fsf
+        modeldir, filename = os.path.split(job)
+        copenum = filename[filename.find('_cope-') + len('_cope-'):-len('.fsf')]
+        studydir = job[:job.find(os.sep + os.path.join('model', 'level3') + os.sep)]
+        task = os.path.basename(modeldir)[len('task-'):]
+        return studydir, os.path.join(modeldir, 'cope-%s.gfeat' % copenum), task
+
+    studydir = os.path.join(_get_arg(job, '--basedir'), _get_arg(job, '--studyid'))
+    modelname = _get_arg(job, '--modelname', _get_arg(job, '-m'))
+    task = _get_arg(job, '--taskname')
+    ses = _get_arg(job, '--sesname', _get_arg(job, '--ses'))
+    modeldir = os.path.join(studydir, 'model', 'level%d' % level, 'model-%s' % modelname)
+    if level == 3:
+        if ses:
+            modeldir = os.path.join(modeldir, 'ses-%s' % ses)
+        copenum = int(job[job.index('--copes') + 1])
+        return studydir, os.path.join(modeldir, 'task-%s' % task, 'cope-%03d.gfeat' % copenum), task
+
+    subid = 'sub-%s' % _get_arg(job, '--sub')
+    subdir = os.path.join(modeldir, subid)
+    subid_ses = subid
+    if ses:
+        subdir = os.path.join(subdir, 'ses-%s' % ses)
+        subid_ses += '_ses-%s' % ses
+    if level == 1:
+        run = _get_arg(job, '--runname')
+        return studydir, os.path.join(subdir, 'task-%s_run-%s' % (task, run),
+                                      '%s_task-%s_run-%s.feat' % (subid_ses, task, run)), task
+    return studydir, os.path.join(subdir, 'task-%s' % task, '%s_task-%s.gfeat' % (subid_ses, task)), task
+
+
+def _check_report_log(featdir):
+    # feat writes every command it runs to report.log; errors show up as lines with "error"
+    errors = []
+    if os.path.exists(os.path.join(featdir, 'report.log')):
+        with open(os.path.join(featdir, 'report.log'), 'r', errors='replace') as f:
+            errors = [line.strip() for line in f if _REPORT_ERROR.search(line)]
+    return errors
+
+
+def check_output(featdir, level, ncopes=None):
+    """Checks whether the output of a feat job is complete
+
+    Args:
+        featdir (str): path of the .feat (level 1) or .gfeat (levels 2 and 3) directory
+        level (int): level of analysis
+        ncopes (int): number of copes the output should have (not checked if None)
+    Returns:
+        dictionary with 'ok' (True if the output is complete), 'exists', 'stats', 'zstats' (number of zstat files),
+        'copes' (number of cope*.feat directories of a gfeat), 'errors' (lines of report.log with errors) and
+        'problems' (descriptions of what is wrong)
+    """
+    checks = {'exists': os.path.isdir(featdir), 'stats': 0, 'zstats': 0, 'copes': 0, 'errors': [], 'problems': []}
+    if not checks['exists']:
+        checks['problems'].append('%s does not exist' % featdir)
+        checks['ok'] = False
+        return checks
+
+    checks['errors'] = _check_report_log(featdir)
+    if level == 1:
+        featdirs = [featdir]
+    else:
+        featdirs = sorted(os.path.join(featdir, name) for name in os.listdir(featdir)
+                          if name.startswith('cope') and name.endswith('.feat'))
+        checks['copes'] = len(featdirs)
+        if len(featdirs) == 0:
+            checks['problems'].append('no cope*.feat directories in %s' % featdir)
+        elif level == 2 and ncopes is not None and len(featdirs) != ncopes:
+            checks['problems'].append('%d of %d cope*.feat directories in %s' % (len(featdirs), ncopes, featdir))
+
+    for copedir in featdirs:
+        # check_featdir prints a PROBLEM line for every report.log, which feat always writes
+        with contextlib.redirect_stdout(io.StringIO()):
+            feat_info = check_featdir(copedir)
+        if feat_info.get('stats', 0) == 0:
+            checks['problems'].append('no stats directory in %s' % copedir)
+            continue
+        checks['stats'] += 1
+        zstats = feat_info.get('zstats', 0)
+        checks['zstats'] += zstats
+        if zstats == 0:
+            checks['problems'].append('no zstat files in %s/stats' % copedir)
+        if level > 1:
+            checks['errors'] += _check_report_log(copedir)
+    if level == 1 and ncopes is not None and 0 < checks['zstats'] < ncopes:
+        checks['problems'].append('%d of %d zstat files in %s/stats' % (checks['zstats'], ncopes, featdir))
+    if len(checks['errors']) > 0:
+        checks['problems'].append('errors in report.log of %s' % featdir)
+    checks['ok'] = len(checks['problems']) == 0
+    return checks
+
+
+def get_slurm_job_id():
+    """Returns the ID of the slurm job (or array task) this process runs in, or '' if it isn't run by slurm"""
+    if 'SLURM_ARRAY_JOB_ID' in os.environ and 'SLURM_ARRAY_TASK_ID' in os.environ:
+        return '%s_%s' % (os.environ['SLURM_ARRAY_JOB_ID'], os.environ['SLURM_ARRAY_TASK_ID'])
+    return os.environ.get('SLURM_JOB_ID', '')
+
+
+class StateStore(object):
+    """States of the feat jobs of a study
+
+    Args:
+        studydir (str): path of parent directory of fmriprep directory (basedir + studyid)
+    """
+
+    def __init__(self, studydir):
+        self.studydir = os.path.abspath(studydir)
+        self.path = os.path.join(self.studydir, STATE_DIRNAME)
+
+    def _get_path(self, featdir):
+        relpath = os.path.relpath(os.path.abspath(featdir), self.studydir)
+        return os.path.join(self.path, relpath.replace(os.sep, '__') + '.json')
+
+    def get(self, featdir):
+        """Returns the state of the job whose output is featdir (dictionary), or None if it was never recorded"""
+        try:
+            with open(self._get_path(featdir), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get_records(self, level=None):
+        """Returns the recorded states of all jobs (of a single level if level is given)"""
+        records = []
+        if not os.path.isdir(self.path):
+            return records
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, name), 'r') as f:
+                    record = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            if level is None or record.get('level') == level:
+                records.append(record)
+        return records
+
+    def set(self, featdir, level, state, **fields):
+        """Records the state of a job
+
+        Args:
+            featdir (str): output directory of the job
+            level (int): level of analysis
+            state (str): QUEUED, RUNNING, SUCCEEDED or FAILED
+            fields: other values to record (e.g. slurm_job_id, exit_code, checks, job)
+        """
+        record = {'featdir': os.path.abspath(featdir), 'level': level, 'state': state, 'updated': time.time(),
+                  'host': socket.gethostname(), 'pid': os.getpid(), 'slurm_job_id': get_slurm_job_id()}
+        record.update(fields)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        path = self._get_path(featdir)
+        tmp_path = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(record, f)
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as e:
+            print("WARNING: Could not record the state of %s: %s" % (featdir, e))
+
+
+def open_store(studydir):
+    """Returns the state store of a study (opened once per process)"""
+    studydir = os.path.abspath(studydir)
+    if studydir not in _stores:
+        _stores[studydir] = StateStore(studydir)
+    return _stores[studydir]
+
+
+def _get_ncopes(job, level, studydir, task):
+    if level == 3:
+        return 1
+    if not isinstance(job, list):
+        return None
+    spec = model_spec.get_model_spec(os.path.basename(studydir), os.path.dirname(studydir),
+                                     _get_arg(job, '--modelname', _get_arg(job, '-m')))
+    return spec.get_ncopes(task)
+
+
+def record_queued(jobs, level, slurm_job_ids=None):
+    """Records that jobs were submitted
+
+    Args:
+        jobs (list): jobs (see get_job_output)
+        level (int): level of analysis
+        slurm_job_ids (list): slurm job ID of each job ('' if the jobs are run locally)
+    """
+    for i, job in enumerate(jobs):
+        studydir, featdir, task = get_job_output(job, level)
+        open_store(studydir).set(featdir, level, QUEUED, job=job,
+                                 slurm_job_id=slurm_job_ids[i] if slurm_job_ids is not None else '')
+
+
+def record_running(job, level):
+    """Records that a job started running"""
+    studydir, featdir, task = get_job_output(job, level)
+    open_store(studydir).set(featdir, level, RUNNING, job=job)
+
+
+def record_finished(job, level, exitcode, max_rss_mb=None):
+    """Checks the output of a job that finished and records whether it succeeded
+
+    Args:
+        job: job that finished (see get_job_output)
+        level (int): level of analysis
+        exitcode (int): exit code of the job
+        max_rss_mb (float): peak memory of the job in MB, if it was measured
+    Returns:
+        exit code to report for the job: exitcode, or 1 if feat exited with 0 but its output is incomplete
+    """
+    studydir, featdir, task = get_job_output(job, level)
+    checks = check_output(featdir, level, _get_ncopes(job, level, studydir, task))
+    state = SUCCEEDED if exitcode == 0 and checks['ok'] else FAILED
+    store = open_store(studydir)
+    # the runtime and peak memory of the job are used to predict the resources of later jobs (see
+    # resource_estimator.py)
+    fields = {}
+    if max_rss_mb is not None:
+        fields['max_rss_mb'] = max_rss_mb
+    record = store.get(featdir)
+    if record is not None and record['state'] == RUNNING and record.get('pid') == os.getpid():
+        fields['started'] = record['updated']
+        fields['runtime'] = time.time() - record['updated']
+    store.set(featdir, level, state, job=job, exit_code=exitcode, checks=checks, **fields)
+    if state == FAILED:
+        for problem in checks['problems']:
+            print('WARNING: %s' % problem)
+        if exitcode == 0:
+            return 1
+    return exitcode
+
+
+def _is_alive(record):
+    # whether the process or slurm job that last recorded a queued/running state still exists
+    if record.get('slurm_job_id'):
+        if shutil.which('squeue') is None:
+            return True  # can't tell, so assume it is still running
+        try:
+            output = subprocess.check_output(['squeue', '-h', '-j', record['slurm_job_id'], '-o', '%T'],
+                                             stderr=subprocess.STDOUT, universal_newlines=True)
+        except subprocess.CalledProcessError:  # squeue fails for jobs it no longer knows about
+            return False
+        return output.strip() != ''
+    if record.get('host') != socket.gethostname():
+        return True
+    try:
+        os.kill(record['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, KeyError, TypeError):
+        return True
+    return True
+
+
+def check_finished_output(studydir, featdir, level, ncopes=None):
+    """Checks the output of a job that is known to have finished (e.g. a job that another job was released after)
+
+    Unlike get_job_status, a job that is still recorded as queued or running is not looked up with squeue: it stopped
+    without recording its end (e.g. slurm killed it when it ran out of time), so its output is incomplete.
+
+    Args:
+        studydir (str): path of parent directory of fmriprep directory (basedir + studyid)
+        featdir (str): path of the output of the job
+        level (int): level of analysis
+        ncopes (int): number of copes the output should have (see check_output)
+    Returns:
+        tuple of whether the output is complete and why it isn't ('' if it is)
+    """
+    record = open_store(studydir).get(featdir)
+    if record is not None and record['state'] == FAILED:
+        return False, 'its job failed'
+    if record is not None and record['state'] != SUCCEEDED:
+        return False, 'its job stopped before it finished'
+    checks = check_output(featdir, level, ncopes)
+    if not checks['ok']:
+        return False, '; '.join(checks['problems'])
+    return True, ''
+
+
+def get_job_status(job, level):
+    """Gets the status of a job for --resume
+
+    Returns:
+        tuple of the status ('done', 'active' for jobs that are still queued or running, 'failed' for jobs that failed
+        or whose output is incomplete, or 'missing' for jobs that were never run) and the path of the output
+    """
+    studydir, featdir, task = get_job_output(job, level)
+    record = open_store(studydir).get(featdir)
+    if record is not None and record['state'] in [QUEUED, RUNNING] and _is_alive(record):
+        return 'active', featdir
+    if not os.path.exists(featdir):
+        return 'missing', featdir
+    if record is not None and record['state'] == FAILED:
+        return 'failed', featdir
+    # outputs that exist are checked again (they may have been created before states were recorded, or changed)
+    checks = check_output(featdir, level, _get_ncopes(job, level, studydir, task))
+    if not checks['ok']:
+        return 'failed', featdir
+    return 'done', featdir
+
+
+def get_resume_jobs(jobs, level):
+    """Keeps the jobs that failed or were never run, for --resume
+
+    Jobs whose output is complete are dropped, and so are jobs that are still queued or running.
+
+    Args:
+        jobs (list): all the jobs of a level (see get_job_output)
+        level (int): level of analysis
+    Returns:
+        tuple of the jobs to run and the outputs of the failed jobs (partial outputs that feat would not overwrite)
+    """
+    resume_jobs = []
+    failed_outputs = []
+    counts = {'done': 0, 'active': 0, 'failed': 0, 'missing': 0}
+    for job in jobs:
+        status, featdir = get_job_status(job, level)
+        counts[status] += 1
+        if status == 'active':
+            print('WARNING: %s is still queued or running, it will not be submitted again' % featdir)
+        if status in ['failed', 'missing']:
+            resume_jobs.append(job)
+        if status == 'failed':
+            failed_outputs.append(featdir)
+    print('Resuming level %d: %d jobs are done, %d are queued or running, %d failed and %d were never run' % (
+        level, counts['done'], counts['active'], counts['failed'], counts['missing']))
+    return resume_jobs, failed_outputs
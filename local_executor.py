@@ -0,0 +1,321 @@
+"""
+Runs feat jobs on the local machine when sbatch is not available
+Jobs are started only if there is a free core and enough free memory for them, the longest jobs are started first,
+and each job runs feat directly (not through a new python process) with BLAS/OpenMP limited to a set number of threads.
+The output of each job is written to its own log file.
+"""
+
+import contextlib
+import io
+import multiprocessing
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import fsf_utils
+import job_metrics
+import job_state
+import run_feat_job
+
+# environment variables that limit the number of threads of BLAS/OpenMP libraries
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS']
+
+# seconds between checks of the running jobs
+POLL_INTERVAL = 0.2
+
+# memory (MB) kept free for the rest of the system
+RESERVED_MEM_MB = 512
+
+
+def get_available_mem_mb():
+    """Returns the memory (MB) that can be used without swapping (MemAvailable), or None if it is unknown"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_num_cores():
+    """Returns the number of cores this process may use"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def get_threads_per_job():
+    """Number of BLAS/OpenMP threads of each job (FMRI_PIPELINE_THREADS_PER_JOB, 1 by default)"""
+    try:
+        return max(1, int(os.environ.get('FMRI_PIPELINE_THREADS_PER_JOB', '1')))
+    except ValueError:
+        print("WARNING: FMRI_PIPELINE_THREADS_PER_JOB should be a number, using 1 thread per job")
+        return 1
+
+
+def estimate_cost(commands):
+    """Estimates how long the commands of a job take to run, relative to other jobs of the same level
+
+    A level 1 fsf costs the size of its functional data and a higher level fsf costs its number of inputs times its
+    number of copes.
+
+    Args:
+        commands (list): argument lists of the job; the fsf is the last argument of the feat command
+    Returns:
+        cost (float), 0 if it could not be estimated
+    """
+    fsfs = [command[-1] for command in commands if command[0] == 'feat']
+    cost = 0.0
+    for fsf in fsfs:
+        try:
+            settings = fsf_utils.read_settings(fsf)
+        except (IOError, OSError):
+            continue
+        if settings.get('fmri(level)') == '1':
+            datafile = settings.get('feat_files(1)', '').strip('"')
+            for path in [datafile, datafile + '.nii.gz']:
+                if os.path.isfile(path):
+                    cost += os.path.getsize(path)
+                    break
+        else:
+            try:
+                cost += float(settings.get('fmri(npts)', 1)) * max(1, float(settings.get('fmri(ncopeinputs)', 1)))
+            except ValueError:
+                pass
+    return cost
+
+
+class LocalJob(object):
+    """A job to run on the local machine
+
+    Args:
+        name (str): name of the job, used for its log file
+        commands (list): argument lists that are run one after the other; the job stops at the first that fails
+        mem (int): memory the job needs in MB
+        cost (float): estimated run time, only used to order the jobs
+        deps (list): names of the jobs that must finish before this job starts
+        dep_mode (str): 'ok' if the jobs in deps must succeed (otherwise this job is skipped) or 'any' if they only
+            need to finish
+        prepare (function): called when the job is about to start if commands is None; returns the commands (or None
+            if the job can't be run), e.g. to create an fsf that needs the outputs of the jobs in deps
+        priority (int): among the jobs that are ready, jobs with a higher priority are started first
+        on_start (function): called when the commands of the job are started
+        on_finish (function): called with the exit code of the job and what it used (see job_metrics.run; None if it
+            wasn't measured) when it finishes; returns the exit code to report (e.g. to fail a job whose output is
+            incomplete)
+    """
+
+    def __init__(self, name, commands, mem, cost=0.0, deps=(), dep_mode='ok', prepare=None, priority=0,
+                 on_start=None, on_finish=None):
+        self.name = name
+        self.commands = commands
+        self.mem = mem
+        self.cost = cost
+        self.deps = list(deps)
+        self.dep_mode = dep_mode
+        self.prepare = prepare
+        self.priority = priority
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.proc = None
+        self.log = None
+        self.start = None
+
+    def get_args(self):
+        if len(self.commands) == 1:
+            return self.commands[0]
+        # several commands (e.g. fslmaths before feat) run in a single shell instead of a python process
+        return ['sh', '-c', ' && '.join(' '.join(shlex.quote(arg) for arg in command) for command in self.commands)]
+
+
+def run_jobs(jobs, logdir, max_jobs=None, threads_per_job=None, mem_limit=None):
+    """Runs jobs on the local machine, starting each job only when there are enough free cores and memory for it
+
+    A job is ready once the jobs it depends on have finished; ready jobs are started by priority, then longest first
+    (by cost). A job is started when fewer than max_jobs jobs are running, the memory needed by the running jobs plus
+    this job fits in mem_limit and the system reports enough free memory. A job is always started if no other job is
+    running, even if it needs more memory than is free. A job whose dep_mode is 'ok' is skipped if one of the jobs it
+    depends on failed or was skipped.
+
+    Args:
+        jobs (list): LocalJob objects
+        logdir (str): directory in which the log of each job (<name>.log) is written
+        max_jobs (int): maximum number of jobs running at the same time (defaults to the number of cores divided by
+            threads_per_job)
+        threads_per_job (int): number of BLAS/OpenMP threads of each job (defaults to get_threads_per_job())
+        mem_limit (float): memory (MB) that the jobs may use together (defaults to the memory available now minus
+            RESERVED_MEM_MB)
+    Returns:
+        dictionary with the names of the jobs as keys and their exit codes as values (None for skipped jobs)
+    """
+    names = set(job.name for job in jobs)
+    for job in jobs:
+        unknown = [dep for dep in job.deps if dep not in names]
+        if len(unknown) > 0:
+            raise ValueError('Job %s depends on unknown jobs: %s' % (job.name, ' '.join(unknown)))
+
+    if threads_per_job is None:
+        threads_per_job = get_threads_per_job()
+    if max_jobs is None:
+        max_jobs = max(1, get_num_cores() // threads_per_job)
+    if mem_limit is None:
+        available = get_available_mem_mb()
+        mem_limit = None if available is None else max(0, available - RESERVED_MEM_MB)
+
+    env = os.environ.copy()
+    for var in THREAD_ENV_VARS:
+        env[var] = str(threads_per_job)
+
+    pending = list(jobs)
+    running = []
+    exitcodes = {}
+    print('NOTE: Running %d jobs, up to %d at a time%s. Logs are saved to %s\n' % (
+        len(jobs), max_jobs, '' if mem_limit is None else ' and %d MB of memory' % mem_limit, logdir))
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            _skip_jobs(pending, exitcodes)
+            ready = [job for job in pending if all(dep in exitcodes for dep in job.deps)]
+            ready.sort(key=lambda job: (-job.priority, -job.cost))
+            # start the jobs that fit
+            for job in ready:
+                if len(running) >= max_jobs:
+                    break
+                if len(running) > 0 and mem_limit is not None:
+                    committed = sum(running_job.mem for running_job in running)
+                    available = get_available_mem_mb()
+                    if committed + job.mem > mem_limit or (available is not None and available < job.mem):
+                        break
+                pending.remove(job)
+                if _start_job(job, logdir, env):
+                    running.append(job)
+                else:
+                    exitcodes[job.name] = 127
+                    print('FAILED: job %s could not be started (see %s.log)' % (job.name, job.name))
+            if len(running) == 0:
+                if len(ready) == 0 and len(pending) > 0:
+                    raise ValueError('The jobs %s depend on each other' % ' '.join(job.name for job in pending))
+                continue
+
+            time.sleep(POLL_INTERVAL)
+            for job in running[:]:
+                result = job_metrics.poll(job.proc, job.start)
+                if result is None:
+                    continue
+                exitcode = _finish_job(job, *result)
+                exitcodes[job.name] = exitcode
+                running.remove(job)
+                print('%s job %s (exit code %d, %.0f s), %d left' % (
+                    'Finished' if exitcode == 0 else 'FAILED:', job.name, exitcode, time.time() - job.start,
+                    len(pending) + len(running)))
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        print('\nStopping the %d running jobs...' % len(running))
+        for job in running:
+            job.proc.terminate()
+            _finish_job(job, job.proc.wait())
+        raise
+
+    failed = sorted(name for name, exitcode in exitcodes.items() if exitcode is not None and exitcode != 0)
+    if len(failed) > 0:
+        print('\nWARNING: %d jobs failed (see their logs in %s): %s' % (len(failed), logdir, ' '.join(failed)))
+    return exitcodes
+
+
+def _skip_jobs(pending, exitcodes):
+    # skips the jobs that need a job that failed or was skipped (which can in turn skip the jobs that need them)
+    skipped = True
+    while skipped:
+        skipped = False
+        for job in pending[:]:
+            if job.dep_mode != 'ok':
+                continue
+            failed_deps = [dep for dep in job.deps if dep in exitcodes and exitcodes[dep] != 0]
+            if len(failed_deps) > 0:
+                pending.remove(job)
+                exitcodes[job.name] = None
+                skipped = True
+                print('SKIPPED: job %s, because %s did not succeed' % (job.name, failed_deps[0]))
+
+
+def _start_job(job, logdir, env):
+    job.log = open(os.path.join(logdir, '%s.log' % job.name), 'w')
+    if job.commands is None and job.prepare is not None:
+        # e.g. the fsf of a level 2 job is only created once its level 1 jobs are done
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            job.commands = job.prepare()
+        job.log.write(output.getvalue())
+        if job.commands is None:
+            job.log.write('ERROR: The commands of the job could not be created\n')
+            job.start = time.time()
+            _finish_job(job, 1)
+            return False
+    for command in job.commands:
+        job.log.write('Calling %s\n' % ' '.join(command))
+    if job.on_start is not None:
+        job.on_start()
+    job.log.flush()
+    job.start = time.time()
+    try:
+        job.proc = subprocess.Popen(job.get_args(), stdout=job.log, stderr=subprocess.STDOUT, env=env)
+    except OSError as e:  # e.g. feat is not installed
+        job.log.write('ERROR: %s\n' % e)
+        _finish_job(job, 127)
+        return False
+    return True
+
+
+def _finish_job(job, exitcode, usage=None):
+    if job.on_finish is not None:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            exitcode = job.on_finish(exitcode, usage)
+        job.log.write(output.getvalue())
+    job.log.write('\nExit code: %d (%.0f s)\n' % (exitcode, time.time() - job.start))
+    job.log.close()
+    return exitcode
+
+
+def run_feat_jobs(jobs, level, logdir, mem, parallel=True, fsf_workers=1):
+    """Runs the jobs planned by run_level1.py, run_level2.py or run_level3.py on the local machine
+
+    Args:
+        jobs (list): list of argument lists for mk_level1_fsf_bbr or mk_level2_fsf (levels 1 and 2) or list of paths of
+            fsf's (level 3)
+        level (int): level of analysis
+        logdir (str): directory in which the log of each job is written
+        mem (int): memory each job needs in MB
+        parallel (bool): if False, the jobs are run one at a time
+        fsf_workers (int): number of processes that create the fsf's of level 1 and level 2 jobs
+    Returns:
+        dictionary with the names of the jobs as keys and their exit codes as values
+    """
+    local_jobs = []
+    job_state.record_queued(jobs, level)
+    for i, (job, commands) in enumerate(zip(jobs, run_feat_job.get_feat_commands(jobs, level, fsf_workers))):
+        if commands is None:  # the fsf could not be created (the error was printed)
+            job_state.record_finished(job, level, 1)
+            continue
+        fsf = commands[-1][-1]
+        name = '%d_%s' % (i, os.path.splitext(os.path.basename(fsf))[0])
+        local_jobs.append(LocalJob(name, commands, mem, estimate_cost(commands), **get_state_hooks(job, level)))
+    return run_jobs(local_jobs, logdir, max_jobs=None if parallel else 1)
+
+
+def get_state_hooks(job, level):
+    """Returns the on_start and on_finish arguments of a LocalJob that record the state of a feat job (see
+    job_state.py) and its runtime metrics (see job_metrics.py)"""
+    def on_finish(exitcode, usage):
+        job_metrics.record_job(job, level, exitcode, usage)
+        return job_state.record_finished(job, level, exitcode, usage['max_rss_mb'] if usage is not None else None)
+
+    return {'on_start': lambda: job_state.record_running(job, level), 'on_finish': on_finish}
+
@@ -8,8 +8,11 @@ import argparse
 import json
 
 from directory_struct_utils import *
+import fingerprint
 import mk_level3_fsf
+import model_spec
 import setup_utils
+import study_catalog
 
 
 def parse_command_line(argv):
@@ -29,6 +32,9 @@ def parse_command_line(argv):
                         default=False, help='Use Randomise for stats instead of FLAME 1')
     parser.add_argument('--nofeat', dest='nofeat', action='store_true',
                         default=False, help='Only create the fsf\'s, don\'t call feat')
+    parser.add_argument('--all-copes', dest='all_copes', action='store_true',
+                        default=False, help='Return all copes, including those whose gfeat exists and whose inputs '
+                                            'didn\'t change')
 
     args = parser.parse_args(argv)
     return args
@@ -43,6 +49,7 @@ def main(argv=None):
     modelname = args.modelname
     subids = args.subids
     randomise = args.randomise
+    return_all_copes = args.all_copes
 
     # gets dictionary of study information
     hasSessions = False
@@ -95,17 +102,40 @@ def main(argv=None):
             args.randomise = randomise
             jobs.append(args)
 
+    # existing gfeats whose inputs didn't change since their fsf was made are not run again (see fingerprint.py); the
+    # fingerprints are checked before the fsf's are made again
+    catalog = study_catalog.open_catalog(os.path.join(basedir, studyid))
+    spec = model_spec.get_model_spec(studyid, basedir, modelname)
+    up_to_date_copes = set()
+    for job_args in jobs:
+        ncopes = spec.get_ncopes(job_args.taskname)
+        if ncopes is None:  # mk_level3_fsf prints a warning
+            continue
+        sublist = mk_level3_fsf.get_sublist(job_args)
+        for copenum in range(1, ncopes + 1):
+            cope_fsf = mk_level3_fsf.get_fsfname(job_args, copenum)
+            cope_gfeat_path = os.path.join(os.path.dirname(cope_fsf), 'cope-%03d.gfeat' % copenum)
+            if not catalog.output_exists(3, cope_gfeat_path):
+                continue
+            settings = mk_level3_fsf.get_fingerprint_settings(job_args, sublist, copenum)
+            if fingerprint.is_output_up_to_date(cope_gfeat_path, cope_fsf, settings) is False:
+                print("WARNING: The inputs of %s changed since it was made, it will be run again" % cope_gfeat_path)
+            else:
+                up_to_date_copes.add(cope_fsf)
+
     # creates fsf's and retrieves a list of their names
     all_copes = []
     for job_args in jobs:
         copes = mk_level3_fsf.mk_level3_fsf(job_args)
         all_copes += copes
 
-    # find existing cope gfeats
+    # find existing cope gfeats (through the study catalog, which only lists directories that changed); the gfeats of
+    # copes that are run again are returned separately, since feat doesn't overwrite them (it writes to X+.gfeat)
     existing_copes = []
+    rerun_copes = []
     for cope_fsf in all_copes:
         upper_cope_dir = os.path.dirname(cope_fsf)
-        dircontents = os.listdir(upper_cope_dir)
+        dircontents = [name for name, is_dir in catalog.scandir(upper_cope_dir)]
 
         filename = os.path.split(cope_fsf)[-1]
         if 'cope-' in filename:
@@ -113,16 +143,24 @@ def main(argv=None):
             cope_gfeat_name = cope_fsf[i + 1:-1 * len('.fsf')]
             cope_gfeat = cope_gfeat_name + '.gfeat'
             cope_gfeat_path = os.path.join(upper_cope_dir, cope_gfeat)
-            if cope_gfeat in dircontents:
-                existing_copes.append(cope_gfeat_path)
+            if catalog.output_exists(3, cope_gfeat_path):
+                if cope_fsf in up_to_date_copes:
+                    existing_copes.append(cope_gfeat_path)
+                else:
+                    rerun_copes.append(cope_gfeat_path)
                 print("WARNING: Existing cope found here: %s" % cope_gfeat_path)
             for f in dircontents:
-                if f.startswith(cope_gfeat_name) and f.endswith('.gfeat') and f not in existing_copes:
-                    existing_copes.append(os.path.join(upper_cope_dir, f))
+                path = os.path.join(upper_cope_dir, f)
+                if f.startswith(cope_gfeat_name) and f.endswith('.gfeat') and path not in existing_copes + rerun_copes:
+                    existing_copes.append(path)
+
+    catalog.commit()
 
+    if not return_all_copes:
+        all_copes = [cope_fsf for cope_fsf in all_copes if cope_fsf not in up_to_date_copes]
     if len(existing_copes) == 0:
         print(len(all_copes), "jobs")
-    return existing_copes, all_copes
+    return existing_copes, all_copes, rerun_copes
 
 
 if __name__ == '__main__':
@@ -34,19 +34,22 @@ USAGE: mk_level1_fsf_bbr.py <studyid> <sub> <taskname> <runname> <smoothing - mm
 # create fsf file for arbitrary design
 
 import argparse
-from collections import OrderedDict
 import inspect
-import json
 import numpy as N
 import os
 import subprocess as sub
 import sys
 
-import nifti_utils
+import directory_struct_utils
+import fingerprint
+import fsf_utils
+import job_metrics
+import model_spec
+import study_catalog
 from openfmri_utils import *
 
-def parse_command_line(argv):
-    parser = argparse.ArgumentParser(argv, description='setup_subject')
+def get_parser():
+    parser = argparse.ArgumentParser(description='setup_subject')
 
     parser.add_argument('--studyid', dest='studyid',
         required=True,help='Study ID')
@@ -85,7 +88,11 @@ def parse_command_line(argv):
     parser.add_argument('--callfeat', dest='callfeat', action='store_true',
         default=False,help='Call fsl\'s feat on the .fsf file that is created')
     
-    args = parser.parse_args(argv)
+    return parser
+
+
+def parse_command_line(argv):
+    args = get_parser().parse_args(argv)
     return args
 
 
@@ -96,8 +103,16 @@ def main(argv=None):
     mk_level1_fsf_bbr(args)
 
 
+def get_fingerprint_settings(a):
+    """Returns the arguments that go into the fingerprint of the fsf (see fingerprint.py)"""
+    settings=dict(vars(a))
+    settings.pop('callfeat',None)
+    return settings
+
+
 # a: Namespace object, output of parser_command_line
-def mk_level1_fsf_bbr(a):
+# feat_commands: if a list is given, the commands that callfeat runs are added to it (even if callfeat is False)
+def mk_level1_fsf_bbr(a, feat_commands=None):
 
     # attributes in a:
     # studyid,subid,taskname,runname,smoothing,use_inplane,basedir,nonlinear,modelname,anatimg,confound,hpf,whiten,
@@ -126,19 +141,19 @@ def mk_level1_fsf_bbr(a):
         os.makedirs(model_subdir)
 
 
+    # index of the fmriprep directory, each directory is only listed once
+    bids_index=directory_struct_utils.get_bids_index(projdir)
+
     ## Get anat preprocessed data from fmriprep
     # anat dir directly under subject folder
-    anatdircontent = []
-    anatdir = os.path.join(os.path.join(a.basedir,'%s/fmriprep/%s'%(a.studyid,subid)),'anat')
-    if os.path.exists(anatdir):
-        anatdircontent = os.listdir(anatdir)
+    anatdir = bids_index.get_dir(a.subid,'','anat')
+    anatdircontent = bids_index.list_files(a.subid,'','anat')
 
     # anat dir under session folder
     sesanatdircontent=[]
     if a.sesname!="":
-        sesanatdir = os.path.join(os.path.join(a.basedir,'%s/fmriprep/%s/ses-%s'%(a.studyid,subid,a.sesname)),'anat')
-        if os.path.exists(sesanatdir):
-            sesanatdircontent = os.listdir(sesanatdir)
+        sesanatdir = bids_index.get_dir(a.subid,a.sesname,'anat')
+        sesanatdircontent = bids_index.list_files(a.subid,a.sesname,'anat')
 
     anat_preproc_files = []
 
@@ -187,7 +202,8 @@ def mk_level1_fsf_bbr(a):
 
     # Get func preprocessed data from fmriprep
     funcdir = os.path.join(fmriprep_subdir,'func')
-    funcdircontent = os.listdir(funcdir)
+    # only the files of this run (parsed by task and run entities) need to be checked
+    funcdircontent = bids_index.get_run_files(a.subid,a.sesname,a.taskname,a.runname)
     func_preproc_files = []
     funchead='%s_task-%s_run-%s'%(subid_ses,a.taskname,a.runname)
     functail='.nii.gz'
@@ -216,7 +232,7 @@ def mk_level1_fsf_bbr(a):
         print("\tNOTE: Looked for 'preproc' and 'bold' in the file name. (Excluded files with 'brain' in file name).")
         sys.exit(-1)
     else:
-        if a.spacetag!='' and os.path.exists(fmriprep_subdir+'/func/'+funchead+a.spacetag+functail):
+        if a.spacetag!='' and funchead+a.spacetag+functail in funcdircontent:
             func_preproc_file = funchead+a.spacetag+functail
         else:
             print("ERROR: Found multiple preprocessed func files here: %s. Please specify the label in the arguments."
@@ -238,31 +254,20 @@ def mk_level1_fsf_bbr(a):
     if anatimg=='':
         anatimg=os.path.join(fmriprep_subdir,'anatomy/highres001_brain')
     
+    # model files are read once per process (and again only if they change)
+    spec=model_spec.get_model_spec(a.studyid,a.basedir,a.modelname)
+
     # read the conditions_key file 
-    # if it's a json file
-    cond_key_json = os.path.join(a.basedir,a.studyid,'model/level1/model-%s/condition_key.json' % a.modelname)
-    # if it's a text file
-    cond_key_txt = os.path.join(a.basedir,a.studyid,'model/level1/model-%s/condition_key.txt' % a.modelname)
-    if os.path.exists(cond_key_json):
-        try:
-            conddict = json.load(open(cond_key_json), object_pairs_hook=OrderedDict)
-            # keep the order of the keys as they were in the json file
-        except ValueError:
-            print("\nERROR: Could not read the %s file. Make sure it is formatted correctly." % cond_key_json)
-            sys.exit(-1)
-        conddict_keys=[]
-        if a.taskname in conddict.keys():
-            # set conddict to the dictionary for this task where 
-                # the EV names are the keys
-                # and the names of the conditions are the values
-            conddict = conddict[a.taskname] 
-            for key,value in conddict.items():
-                conddict_keys.append(key)
-        else:
+    if spec.condition_key_file.endswith('.json'):
+        conddict=spec.get_conditions(a.taskname)
+        if conddict is None:
             print("ERROR: Task name %s was not found in condition_key.json. Make sure the JSON file is "
                   "formatted correctly" % a.taskname)
             sys.exit(-1)
-        ev_keys = conddict_keys
+        # conddict is the dictionary for this task where
+            # the EV names are the keys
+            # and the names of the conditions are the values
+        ev_keys=list(conddict.keys())
         ev_files=[]
         conditions=[]
         # get the names of the EV files and the names of the conditions
@@ -270,28 +275,17 @@ def mk_level1_fsf_bbr(a):
             ev_files.append('%s_task-%s_run-%s_ev-%03d'%(subid_ses,a.taskname,a.runname,int(ev)))
             conditions.append(conddict[ev])  
         print("found conditions:",conditions)
-    elif os.path.exists(cond_key_txt):
-        cond_key=load_condkey(cond_key_txt)
-
-        conditions=cond_key[a.taskname].values()
+    elif spec.condition_key_file!='':
+        conditions=list(spec.condition_key[a.taskname].values())
         print('found conditions:',conditions)
     else:
-        print("ERROR: Could not find condition key in %s" % (os.path.join(a.basedir,a.studyid,
-                                                                          'model/level1/model-%s' % a.modelname)))
+        print("ERROR: Could not find condition key in %s" % spec.modeldir)
         sys.exit(-1)
 
     # not tested yet
     # check for orthogonalization file
-    orth={}
-    orthfile=os.path.join(a.basedir,a.studyid,'model/level1/model-%s/orthogonalize.txt' % a.modelname)
-    if os.path.exists(orthfile):
-        f=open(orthfile)
-        for l in f.readlines():
-            orth_tasknum=int(l.split()[0].replace('task',''))
-            if orth_tasknum==tasknum:
-                orth[int(l.split()[1])]=int(l.split()[2])
-        f.close()
-    else:
+    orth=spec.get_orthogonalization(tasknum)
+    if spec.orthogonalize_file=='':
         print('no orthogonalization found')
         
     # not tested yet
@@ -302,32 +296,29 @@ def mk_level1_fsf_bbr(a):
 
     # Get task contrasts
     print('loading contrasts')
-    # if it's a json file
-    contrastsfile_json=os.path.join(a.basedir,a.studyid,'model/level1/model-%s/task_contrasts.json' % a.modelname)
-    # if it's a txt file
-    contrastsfile_txt=os.path.join(a.basedir,a.studyid,'model/level1/model-%s/task_contrasts.txt' % a.modelname)
-    if os.path.exists(contrastsfile_json):
-        contrasts_all = json.load(open(contrastsfile_json), object_pairs_hook=OrderedDict)
-        contrasts_keys=[]
-        for contrast,value in contrasts_all.items():
-            contrasts_keys.append(contrast)
-    elif os.path.exists(contrastsfile_txt):
-        contrasts_all=load_contrasts(contrastsfile)
-    else:
-        print("WARNING: Could not find task_contrasts file in %s"%(os.path.join(a.basedir,a.studyid,
-                                                                                'model/level1/model-%s' % a.modelname)))
-        contrasts_all={}
-    print('added contrasts:',contrasts_all)
+    contrasts_all=spec.task_contrasts
+    if spec.task_contrasts_file=='':
+        print("WARNING: Could not find task_contrasts file in %s"%(spec.modeldir))
+    print('added contrasts:',dict(contrasts_all))
 
-    contrasts=[]
+    contrasts={}
     if a.taskname in contrasts_all:
         contrasts=contrasts_all[a.taskname]
-    elif os.path.exists(contrastsfile_json) or os.path.exists(contrastsfile_txt):
-        print("ERROR: Could not find task name %s in contrasts. Make sure the file is formatted correctly.")
+    elif spec.task_contrasts_file!='':
+        print("ERROR: Could not find task name %s in contrasts. Make sure the file is formatted correctly." %
+              a.taskname)
         sys.exit(-1)
 
-    # Find Repetition Time - from header of preprocessed func file
-    tr=nifti_utils.get_tr('%s/func/%s'%(fmriprep_subdir,func_preproc_file))
+    # Find Repetition Time and number of timepoints - from header of preprocessed func file
+    try:
+        # the header cache is filled for all runs by get_level1_jobs before the jobs are submitted (the jobs open the
+        # study catalog read-only, see run_feat_job.py)
+        func_header=study_catalog.open_catalog(projdir).get_nifti_header('%s/func/%s'%(fmriprep_subdir,
+                                                                                        func_preproc_file))
+    except (OSError, ValueError) as e:
+        print("ERROR: Could not read the header of %s/func/%s: %s" % (fmriprep_subdir,func_preproc_file,e))
+        sys.exit(-1)
+    tr=func_header.tr
     
     # Get fsf template with default values
     stubfilename=os.path.join(_thisDir,'design_level1_fsl5.stub')
@@ -335,175 +326,139 @@ def mk_level1_fsf_bbr(a):
     # Name of fsf file to create
     outfilename='%s/%s_task-%s_run-%s.fsf'%(model_subdir,subid_ses,a.taskname,a.runname)
     print('outfilename: %s\n'%outfilename)
-    outfile=open(outfilename,'w')
-    outfile.write('# Automatically generated by mk_fsf.py\n')
-
-    # Get settings from custom stub file, store in customsettings dictionary 
-    # in customsettings, key is the setting ('fmri(mc)' for example) and the value of the setting is the value
-    customsettings={}
-    if os.path.exists(customstubfilename):
-        print('Found custom fsf stub')
-        customstubfile=open(customstubfilename,'r')
-        for l in customstubfile:
-            llist=l.split(' ')
-            if len(l)>3 and llist[0]=='set':
-                setting=llist[1]
-                value=llist[2]
-                customsettings[setting]=value
-        customstubfile.close()
-
-    # first get common lines from stub file
-    stubfile=open(stubfilename,'r')
-    for l in stubfile:
-        llist=l.split(' ')
-        if len(l)>3 and llist[0]=='set':
-            setting=llist[1]
-            value=llist[2]
-            # check if setting in default stub file shows up in custom stub file
-            if setting in customsettings.keys():
-                outfile.write('# From custom stub file\n')
-                llist[2]=customsettings[setting]
-                l=' '.join(llist)
-                del customsettings[setting]
-        outfile.write(l)
-    stubfile.close()
-
-    # if there are other settings that haven't been replaced and still need to be added
-    if len(customsettings) > 0:
-        outfile.write('\n### Additional settings from custom stub file ###\n')
-        for setting in customsettings:
-            l='set ' + setting + ' ' + customsettings[setting]
-            outfile.write(l)
 
-    # figure out how many timepoints there are 
-    p = sub.Popen(['fslinfo', '%s/func/%s'%(fmriprep_subdir,func_preproc_file)], stdout=sub.PIPE, stderr=sub.PIPE,
-                  encoding='utf8')
-    output, errors = p.communicate()
+    # the default and custom stubs are parsed once per process; settings from the custom stub replace the defaults
+    fsf=fsf_utils.get_template(stubfilename,customstubfilename).document()
 
-    ntp=int(output.split('\n')[4].split()[1])
+    # figure out how many timepoints there are 
+    ntp=func_header.npts
 
     #img=nibabel.load('%s/BOLD/task%03d_run%03d/bold_mcf_brain.nii.gz'%(fmriprep_subdir,tasknum,a.runname))
     #h=img.get_header()
     #ntp=h.get_data_shape()[3]
     
-    outfile.write('\n\n### AUTOMATICALLY GENERATED PART###\n\n')
+    fsf.start_generated_part()
     # now add custom lines
-    outfile.write( 'set fmri(regstandard_nonlinear_yn) %d\n' % a.nonlinear)
+    fsf.set('fmri(regstandard_nonlinear_yn)', int(a.nonlinear))
 
     # not tested - used to be read from scan_key.txt 
     # Delete volumes
     nskip=0
-    outfile.write('set fmri(ndelete) %d\n' % nskip)
+    fsf.set('fmri(ndelete)', nskip)
 
     # do or don't do registration
-    outfile.write('set fmri(reg_yn) %d\n' % a.doreg)
-    outfile.write('set fmri(reginitial_highres_yn) %d\n' % a.doreg)
-    outfile.write('set fmri(reghighres_yn) %d\n' % a.doreg)
-    outfile.write('set fmri(regstandard_yn) %d\n' % a.doreg)
+    fsf.set('fmri(reg_yn)', int(a.doreg))
+    fsf.set('fmri(reginitial_highres_yn)', int(a.doreg))
+    fsf.set('fmri(reghighres_yn)', int(a.doreg))
+    fsf.set('fmri(regstandard_yn)', int(a.doreg))
 
     # look for standard brain fsl provides
-    env = os.environ.copy()
+    env = os.environ
     FSLDIR='/usr/local/fsl'
     if 'FSLDIR' in env.keys():
         FSLDIR=env["FSLDIR"]
     elif 'FSL_DIR' in env.keys():
         FSLDIR=env["FSL_DIR"]
     regstandard=os.path.join(FSLDIR,'data/standard/MNI152_T1_2mm_brain')
-    outfile.write('set fmri(regstandard) "%s"\n' % regstandard)
+    fsf.set('fmri(regstandard)', '"%s"' % regstandard)
 
-    outfile.write('set fmri(outputdir) "%s/%s_task-%s_run-%s.feat"\n' % (model_subdir,subid_ses,a.taskname,a.runname))
+    fsf.set('fmri(outputdir)', '"%s/%s_task-%s_run-%s.feat"' % (model_subdir,subid_ses,a.taskname,a.runname))
     if not a.usebrainmask:
-        outfile.write('set feat_files(1) "%s"\n' % (os.path.join(funcdir,func_preproc_file)))
+        fsf.set('feat_files(1)', '"%s"' % (os.path.join(funcdir,func_preproc_file)))
     else:
-        outfile.write('set feat_files(1) "%s"\n' % (os.path.join(funcdir,fslmaths_preproc_brainmask)))
+        fsf.set('feat_files(1)', '"%s"' % (os.path.join(funcdir,fslmaths_preproc_brainmask)))
 
     if a.use_inplane==1:
-        outfile.write('set fmri(reginitial_highres_yn) 1\n')
-        outfile.write('set initial_highres_files(1) "%s"\n' % (initial_highres_file))
+        fsf.set('fmri(reginitial_highres_yn)', 1)
+        fsf.set('initial_highres_files(1)', '"%s"' % (initial_highres_file))
     else:
-        outfile.write('set fmri(reginitial_highres_yn) 0\n')
+        fsf.set('fmri(reginitial_highres_yn)', 0)
 
     if a.whiten:
-        outfile.write('set fmri(prewhiten_yn) 1\n')
+        fsf.set('fmri(prewhiten_yn)', 1)
     else:
-        outfile.write('set fmri(prewhiten_yn) 0\n')
+        fsf.set('fmri(prewhiten_yn)', 0)
        
     if a.hpf:
-        outfile.write('set fmri(temphp_yn) 1\n')
+        fsf.set('fmri(temphp_yn)', 1)
     else:
-        outfile.write('set fmri(temphp_yn) 0\n')
+        fsf.set('fmri(temphp_yn)', 0)
 
-    outfile.write('set highres_files(1) "%s"\n' % anatimg)
-    outfile.write('set fmri(npts) %d\n' % ntp)
-    outfile.write('set fmri(tr) %0.2f\n' % tr)
+    fsf.set('highres_files(1)', '"%s"' % anatimg)
+    fsf.set('fmri(npts)', '%d' % ntp)
+    fsf.set('fmri(tr)', '%0.2f' % tr)
     nevs=len(conditions)
-    outfile.write('set fmri(evs_orig) %d\n' % nevs)
-    outfile.write('set fmri(evs_real) %d\n' % (2*nevs))
-    outfile.write('set fmri(smooth) %d\n' % a.smoothing)
-    outfile.write('set fmri(ncon_orig) %d\n' % (len(conditions)+1+len(contrasts)))
-    outfile.write('set fmri(ncon_real) %d\n' % (len(conditions)+1+len(contrasts)))
+    fsf.set('fmri(evs_orig)', nevs)
+    fsf.set('fmri(evs_real)', 2*nevs)
+    fsf.set('fmri(smooth)', '%d' % a.smoothing)
+    fsf.set('fmri(ncon_orig)', len(conditions)+1+len(contrasts))
+    fsf.set('fmri(ncon_real)', len(conditions)+1+len(contrasts))
 
     # loop through EVs
     convals_real=N.zeros(nevs*2)
     convals_orig=N.zeros(nevs)
     empty_evs=[]
+    ev_inputs=[]
 
     # iterate through the EVs
     for ev in range(len(conditions)):
-        outfile.write('\n\nset fmri(evtitle%d) "%s"\n' % (ev+1,conditions[ev]))
+        fsf.write('\n\n')
+        fsf.set('fmri(evtitle%d)' % (ev+1), '"%s"' % conditions[ev])
 
         ## get the full path of the EV file
         # if it's a json file
-        if os.path.exists(cond_key_json):
+        if spec.condition_key_file.endswith('.json'):
             condfile='%s/onsets/%s'%(model_subdir,ev_files[ev])
+            ev_inputs+=[condfile+'.txt',condfile+'.tsv']
             if os.path.exists(condfile+'.txt'):
                 condfile+='.txt'
             elif os.path.exists(condfile+'.tsv'):
                 condfile+='.tsv'
         else:
             condfile='%s/onsets/%s_task-%s_run-%s_ev-%03d.txt' % (model_subdir,subid_ses,a.taskname,a.runname,ev+1)
+            ev_inputs.append(condfile)
         # if the EV file exists
         if os.path.exists(condfile):
-            outfile.write('set fmri(shape%d) 3\n' % (ev+1))
-            outfile.write('set fmri(custom%d) "%s"\n' % (ev+1,condfile))
+            fsf.set('fmri(shape%d)' % (ev+1), 3)
+            fsf.set('fmri(custom%d)' % (ev+1), '"%s"' % condfile)
         # if the EV file is missing
         else:
-             outfile.write('set fmri(shape%d) 10\n' % (ev+1))
+             fsf.set('fmri(shape%d)' % (ev+1), 10)
              print('%s is missing, using empty EV' % condfile)
              empty_evs.append(ev+1)
              
-        outfile.write('set fmri(convolve%d) 3\n' % (ev+1))
-        outfile.write('set fmri(convolve_phase%d) 0\n' % (ev+1))
-        outfile.write('set fmri(tempfilt_yn%d) 1\n' % (ev+1))
-        outfile.write('set fmri(deriv_yn%d) 1\n' % (ev+1))
+        fsf.set('fmri(convolve%d)' % (ev+1), 3)
+        fsf.set('fmri(convolve_phase%d)' % (ev+1), 0)
+        fsf.set('fmri(tempfilt_yn%d)' % (ev+1), 1)
+        fsf.set('fmri(deriv_yn%d)' % (ev+1), 1)
 
         # first write the orth flag for zero, which seems to be turned on whenever
         # anything is orthogonalized
         
         if ev+1 in orth:
-                outfile.write('set fmri(ortho%d.0) 1\n' % int(ev+1))
+                fsf.set('fmri(ortho%d.0)' % int(ev+1), 1)
         else:
-                outfile.write('set fmri(ortho%d.0) 0\n' % int(ev+1))
+                fsf.set('fmri(ortho%d.0)' % int(ev+1), 0)
         
         for evn in range(1,nevs+1):
             if ev+1 in orth:
                 if orth[ev+1]==evn:
-                    outfile.write('set fmri(ortho%d.%d) 1\n' % (ev+1,evn))
+                    fsf.set('fmri(ortho%d.%d)' % (ev+1,evn), 1)
                 else:
-                    outfile.write('set fmri(ortho%d.%d) 0\n' % (ev+1,evn))
+                    fsf.set('fmri(ortho%d.%d)' % (ev+1,evn), 0)
             else:
-                outfile.write('set fmri(ortho%d.%d) 0\n' % (ev+1,evn))
+                fsf.set('fmri(ortho%d.%d)' % (ev+1,evn), 0)
         # make a T contrast for each EV
-        outfile.write('set fmri(conpic_real.%d) 1\n' % (ev+1))
-        outfile.write('set fmri(conpic_orig.%d) 1\n' % (ev+1))
-        outfile.write('set fmri(conname_real.%d) "%s"\n' % (ev+1,conditions[ev]))
-        outfile.write('set fmri(conname_orig.%d) "%s"\n' % (ev+1,conditions[ev]))
+        fsf.set('fmri(conpic_real.%d)' % (ev+1), 1)
+        fsf.set('fmri(conpic_orig.%d)' % (ev+1), 1)
+        fsf.set('fmri(conname_real.%d)' % (ev+1), '"%s"' % conditions[ev])
+        fsf.set('fmri(conname_orig.%d)' % (ev+1), '"%s"' % conditions[ev])
         for evt in range(nevs*2):
-            outfile.write('set fmri(con_real%d.%d) %d\n' % (ev+1,evt+1,int(evt==(ev*2))))
+            fsf.set('fmri(con_real%d.%d)' % (ev+1,evt+1), int(evt==(ev*2)))
             if (evt==(ev*2)):
                 convals_real[evt]=1
         for evt in range(nevs):
-            outfile.write('set fmri(con_orig%d.%d) %d\n' % (ev+1,evt+1,int(evt==ev)))
+            fsf.set('fmri(con_orig%d.%d)' % (ev+1,evt+1), int(evt==ev))
             if (evt==ev):
                 convals_orig[evt]=1
                 
@@ -516,14 +471,14 @@ def mk_level1_fsf_bbr(a):
         empty_ev_file.close()
 
     # make one additional contrast across all conditions
-    outfile.write('set fmri(conpic_real.%d) 1\n' % (ev+2))
-    outfile.write('set fmri(conname_real.%d) "all"\n' % (ev+2))
-    outfile.write('set fmri(conname_orig.%d) "all"\n' % (ev+2))
+    fsf.set('fmri(conpic_real.%d)' % (ev+2), 1)
+    fsf.set('fmri(conname_real.%d)' % (ev+2), '"all"')
+    fsf.set('fmri(conname_orig.%d)' % (ev+2), '"all"')
 
     for evt in range(nevs*2):
-        outfile.write('set fmri(con_real%d.%d) %d\n' % (ev+2,evt+1,convals_real[evt]))
+        fsf.set('fmri(con_real%d.%d)' % (ev+2,evt+1), '%d' % convals_real[evt])
     for evt in range(nevs):
-        outfile.write('set fmri(con_orig%d.%d) %d\n' % (ev+2,evt+1,convals_orig[evt]))
+        fsf.set('fmri(con_orig%d.%d)' % (ev+2,evt+1), '%d' % convals_orig[evt])
 
     # add custom contrasts
     if len(contrasts)>0:
@@ -531,21 +486,21 @@ def mk_level1_fsf_bbr(a):
         contrastctr=ev+3;
         for c in contrasts.keys():
             
-            outfile.write('set fmri(conpic_real.%d) 1\n' % contrastctr)
-            outfile.write('set fmri(conname_real.%d) "%s"\n' % (contrastctr,c))
-            outfile.write('set fmri(conname_orig.%d) "%s"\n' % (contrastctr,c))
+            fsf.set('fmri(conpic_real.%d)' % contrastctr, 1)
+            fsf.set('fmri(conname_real.%d)' % contrastctr, '"%s"' % c)
+            fsf.set('fmri(conname_orig.%d)' % contrastctr, '"%s"' % c)
             cveclen=len(contrasts[c])
             con_real_ctr=1
             for evt in range(nevs):
-                outfile.write('set fmri(con_real%d.%d) %s\n' % (contrastctr,con_real_ctr,contrasts[c][evt]))
-                outfile.write('set fmri(con_real%d.%d) 0\n' % (contrastctr,con_real_ctr+1))
+                fsf.set('fmri(con_real%d.%d)' % (contrastctr,con_real_ctr), contrasts[c][evt])
+                fsf.set('fmri(con_real%d.%d)' % (contrastctr,con_real_ctr+1), 0)
                 con_real_ctr+=2
                     
             for evt in range(nevs):
                 if evt<cveclen:
-                    outfile.write('set fmri(con_orig%d.%d) %s\n' % (contrastctr,evt+1,contrasts[c][evt]))
+                    fsf.set('fmri(con_orig%d.%d)' % (contrastctr,evt+1), contrasts[c][evt])
                 else:
-                    outfile.write('set fmri(con_orig%d.%d) 0\n' % (contrastctr,evt+1))
+                    fsf.set('fmri(con_orig%d.%d)' % (contrastctr,evt+1), 0)
 
             contrastctr+=1
     
@@ -554,23 +509,44 @@ def mk_level1_fsf_bbr(a):
     if not os.path.exists(confoundfile):
         confoundfile='%s/onsets/%s_task-%s_run-%s_ev-confounds.txt' % (model_subdir,subid_ses,a.taskname,a.runname)
     if os.path.exists(confoundfile) and a.confound:
-        outfile.write('set fmri(confoundevs) 1\n')
-        outfile.write('set confoundev_files(1) "%s"\n' % confoundfile)
+        fsf.set('fmri(confoundevs)', 1)
+        fsf.set('confoundev_files(1)', '"%s"' % confoundfile)
     else:
         print("No confounds file found")
-        outfile.write('set fmri(confoundevs) 0\n')
-        
-    outfile.close()
+        fsf.set('fmri(confoundevs)', 0)
+
+    # fingerprint of everything the fsf was made from, so that the planners can tell when the feat is out of date
+    fp=fingerprint.Fingerprint(get_fingerprint_settings(a))
+    fp.add(os.path.join(funcdir,func_preproc_file))
+    if a.usebrainmask:
+        fp.add(os.path.join(funcdir,fmriprep_brainmask))
+    if a.use_inplane==1:
+        fp.add(initial_highres_file)
+    confoundbase=os.path.splitext(confoundfile)[0]
+    for path in ev_inputs+[confoundbase+'.tsv',confoundbase+'.txt',stubfilename,customstubfilename]+\
+            spec.get_input_files():
+        fp.add(path)
+    fsf.write('\n' + fp.comment())
+
+    fsf.save(outfilename)
+
+    featargs = ["feat",outfilename]
+    if a.usebrainmask:
+        fslmathsargs = ["fslmaths",os.path.join(funcdir,func_preproc_file),"-mas",
+                        os.path.join(funcdir,fmriprep_brainmask),os.path.join(funcdir,fslmaths_preproc_brainmask)]
+    if feat_commands is not None:
+        if a.usebrainmask:
+            feat_commands.append(fslmathsargs)
+        feat_commands.append(featargs)
 
     if a.callfeat:
         if a.usebrainmask:
-            fslmathsargs = ["fslmaths",os.path.join(funcdir,func_preproc_file),"-mas",
-                            os.path.join(funcdir,fmriprep_brainmask),os.path.join(funcdir,fslmaths_preproc_brainmask)]
             print("Applying fslmath's mas, creating the following file: %s"%(fslmaths_preproc_brainmask))
             sub.call(fslmathsargs)
-        featargs = ["feat",outfilename]
         print("Calling", ' '.join(featargs))
-        sub.call(featargs)
+        # the runtime metrics of feat are appended to the metrics store of the study (see job_metrics.py)
+        job_metrics.call(featargs,projdir,1,{'model':a.modelname,'sub':a.subid,'ses':a.sesname,'task':a.taskname,
+                                             'run':a.runname,'cope':''})
 
     return outfilename
 
@@ -29,16 +29,18 @@
 # create fsf file for arbitrary design
 
 import argparse
-from collections import OrderedDict
 import inspect
-import json
 import subprocess as sub
 import sys
 
+import fingerprint
+import fsf_utils
+import job_metrics
+import model_spec
 from openfmri_utils import *
 
 
-def parse_command_line(argv):
+def get_parser():
     parser = argparse.ArgumentParser(description='setup_subject')
 
     parser.add_argument('--studyid', dest='studyid',
@@ -58,7 +60,11 @@ def parse_command_line(argv):
     parser.add_argument('--callfeat', dest='callfeat', action='store_true',
                         default=False, help='Call fsl\'s feat on the .fsf file that is created')
 
-    args = parser.parse_args(argv)
+    return parser
+
+
+def parse_command_line(argv):
+    args = get_parser().parse_args(argv)
     return args
 
 
@@ -69,10 +75,18 @@ def main(argv=None):
     mk_level2_fsf(args)
 
 
+def get_fingerprint_settings(a):
+    """Returns the arguments that go into the fingerprint of the fsf (see fingerprint.py)"""
+    settings = dict(vars(a))
+    settings.pop('callfeat', None)
+    return settings
+
+
 # a: Namespace object, output of parser_command_line
-def mk_level2_fsf(a):
+def mk_level2_fsf(a, feat_commands=None):
     # attributes in a:
     # studyid,subid,taskname,runs,basedir,modelname,sesname,callfeat
+    # feat_commands: if a list is given, the commands that callfeat runs are added to it (even if callfeat is False)
 
     _thisDir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 
@@ -93,68 +107,25 @@ def mk_level2_fsf(a):
     if not os.path.exists(model_subdir):
         os.makedirs(model_subdir)
 
-    ## read the conditions_key file
-    # if it's a json file
-    cond_key_json = os.path.join(a.basedir, a.studyid, 'model/level1/model-%s/condition_key.json' % a.modelname)
-    # if it's a text file
-    cond_key_txt = os.path.join(a.basedir, a.studyid, 'model/level1/model-%s/condition_key.txt' % a.modelname)
-    if os.path.exists(cond_key_json):
-        try:
-            cond_key = json.load(open(cond_key_json),
-                             object_pairs_hook=OrderedDict)  # keep the order of the keys as they were in the json file
-        except ValueError:
-            print("\nERROR: Could not read the %s file. Make sure it is formatted correctly." % cond_key_json)
-            sys.exit(-1)
-        conddict_keys = []
-        if a.taskname in cond_key.keys():
-            # set conddict to the dictionary for this task where 
-            # the EV names are the keys
-            # and the names of the conditions are the values
-            cond_key = cond_key[a.taskname]
-            for key, value in cond_key.items():
-                conddict_keys.append(key)
-        else:
-            print("ERROR: Task name was not found in JSON file %s. Make sure the JSON file is formatted correctly" % (
-                cond_key_json))
-            sys.exit(-1)
+    # model files are read once per process (and again only if they change)
+    spec = model_spec.get_model_spec(a.studyid, a.basedir, a.modelname)
 
-        ev_keys = conddict_keys
-        ev_files = []
-        conditions = []
-        # get the EV file names and the condition names
-        for ev in ev_keys:
-            ev_files.append('%s_task-%s_run-%s_ev-%03d' % (subid_ses, a.taskname, a.runs[0], int(ev)))
-            conditions.append(cond_key[ev])
-    elif os.path.exists(cond_key_txt):
-        cond_key = load_condkey(cond_key_txt)
-        cond_key = cond_key[a.taskname]
-    else:
-        print("ERROR: Could not find condition key in %s" % (
-            os.path.join(a.basedir, a.studyid, 'model/level1/model-%s' % a.modelname)))
+    ## read the conditions_key file
+    if spec.condition_key_file == '':
+        print("ERROR: Could not find condition key in %s" % spec.modeldir)
+        sys.exit(-1)
+    # the EV names are the keys and the names of the conditions are the values
+    cond_key = spec.get_conditions(a.taskname)
+    if cond_key is None:
+        print("ERROR: Task name was not found in %s. Make sure the file is formatted correctly" % (
+            spec.condition_key_file))
         sys.exit(-1)
 
     ## get contrasts
-    # if it's a json file
-    contrastsfile_json = os.path.join(a.basedir, a.studyid, 'model/level1/model-%s/task_contrasts.json' % a.modelname)
-    # if it's a txt file
-    contrastsfile_txt = os.path.join(a.basedir, a.studyid, 'model/level1/model-%s/task_contrasts.txt' % a.modelname)
-    if os.path.exists(contrastsfile_json):
-        try:
-            all_addl_contrasts = json.load(open(contrastsfile_json), object_pairs_hook=OrderedDict)
-        except ValueError:
-            print("\nERROR: Could not read the %s file. Make sure it is formatted correctly." % contrastsfile_json)
-            sys.exit(-1)
-        # all_addl_contrasts = dict(all_addl_contrasts)
-        # for contrast in all_addl_contrasts:
-        #    all_addl_contrasts[contrast] = dict(all_addl_contrasts[contrast])
-    elif os.path.exists(contrastsfile_txt):
-        all_addl_contrasts = load_contrasts(contrastsfile_txt)
-    else:
-        print("WARNING: Could not find task_contrasts file in %s" % (
-            os.path.join(a.basedir, a.studyid, 'model/level1/model-%s' % a.modelname)))
-        all_addl_contrasts = {}
-    if a.taskname in all_addl_contrasts:
-        addl_contrasts = all_addl_contrasts[a.taskname]
+    if spec.task_contrasts_file == '':
+        print("WARNING: Could not find task_contrasts file in %s" % spec.modeldir)
+    addl_contrasts = spec.get_contrasts(a.taskname)
+    if addl_contrasts is not None:
         n_addl_contrasts = len(addl_contrasts)
     else:
         n_addl_contrasts = 0
@@ -166,44 +137,9 @@ def mk_level2_fsf(a):
     customstubfilename = os.path.join(a.basedir, a.studyid,
                                       'model/level2/model-%s/design_level2_custom.stub' % a.modelname)
     outfilename = os.path.join(model_subdir, '%s_task-%s.fsf' % (subid_ses, a.taskname))
-    outfile = open(outfilename, 'w')
-    outfile.write('# Automatically generated by mk_fsf.py\n')
-
-    # Get settings from custom stub file, store in customsettings dictionary 
-    # in customsettings, key is the setting ('fmri(mc)' for example) and the value of the setting is the value
-    customsettings = {}
-    if os.path.exists(customstubfilename):
-        print('Found custom fsf stub')
-        customstubfile = open(customstubfilename, 'r')
-        for line in customstubfile:
-            llist = line.split(' ')
-            if len(line) > 3 and llist[0] == 'set':
-                setting = llist[1]
-                value = llist[2]
-                customsettings[setting] = value
-        customstubfile.close()
-
-    # first get common lines from stub file
-    stubfile = open(stubfilename, 'r')
-    for line in stubfile:
-        llist = line.split(' ')
-        if len(line) > 3 and llist[0] == 'set':
-            setting = llist[1]
-            # check if setting in default stub file shows up in custom stub file
-            if setting in customsettings.keys():
-                outfile.write('# From custom stub file\n')
-                llist[2] = customsettings[setting]  # set the value of the setting
-                line = ' '.join(llist)
-                del customsettings[setting]
-        outfile.write(line)
-    stubfile.close()
-
-    # if there are other settings that haven't been replaced and still need to be added
-    if len(customsettings) > 0:
-        outfile.write('\n### Additional settings from custom stub file ###\n')
-        for setting in customsettings:
-            line = 'set ' + setting + ' ' + customsettings[setting]
-            outfile.write(line)
+
+    # the default and custom stubs are parsed once per process; settings from the custom stub replace the defaults
+    fsf = fsf_utils.get_template(stubfilename, customstubfilename).document()
 
     # now add custom lines
 
@@ -218,22 +154,22 @@ def mk_level2_fsf(a):
             empty_evs.extend([int(x.strip()) for x in evfile.readlines()])
             evfile.close()
 
-    outfile.write('\n\n### AUTOMATICALLY GENERATED PART###\n\n')
+    fsf.start_generated_part()
 
     # look for standard brain fsl provides
-    env = os.environ.copy()
+    env = os.environ
     FSLDIR = '/usr/local/fsl'
     if 'FSLDIR' in env.keys():
         FSLDIR = env["FSLDIR"]
     elif 'FSL_DIR' in env.keys():
         FSLDIR = env["FSL_DIR"]
     regstandard = os.path.join(FSLDIR, 'data/standard/MNI152_T1_2mm_brain')
-    outfile.write('set fmri(regstandard) "%s"\n' % regstandard)
+    fsf.set('fmri(regstandard)', '"%s"' % regstandard)
 
-    outfile.write('set fmri(outputdir) "%s/%s_task-%s.gfeat"\n' % (model_subdir, subid_ses, a.taskname))
-    outfile.write('set fmri(npts) %d\n' % nruns)  # number of runs
-    outfile.write('set fmri(multiple) %d\n' % nruns)  # number of runs
-    outfile.write('set fmri(ncopeinputs) %d\n' % int(len(cond_key) + 1 + n_addl_contrasts))  # number of copes
+    fsf.set('fmri(outputdir)', '"%s/%s_task-%s.gfeat"' % (model_subdir, subid_ses, a.taskname))
+    fsf.set('fmri(npts)', nruns)  # number of runs
+    fsf.set('fmri(multiple)', nruns)  # number of runs
+    fsf.set('fmri(ncopeinputs)', int(len(cond_key) + 1 + n_addl_contrasts))  # number of copes
 
     # iterate through runs
     for r in range(nruns):
@@ -265,7 +201,7 @@ def mk_level2_fsf(a):
                 sub.call(['rm', '-rf', feat_folder + '/reg_standard'])
             sub.call(['rm', '-f', feat_folder + '/reg/' + '*.mat'])
 
-            env = os.environ.copy()
+            env = os.environ
 
             if 'FSLDIR' in env.keys():
                 ident_file = os.path.join(env["FSLDIR"], "etc/flirtsch/ident.mat")
@@ -286,25 +222,43 @@ def mk_level2_fsf(a):
                 print("No %s found in %s." % (mean_func, feat_folder))
             print("Completed registration workaround.")
 
-        outfile.write('set feat_files(%d) "%s"\n' % (int(r + 1), feat_folder))
-        outfile.write('set fmri(evg%d.1) 1\n' % int(r + 1))
-        outfile.write('set fmri(groupmem.%d) 1\n' % int(r + 1))
+        fsf.set('feat_files(%d)' % int(r + 1), '"%s"' % feat_folder)
+        fsf.set('fmri(evg%d.1)' % int(r + 1), 1)
+        fsf.set('fmri(groupmem.%d)' % int(r + 1), 1)
 
     # need to figure out if any runs have empty EVs and leave them out
     for c in range(len(cond_key) + 1 + n_addl_contrasts):
         if not c + 1 in empty_evs:
-            outfile.write('set fmri(copeinput.%d) 1\n' % int(c + 1))
+            fsf.set('fmri(copeinput.%d)' % int(c + 1), 1)
         else:
-            outfile.write('set fmri(copeinput.%d) 0\n' % int(c + 1))
+            fsf.set('fmri(copeinput.%d)' % int(c + 1), 0)
+
+    # fingerprint of everything the fsf was made from; the fsf's that feat saved in the level 1 feats stand for them
+    fp = fingerprint.Fingerprint(get_fingerprint_settings(a))
+    for r in range(nruns):
+        run_prefix = "%s/task-%s_run-%s/%s_task-%s_run-%s" % (lev1_model_subdir, a.taskname, a.runs[r], subid_ses,
+                                                             a.taskname, a.runs[r])
+        fp.add(fingerprint.get_output_fsfname(run_prefix + '.feat'))
+        fp.add("%s/task-%s_run-%s/onsets/%s_task-%s_run-%s_empty_evs.txt" % (
+            lev1_model_subdir, a.taskname, a.runs[r], subid_ses, a.taskname, a.runs[r]))
+    for path in [stubfilename, customstubfilename] + spec.get_input_files():
+        fp.add(path)
+    fsf.write('\n' + fp.comment())
 
-    outfile.close()
+    fsf.save(outfilename)
 
     print('outfilename: ' + outfilename)
 
+    featargs = ["feat", outfilename]
+    if feat_commands is not None:
+        feat_commands.append(featargs)
+
     if a.callfeat:
-        featargs = ["feat", outfilename]
         print("Calling", ' '.join(featargs))
-        sub.call(featargs)
+        # the runtime metrics of feat are appended to the metrics store of the study (see job_metrics.py)
+        job_metrics.call(featargs, os.path.join(a.basedir, a.studyid), 2,
+                         {'model': a.modelname, 'sub': a.subid, 'ses': a.sesname, 'task': a.taskname, 'run': '',
+                          'cope': ''})
 
     return outfilename
 
@@ -31,14 +31,17 @@
 import argparse
 from collections import OrderedDict
 import inspect
-import json
 
 from directory_struct_utils import *
+import fingerprint
+import fsf_utils
+import job_state
+import model_spec
 from openfmri_utils import *
 
 
-def parse_command_line(argv):
-    parser = argparse.ArgumentParser(argv, description='setup_task')
+def get_parser():
+    parser = argparse.ArgumentParser(description='setup_task')
 
     parser.add_argument('--studyid', dest='studyid',
                         required=True, help='Study ID')
@@ -54,8 +57,17 @@ def parse_command_line(argv):
                         default='', help='Name of session (not including "ses-")')
     parser.add_argument('--randomise', dest='randomise', action='store_true',
                         default=False, help='Use Randomise for stats instead of FLAME 1')
+    parser.add_argument('--copes', dest='copes', type=int, nargs='+',
+                        default=[], help='Numbers of the copes to create fsf\'s for (defaults to all copes)')
+    parser.add_argument('--complete-inputs', dest='complete_inputs', action='store_true',
+                        default=False, help='Only add the subjects whose level 2 job succeeded and whose gfeat is '
+                                            'complete (run_pipeline.py releases the copes once the level 2 jobs of '
+                                            'the task have finished, whether or not they succeeded)')
+    return parser
+
 
-    args = parser.parse_args(argv)
+def parse_command_line(argv):
+    args = get_parser().parse_args(argv)
     return args
 
 
@@ -66,10 +78,33 @@ def main(argv=None):
     mk_level3_fsf(args)
 
 
+def get_sublist(a):
+    """Returns the subjects of a level 3 job: the subjects passed in, or all subjects"""
+    if len(a.subids) == 0:
+        return get_all_subs(os.path.join(a.basedir, a.studyid))
+    return a.subids
+
+
+def get_fsfname(a, copenum):
+    """Returns the path of the fsf of a cope"""
+    modeldir = '%s/model/level3/model-%s' % (os.path.join(a.basedir, a.studyid), a.modelname)
+    if a.sesname != '':
+        return '%s/ses-%s/task-%s/ses-%s_task-%s_cope-%03d.fsf' % (modeldir, a.sesname, a.taskname, a.sesname,
+                                                                   a.taskname, copenum)
+    return '%s/task-%s/task-%s_cope-%03d.fsf' % (modeldir, a.taskname, a.taskname, copenum)
+
+
+def get_fingerprint_settings(a, sublist, copenum):
+    """Returns the settings that go into the fingerprint of the fsf of a cope (see fingerprint.py)"""
+    return {'studyid': a.studyid, 'basedir': a.basedir, 'modelname': a.modelname, 'taskname': a.taskname,
+            'sesname': a.sesname, 'randomise': a.randomise, 'subs': list(sublist), 'cope': copenum}
+
+
 # a: Namespace object, output of parser_command_line
-def mk_level3_fsf(a):
+# feat_commands: if a list is given, the command that runs feat on each fsf is added to it
+def mk_level3_fsf(a, feat_commands=None):
     # attributes in a:
-    # studyid,subids,taskname,basedir,modelname,sesname,randomise
+    # studyid,subids,taskname,basedir,modelname,sesname,randomise,copes (optional),complete_inputs (optional)
 
     # Set up directories
     _thisDir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -82,59 +117,28 @@ def mk_level3_fsf(a):
     if not os.path.exists(modeldir):
         os.makedirs(modeldir)
 
+    # model files are read once per process (and again only if they change)
+    spec = model_spec.get_model_spec(a.studyid, a.basedir, a.modelname)
+
     ## read the conditions_key file
-    # if it's a json file
-    cond_key_json = os.path.join(a.basedir, a.studyid, 'model/level1/model-%s/condition_key.json' % a.modelname)
-    # if it's a text file
-    cond_key_txt = os.path.join(a.basedir, a.studyid, 'model/level1/model-%s/condition_key.txt' % a.modelname)
-    if os.path.exists(cond_key_json):
-        try:
-            cond_key = json.load(open(cond_key_json),
-                                 object_pairs_hook=OrderedDict)  # keep the order of the keys as they were in the json file
-        except ValueError:
-            print("\nERROR: Could not read the %s file. Make sure it is formatted correctly." % cond_key_json)
-            sys.exit(-1)
-        if a.taskname in cond_key.keys():
-            cond_key = cond_key[a.taskname]
-        else:
-            print(
-                "WARNING: Task name %s was not found in JSON file %s. Make sure the JSON file is formatted correctly" %
-                (a.taskname, cond_key_json))
-            return []  # no fsf files created
-            # an empty list is returned (rather than an error thrown) because this function is called by
-            # mk_all_level3_fsf, which needs to know how many fsf's were created
-        nconditions = len(cond_key.keys())
-    elif os.path.exists(cond_key_txt):
-        cond_key = load_condkey(cond_key_txt)
-        conditions = cond_key[a.taskname].values()
-        nconditions = len(conditions)  # TO DO: test this
-    else:
-        print("ERROR: Could not find condition key in %s" % (
-            os.path.join(a.basedir, a.studyid, 'model/level1/model-%s' % a.modelname)))
+    if spec.condition_key_file == '':
+        print("ERROR: Could not find condition key in %s" % spec.modeldir)
         sys.exit(-1)
+    cond_key = spec.get_conditions(a.taskname)
+    if cond_key is None:
+        print(
+            "WARNING: Task name %s was not found in %s. Make sure the file is formatted correctly" %
+            (a.taskname, spec.condition_key_file))
+        return []  # no fsf files created
+        # an empty list is returned (rather than an error thrown) because this function is called by
+        # mk_all_level3_fsf, which needs to know how many fsf's were created
+    nconditions = len(cond_key)
 
     ## get contrasts
-    # if it's a json file
-    contrastsfile_json = os.path.join(a.basedir, a.studyid, 'model/level1/model-%s/task_contrasts.json' % a.modelname)
-    # if it's a txt file
-    contrastsfile_txt = os.path.join(a.basedir, a.studyid, 'model/level1/model-%s/task_contrasts.txt' % a.modelname)
-    if os.path.exists(contrastsfile_json):
-        try:
-            all_addl_contrasts = json.load(open(contrastsfile_json), object_pairs_hook=OrderedDict)
-        except ValueError:
-            print("\nERROR: Could not read the %s file. Make sure it is formatted correctly." % contrastsfile_json)
-            sys.exit(-1)
-        # all_addl_contrasts = dict(all_addl_contrasts)
-        # for contrast in all_addl_contrasts:
-        #    all_addl_contrasts[contrast] = dict(all_addl_contrasts[contrast])
-    elif os.path.exists(contrastsfile_txt):
-        all_addl_contrasts = load_contrasts(contrastsfile_txt)
-    else:
-        print("WARNING: Could not find task_contrasts file in %s" % (
-            os.path.join(studydir, a.studyid, 'model/level1/model-%s' % a.modelname)))
-        all_addl_contrasts = {}
-    if a.taskname in all_addl_contrasts:
-        addl_contrasts = all_addl_contrasts[a.taskname]
+    if spec.task_contrasts_file == '':
+        print("WARNING: Could not find task_contrasts file in %s" % spec.modeldir)
+    addl_contrasts = spec.get_contrasts(a.taskname)
+    if addl_contrasts is not None:
         n_addl_contrasts = len(addl_contrasts)
     else:
         n_addl_contrasts = 0
@@ -146,98 +150,66 @@ def mk_level3_fsf(a):
     stubfilename = os.path.join(_thisDir, 'design_level3.stub')
     customstubfilename = os.path.join(a.basedir, a.studyid,
                                       'model/level3/model-%s/design_level3_custom.stub' % a.modelname)
-    # Get settings from custom stub file, store in customsettings dictionary 
-    # in customsettings, key is the setting ('fmri(mc)' for example) and the value of the setting is the value
-    customsettings = {}
-    customsettings_fromstub = {}
-    if os.path.exists(customstubfilename):
-        print('Found custom fsf stub')
-        customstubfile = open(customstubfilename, 'r')
-        for line in customstubfile:
-            llist = line.split(' ')
-            if len(line) > 3 and llist[0] == 'set':
-                setting = llist[1]
-                value = llist[2]
-                customsettings[setting] = value
-                customsettings[setting] = True
-        customstubfile.close()
+    customsettings = fsf_utils.read_custom_stub(customstubfilename)
 
+    # settings that randomise needs, which replace the values in the default stub
+    overrides = OrderedDict()
+    randomise_permutations = None
     if a.randomise:
-        if 'fmri(mixed_yn)' in customsettings and customsettings['fmri(mixed_yn'] == 4:
+        if 'fmri(mixed_yn)' in customsettings and customsettings['fmri(mixed_yn)'].strip() != '4':
             print(
                 'ERROR: design_level3_custom.stub conflicts with the command line argument randomise. Modify the '
                 'custom stub file or don\'t pass --randomise into the command line.')
             sys.exit(-1)
-        customsettings['fmri(mixed_yn)'] = '4\n'
-        customsettings_fromstub['fmri(mixed_yn)'] = False
-        if 'fmri(randomisePermutations)' not in customsettings:
-            customsettings['fmri(randomisePermutations)'] = '5000\n'
-            customsettings_fromstub['fmri(randomisePermutations)'] = False
+        overrides['fmri(mixed_yn)'] = 4
         if 'fmri(thresh)' not in customsettings:
-            customsettings['fmri(thresh)'] = '4\n'
-            customsettings_fromstub['fmri(thresh)'] = False
+            overrides['fmri(thresh)'] = 4
+        if 'fmri(randomisePermutations)' not in customsettings:
+            randomise_permutations = 5000
+
+    # the stubs are parsed once for all copes
+    template = fsf_utils.get_template(stubfilename, customstubfilename, overrides)
+
+    # use the list of subs passed to this function, or get list of all subs
+    sublist = get_sublist(a)
+
+    copenums = range(1, ncopes + 1)
+    if len(getattr(a, 'copes', [])) > 0:
+        copenums = [copenum for copenum in a.copes if 1 <= copenum <= ncopes]
+        if len(copenums) < len(a.copes):
+            print("WARNING: Task %s only has %d copes" % (a.taskname, ncopes))
 
     fsfnames = []
-    for copenum in range(1, ncopes + 1):
+    for copenum in copenums:
         # set feat names
-        if a.sesname != '':
-            outfilename = '%s/ses-%s_task-%s_cope-%03d.fsf' % (modeldir, a.sesname, a.taskname, copenum)
-        else:
-            outfilename = '%s/task-%s_cope-%03d.fsf' % (modeldir, a.taskname, copenum)
+        outfilename = get_fsfname(a, copenum)
         fsfnames.append(outfilename)
-        outfile = open(outfilename, 'w')
-        outfile.write('# Automatically generated by mk_fsf.py\n')
-
-        # first get common lines from stub file
-        stubfile = open(stubfilename, 'r')
-        for line in stubfile:
-            llist = line.split(' ')
-            if len(line) > 3 and llist[0] == 'set':
-                setting = llist[1]
-                # check if setting in default stub file shows up in custom stub file
-                if setting in customsettings.keys():
-                    if customsettings_fromstub[setting]:
-                        outfile.write('# From custom stub file\n')
-                    llist[2] = customsettings[setting]  # set the value of the setting
-                    line = ' '.join(llist)
-                    del customsettings[setting]
-            outfile.write(line)
-        stubfile.close()
-
-        # if there are other settings that haven't been replaced and still need to be added
-        if len(customsettings) > 0:
-            for setting in customsettings:
-                if customsettings_fromstub[setting]:
-                    outfile.write('\n# Additional setting from custom stub file ###\n')
-                if setting == 'fmri(randomisePermutations)':
-                    outfile.write('\n# Higher-level permutations\n')
-                line = 'set ' + setting + ' ' + customsettings[setting]
-                outfile.write(line)
+        fsf = template.document()
+
+        if randomise_permutations is not None:
+            fsf.write('\n# Higher-level permutations\n')
+            fsf.set('fmri(randomisePermutations)', randomise_permutations)
 
         # now add custom lines
 
-        outfile.write('\n\n### AUTOMATICALLY GENERATED PART###\n\n')
+        fsf.start_generated_part()
 
         # look for standard brain provided by fsl (need fsl's path)
-        env = os.environ.copy()
+        env = os.environ
         FSLDIR = '/usr/local/fsl'
         if 'FSLDIR' in env.keys():
             FSLDIR = env["FSLDIR"]
         elif 'FSL_DIR' in env.keys():
             FSLDIR = env["FSL_DIR"]
         regstandard = os.path.join(FSLDIR, 'data/standard/MNI152_T1_2mm_brain')
-        outfile.write('set fmri(regstandard) "%s"\n' % regstandard)
+        fsf.set('fmri(regstandard)', '"%s"' % regstandard)
 
-        outfile.write('set fmri(outputdir) "%s/cope-%03d.gfeat"\n' % (modeldir, copenum))
+        fsf.set('fmri(outputdir)', '"%s/cope-%03d.gfeat"' % (modeldir, copenum))
 
         ngoodsubs = 0
-        # use the list of subs passed to this function, or get list of all subs
-        if len(a.subids) == 0:
-            sublist = get_all_subs(studydir)
-        else:
-            sublist = a.subids
 
         missing_feat_files = []
+        incomplete_feat_files = []
 
         # iterate through all subjects
         for sub in sublist:  # sub doesn't include prefix 'sub-'
@@ -248,10 +220,16 @@ def mk_level3_fsf(a):
                 subid_ses_dir += "/ses-%s" % a.sesname
             featfile = os.path.join(studydir, 'model/level2/model-%s/%s/task-%s/%s_task-%s.gfeat/cope%d.feat' % (
                 a.modelname, subid_ses_dir, a.taskname, subid_ses, a.taskname, copenum))
+            if os.path.exists(featfile) and getattr(a, 'complete_inputs', False):
+                # a level 2 job that failed or ran out of time can leave a partial cope*.feat behind
+                complete, reason = job_state.check_finished_output(studydir, os.path.dirname(featfile), 2, ncopes)
+                if not complete:
+                    incomplete_feat_files.append((sub, featfile, reason))
+                    continue
             if os.path.exists(featfile):
-                outfile.write('set feat_files(%d) "%s"\n' % (ngoodsubs + 1, featfile))
-                outfile.write('set fmri(evg%d.1) 1\n' % int(ngoodsubs + 1))
-                outfile.write('set fmri(groupmem.%d) 1\n' % int(ngoodsubs + 1))
+                fsf.set('feat_files(%d)' % (ngoodsubs + 1), '"%s"' % featfile)
+                fsf.set('fmri(evg%d.1)' % int(ngoodsubs + 1), 1)
+                fsf.set('fmri(groupmem.%d)' % int(ngoodsubs + 1), 1)
                 ngoodsubs += 1
             else:
                 missing_feat_files.append(featfile)
@@ -261,12 +239,32 @@ def mk_level3_fsf(a):
         elif len(missing_feat_files) > 0:
             for featfile in missing_feat_files:
                 print("WARNING: featfile not found: %s, was not added to *.fsf\n" % featfile)
+        for sub, featfile, reason in incomplete_feat_files:
+            print("WARNING: The level 2 output %s is incomplete (%s), it was not added to *.fsf\n" % (featfile, reason))
 
         # Note: "feat won't run if zero feat_files are added to this fsf."
-        outfile.write('set fmri(npts) %d\n' % ngoodsubs)  # number of runs
-        outfile.write('set fmri(multiple) %d\n' % ngoodsubs)  # number of runs
-
-        outfile.close()
+        fsf.set('fmri(npts)', ngoodsubs)  # number of runs
+        fsf.set('fmri(multiple)', ngoodsubs)  # number of runs
+
+        # fingerprint of everything the fsf was made from; the design.fsf's of the level 2 gfeats stand for them. The
+        # subjects left out because their level 2 output is incomplete are left out of the settings too, so the cope is
+        # out of date (and run again) once their level 2 jobs have been run again
+        incomplete_subs = [sub for sub, featfile, reason in incomplete_feat_files]
+        fp = fingerprint.Fingerprint(get_fingerprint_settings(
+            a, [sub for sub in sublist if sub not in incomplete_subs], copenum))
+        for sub in sublist:
+            subid_ses = "sub-" + sub + ("_ses-%s" % a.sesname if a.sesname != "" else "")
+            fp.add(fingerprint.get_output_fsfname(os.path.join(
+                studydir, 'model/level2/model-%s/sub-%s%s/task-%s/%s_task-%s.gfeat' % (
+                    a.modelname, sub, "/ses-%s" % a.sesname if a.sesname != "" else "", a.taskname, subid_ses,
+                    a.taskname))))
+        for path in [stubfilename, customstubfilename] + spec.get_input_files():
+            fp.add(path)
+        fsf.write('\n' + fp.comment())
+
+        fsf.save(outfilename)
+        if feat_commands is not None:
+            feat_commands.append(['feat', outfilename])
 
     """
     for f in fsfnames:
@@ -0,0 +1,229 @@
+"""
+Model files of a level 1 model directory (model_params.json, condition_key, task_contrasts, orthogonalize.txt and
+confounds.json), read and validated once per process
+A ModelSpec is immutable and is shared by the fsf generators of all three levels and by the job builders. It is read
+again only if one of the model files changes.
+"""
+
+from collections import namedtuple, OrderedDict
+import copy
+import json
+import os
+import sys
+from types import MappingProxyType
+
+import confound_expansions
+from openfmri_utils import load_condkey, load_contrasts
+
+MODEL_FILES = ['model_params.json', 'condition_key.json', 'condition_key.txt', 'task_contrasts.json',
+               'task_contrasts.txt', 'orthogonalize.txt', 'confounds.json']
+
+# ModelSpec for each model directory, keyed by the path of the model directory, along with the state of its files
+_model_specs = {}
+
+
+def _freeze(obj):
+    """Returns a read-only copy of nested dictionaries and lists (MappingProxyType and tuples)"""
+    if isinstance(obj, dict):
+        return MappingProxyType(OrderedDict((key, _freeze(value)) for key, value in obj.items()))
+    if isinstance(obj, list):
+        return tuple(_freeze(value) for value in obj)
+    return obj
+
+
+def _thaw(obj):
+    """Returns a modifiable copy of an object frozen by _freeze"""
+    if isinstance(obj, MappingProxyType):
+        return OrderedDict((key, _thaw(value)) for key, value in obj.items())
+    if isinstance(obj, tuple):
+        return [_thaw(value) for value in obj]
+    return copy.copy(obj)
+
+
+def _load_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f, object_pairs_hook=OrderedDict)  # keep the order of the keys as they were in the file
+    except ValueError:
+        print("\nERROR: Could not read the %s file. Make sure it is formatted correctly." % path)
+        sys.exit(-1)
+
+
+def _check_task_dict(data, path):
+    # condition_key.json and task_contrasts.json map each task name to a dictionary
+    if not isinstance(data, dict) or not all(isinstance(value, dict) for value in data.values()):
+        print("\nERROR: Each task name in %s should map to a JSON object. Make sure it is formatted correctly." % path)
+        sys.exit(-1)
+
+
+def _load_orthogonalize(path):
+    # each line is 'task<N> <EV> <EV to orthogonalize it with respect to>'
+    orth = {}
+    with open(path, 'r') as f:
+        for line in f.readlines():
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            tasknum = int(fields[0].replace('task', ''))
+            orth.setdefault(tasknum, {})[int(fields[1])] = int(fields[2])
+    return orth
+
+
+class ModelSpec(namedtuple('ModelSpec', ['modeldir', 'model_params', 'condition_key_file', 'condition_key',
+                                         'task_contrasts_file', 'task_contrasts', 'orthogonalize_file',
+                                         'orthogonalize', 'confounds', 'confound_expansions'])):
+    """Contents of the model files of a level 1 model directory
+
+    modeldir: path of the level 1 model directory
+    model_params: contents of model_params.json (None if it doesn't exist)
+    condition_key_file: path of condition_key.json or condition_key.txt ('' if neither exists)
+    condition_key: task name -> (EV -> condition name), in the order of the file
+    task_contrasts_file: path of task_contrasts.json or task_contrasts.txt ('' if neither exists)
+    task_contrasts: task name -> (contrast name -> contrast vector), in the order of the file
+    orthogonalize_file: path of orthogonalize.txt ('' if it doesn't exist)
+    orthogonalize: task number -> (EV -> EV it is orthogonalized with respect to)
+    confounds: tuple of the confounds listed in confounds.json (None if it doesn't exist)
+    confound_expansions: "expansions" of confounds.json (see confound_expansions.py), or None
+
+    Dictionaries are read-only (MappingProxyType) and lists are tuples. Use get_model_params() for a copy of the
+    model params that can be modified.
+    """
+    __slots__ = ()
+
+    def get_conditions(self, task):
+        """Returns the EV -> condition name mapping of a task, or None if the task isn't in the condition key"""
+        return self.condition_key.get(task)
+
+    def get_contrasts(self, task):
+        """Returns the contrast name -> vector mapping of a task, or None if the task isn't in task_contrasts"""
+        return self.task_contrasts.get(task)
+
+    def get_ncopes(self, task):
+        """Returns the number of copes of a task (one per condition, the all-conditions contrast and one per
+        additional contrast), or None if the task isn't in the condition key"""
+        conditions = self.get_conditions(task)
+        if conditions is None:
+            return None
+        contrasts = self.get_contrasts(task)
+        return len(conditions) + 1 + (len(contrasts) if contrasts is not None else 0)
+
+    def get_input_files(self):
+        """Returns the paths of the model files that the fsf's are made from, including those that don't exist
+        (model_params.json is left out, since its values are passed to the fsf generators as arguments)"""
+        return [os.path.join(self.modeldir, filename) for filename in MODEL_FILES if filename != 'model_params.json']
+
+    def get_orthogonalization(self, tasknum):
+        """Returns the EV -> EV mapping of orthogonalized EVs of a task number (empty if there are none)"""
+        return self.orthogonalize.get(tasknum, MappingProxyType({}))
+
+    def get_confound_expansions(self):
+        """Returns a modifiable copy of the expansions of confounds.json (None if there are none)"""
+        if self.confound_expansions is None:
+            return None
+        return _thaw(self.confound_expansions)
+
+    def get_num_confounds(self):
+        """Returns the number of confound columns, without the spike columns of the expansions (0 without
+        confounds.json)"""
+        if self.confounds is None:
+            return 0
+        return len(self.confounds) + confound_expansions.get_num_columns(self.confound_expansions)
+
+    def get_model_params(self):
+        """Returns a modifiable copy of model_params.json (None if it doesn't exist)"""
+        if self.model_params is None:
+            return None
+        return _thaw(self.model_params)
+
+
+def read_model_spec(modeldir):
+    """Reads and validates the model files of a model directory
+
+    Args:
+        modeldir (str): path of the level 1 model directory (basedir/studyid/model/level1/model-<modelname>)
+    Returns:
+        ModelSpec object
+    """
+    def path(filename):
+        return os.path.join(modeldir, filename)
+
+    model_params = None
+    if os.path.exists(path('model_params.json')):
+        model_params = _load_json(path('model_params.json'))
+        if not isinstance(model_params, dict):
+            print("\nERROR: %s should contain a JSON object." % path('model_params.json'))
+            sys.exit(-1)
+
+    condition_key_file = ''
+    condition_key = {}
+    if os.path.exists(path('condition_key.json')):
+        condition_key_file = path('condition_key.json')
+        condition_key = _load_json(condition_key_file)
+        _check_task_dict(condition_key, condition_key_file)
+    elif os.path.exists(path('condition_key.txt')):
+        condition_key_file = path('condition_key.txt')
+        condition_key = load_condkey(condition_key_file)
+
+    task_contrasts_file = ''
+    task_contrasts = {}
+    if os.path.exists(path('task_contrasts.json')):
+        task_contrasts_file = path('task_contrasts.json')
+        task_contrasts = _load_json(task_contrasts_file)
+        _check_task_dict(task_contrasts, task_contrasts_file)
+    elif os.path.exists(path('task_contrasts.txt')):
+        task_contrasts_file = path('task_contrasts.txt')
+        task_contrasts = load_contrasts(task_contrasts_file)
+
+    orthogonalize_file = ''
+    orthogonalize = {}
+    if os.path.exists(path('orthogonalize.txt')):
+        orthogonalize_file = path('orthogonalize.txt')
+        orthogonalize = _load_orthogonalize(orthogonalize_file)
+
+    confounds = None
+    expansions = None
+    if os.path.exists(path('confounds.json')):
+        confounds_dict = _load_json(path('confounds.json'))
+        if not isinstance(confounds_dict, dict) or not isinstance(confounds_dict.get('confounds'), list):
+            print('\nERROR: %s should contain a JSON object with a list of confounds, e.g. {"confounds": ["csf"]}' %
+                  path('confounds.json'))
+            sys.exit(-1)
+        confounds = confounds_dict['confounds']
+        expansions = confounds_dict.get('expansions')
+        if expansions is not None:
+            error = confound_expansions.check_expansions(expansions)
+            if error is not None:
+                print('\nERROR: %s: %s' % (path('confounds.json'), error))
+                sys.exit(-1)
+
+    return ModelSpec(modeldir, _freeze(model_params), condition_key_file, _freeze(condition_key), task_contrasts_file,
+                     _freeze(task_contrasts), orthogonalize_file, _freeze(orthogonalize), _freeze(confounds),
+                     _freeze(expansions))
+
+
+def _get_files_state(modeldir):
+    state = []
+    for filename in MODEL_FILES:
+        try:
+            st = os.stat(os.path.join(modeldir, filename))
+            state.append((st.st_mtime_ns, st.st_size))
+        except (FileNotFoundError, NotADirectoryError):
+            state.append(None)
+    return tuple(state)
+
+
+def get_model_spec(studyid, basedir, modelname):
+    """Gets the ModelSpec of a model, reading the model files only the first time or if one of them changed
+
+    Args:
+        studyid (str): name of the study (parent directory of fmriprep)
+        basedir (str): path of the directory above the study directory
+        modelname (str): name of model (not including "model-")
+    Returns:
+        ModelSpec object
+    """
+    modeldir = os.path.join(basedir, studyid, 'model', 'level1', 'model-%s' % modelname)
+    state = _get_files_state(modeldir)
+    if modeldir not in _model_specs or _model_specs[modeldir][0] != state:
+        _model_specs[modeldir] = (state, read_model_spec(modeldir))
+    return _model_specs[modeldir][1]
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Motion QC of the runs of a study, computed from the fmriprep confounds files before any job is built
+For each run, reads framewise_displacement (and std_dvars if a DVARS threshold is set) and computes the mean and maximum
+framewise displacement and the percentage of volumes over the thresholds. The results are written to motion_qc.tsv under
+the level 1 model directory, and runs with too much motion can be removed from specificruns so that no job is built for
+them (see run_level1.py and run_pipeline.py --motion-qc).
+The thresholds are read from motion_qc.json under the level 1 model directory, if it exists. Ex:
+    {
+        "fd_threshold": 0.5,         volumes with a framewise displacement over this (mm) are counted as over threshold
+        "dvars_threshold": 1.5,      volumes with a std_dvars over this are also counted as over threshold (null: DVARS
+                                     isn't read)
+        "max_mean_fd": 0.2,          runs with a mean framewise displacement over this (mm) are excluded (null: no
+                                     limit)
+        "max_fd": 5.0,               runs with a framewise displacement over this (mm) are excluded (null: no limit)
+        "max_pct_over": 20           runs with more than this percentage of volumes over threshold are excluded (null:
+                                     no limit)
+    }
+Thresholds that motion_qc.json doesn't set keep their default values (DEFAULT_THRESHOLDS).
+"""
+
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import directory_struct_utils
+import setup_utils
+
+FD_COLUMN = 'framewise_displacement'
+DVARS_COLUMN = 'std_dvars'
+
+DEFAULT_THRESHOLDS = collections.OrderedDict([
+    ('fd_threshold', 0.5),
+    ('dvars_threshold', None),
+    ('max_mean_fd', 0.2),
+    ('max_fd', None),
+    ('max_pct_over', 20.0),
+])
+
+MOTION_QC_FILENAME = 'motion_qc.json'
+MOTION_TABLE_FILENAME = 'motion_qc.tsv'
+MOTION_TABLE_COLUMNS = ['sub', 'ses', 'task', 'run', 'nvols', 'mean_fd', 'max_fd', 'pct_fd_over', 'mean_dvars',
+                        'pct_dvars_over', 'pct_over', 'excluded', 'reason']
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Compute the motion of every run and list the runs to exclude')
+
+    parser.add_argument('--studyid', dest='studyid',
+                        required=True, help='Study ID')
+    parser.add_argument('--basedir', dest='basedir',
+                        required=True, help='Base directory (above studyid directory)')
+    parser.add_argument('-m', '--modelname', dest='modelname',
+                        required=True, help='Model name')
+    parser.add_argument('--nworkers', dest='nworkers', type=int,
+                        default=None, help='Number of processes that read the confounds files. Defaults to one per '
+                                           'core, up to %d.' % setup_utils.MAX_CONFOUNDS_WORKERS)
+    parser.add_argument('-s', '--specificruns', dest='specificruns', type=json.loads,
+                        default={}, help="""JSON object in a string that details which runs to check. If specified,
+                        ignores specificruns specified in model_params.json. Ex: If there are sessions:
+                        \'{"sub-01": {"ses-01": {"flanker": ["1", "2"]}}, "sub-02": {"ses-01": {"flanker": ["1",
+                        "2"]}}}\' where flanker is a task name and ["1", "2"] is a list of the runs. If there aren't
+                        sessions: \'{"sub-01":{"flanker":["1"]},"sub-02":{"flanker":["1","2"]}}\'. Make sure to have
+                        single quotes around the JSON object and double quotes within. """
+                        )
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def get_thresholds(studyid, basedir, modelname):
+    """Reads the thresholds of motion_qc.json under the level 1 model directory
+
+    Returns:
+        OrderedDict with the keys of DEFAULT_THRESHOLDS; thresholds that motion_qc.json doesn't set (or all of them, if
+        it doesn't exist) have their default values
+    """
+    thresholds = copy.copy(DEFAULT_THRESHOLDS)
+    path = os.path.join(basedir, studyid, 'model', 'level1', 'model-%s' % modelname, MOTION_QC_FILENAME)
+    if not os.path.exists(path):
+        return thresholds
+    try:
+        with open(path, 'r') as f:
+            values = json.load(f)
+    except ValueError as e:
+        print('\nERROR: %s is not valid JSON: %s' % (path, e))
+        sys.exit(-1)
+    if not isinstance(values, dict):
+        print('\nERROR: %s should be a JSON object' % path)
+        sys.exit(-1)
+    for key, value in values.items():
+        if key not in thresholds:
+            print('\nERROR: %s: unknown threshold "%s" (expected one of %s)' % (path, key, ', '.join(thresholds)))
+            sys.exit(-1)
+        if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0):
+            print('\nERROR: %s: "%s" should be a positive number or null' % (path, key))
+            sys.exit(-1)
+        thresholds[key] = value
+    if thresholds['fd_threshold'] is None:
+        print('\nERROR: %s: "fd_threshold" can\'t be null' % path)
+        sys.exit(-1)
+    return thresholds
+
+
+def get_run_motion(confounds_filepath, fd_threshold, dvars_threshold=None):
+    """Computes the motion of a run from its fmriprep confounds file
+
+    Args:
+        confounds_filepath (str): path of the fmriprep confounds file
+        fd_threshold (float): framewise displacement threshold (mm)
+        dvars_threshold (float): std_dvars threshold, or None to only use the framewise displacement
+    Returns:
+        dictionary with nvols, mean_fd, max_fd, pct_fd_over, mean_dvars, pct_dvars_over and pct_over (percentage of
+        volumes over either threshold); the values are NaN if the columns are missing. Missing values (the first
+        volume) are never over a threshold.
+    """
+    columns = [FD_COLUMN] if dvars_threshold is None else [FD_COLUMN, DVARS_COLUMN]
+    df = setup_utils.read_confounds(confounds_filepath, columns, reindex=False)
+    nvols = len(df)
+    motion = {'nvols': nvols, 'mean_fd': np.nan, 'max_fd': np.nan, 'pct_fd_over': np.nan, 'mean_dvars': np.nan,
+              'pct_dvars_over': np.nan, 'pct_over': np.nan}
+    if nvols == 0:
+        return motion
+    over = np.zeros(nvols, dtype=bool)
+    found = False
+    for column, threshold, prefix in [(FD_COLUMN, fd_threshold, 'fd'), (DVARS_COLUMN, dvars_threshold, 'dvars')]:
+        if threshold is None or column not in df.columns:
+            continue
+        found = True
+        values = df[column].values.astype(float)
+        with np.errstate(invalid='ignore'):
+            column_over = values > threshold
+        over |= column_over
+        motion['mean_%s' % prefix] = np.nanmean(values) if np.any(~np.isnan(values)) else np.nan
+        motion['pct_%s_over' % prefix] = 100.0 * np.count_nonzero(column_over) / nvols
+        if prefix == 'fd':
+            motion['max_fd'] = np.nanmax(values) if np.any(~np.isnan(values)) else np.nan
+    if found:
+        motion['pct_over'] = 100.0 * np.count_nonzero(over) / nvols
+    return motion
+
+
+def _get_runs_motion(runs):
+    return [get_run_motion(*run) for run in runs]
+
+
+def get_exclusion_reason(motion, thresholds):
+    """Returns why a run is excluded ('' if it isn't), given its motion (see get_run_motion) and the thresholds"""
+    reasons = []
+    if thresholds['max_mean_fd'] is not None and motion['mean_fd'] > thresholds['max_mean_fd']:
+        reasons.append('mean FD %.4f > %s' % (motion['mean_fd'], thresholds['max_mean_fd']))
+    if thresholds['max_fd'] is not None and motion['max_fd'] > thresholds['max_fd']:
+        reasons.append('max FD %.4f > %s' % (motion['max_fd'], thresholds['max_fd']))
+    if thresholds['max_pct_over'] is not None and motion['pct_over'] > thresholds['max_pct_over']:
+        reasons.append('%.1f%% of volumes over threshold > %s%%' % (motion['pct_over'], thresholds['max_pct_over']))
+    return '; '.join(reasons)
+
+
+def get_motion_table(studyid, basedir, specificruns, hasSessions, thresholds, nworkers=None):
+    """Computes the motion of all runs in specificruns, reading the confounds files in nworkers processes
+
+    Args:
+        specificruns (dict): runs to check
+        hasSessions (bool): whether the study has sessions
+        thresholds (dict): see get_thresholds
+        nworkers (int): number of processes (by default, one per core up to setup_utils.MAX_CONFOUNDS_WORKERS); studies
+            with fewer than setup_utils.MIN_PARALLEL_CONFOUNDS runs are read in this process
+    Returns:
+        pandas.DataFrame with the columns of MOTION_TABLE_COLUMNS (a row per run with a confounds file), and a list of
+        the RunObj's of the runs without a confounds file
+    """
+    studydir = os.path.join(basedir, studyid)
+    index = directory_struct_utils.get_bids_index(studydir, use_catalog=True)
+    run_objects = []
+    runs = []  # (confounds file, fd_threshold, dvars_threshold) of each run
+    runs_without_confounds = []
+    for spef_run in setup_utils.traverse_specificruns(studyid, basedir, specificruns, hasSessions):
+        confounds_filepath = setup_utils.get_confounds_filepath(index, spef_run)
+        if confounds_filepath is not None:
+            run_objects.append(spef_run)
+            runs.append((confounds_filepath, thresholds['fd_threshold'], thresholds['dvars_threshold']))
+        else:
+            runs_without_confounds.append(spef_run)
+
+    if nworkers is None:
+        nworkers = min(setup_utils.MAX_CONFOUNDS_WORKERS, os.cpu_count() or 1)
+    if nworkers <= 1 or len(runs) < setup_utils.MIN_PARALLEL_CONFOUNDS:
+        motions = _get_runs_motion(runs)
+    else:
+        chunksize = max(1, len(runs) // (nworkers * 4))
+        chunks = [runs[i:i + chunksize] for i in range(0, len(runs), chunksize)]
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            motions = [motion for chunk_motions in pool.map(_get_runs_motion, chunks) for motion in chunk_motions]
+
+    rows = []
+    for spef_run, motion in zip(run_objects, motions):
+        reason = get_exclusion_reason(motion, thresholds)
+        rows.append(dict(motion, sub=spef_run.sub, ses=spef_run.ses if spef_run.ses is not None else '',
+                         task=spef_run.task, run=spef_run.run, excluded=int(reason != ''), reason=reason))
+    return pd.DataFrame(rows, columns=MOTION_TABLE_COLUMNS), runs_without_confounds
+
+
+def write_motion_table(table, path):
+    table.to_csv(path, sep='\t', index=False, na_rep='n/a', float_format='%.4f')
+
+
+def prune_specificruns(specificruns, table):
+    """Returns a copy of specificruns without the runs that are excluded in the motion table
+    Sessions, tasks and subjects that have no runs left are removed as well
+    """
+    pruned = copy.deepcopy(specificruns)
+    for row in table[table['excluded'] == 1].itertuples():
+        subid = 'sub-' + row.sub
+        tasks = pruned[subid]['ses-' + row.ses] if row.ses != '' else pruned[subid]
+        tasks[row.task].remove(row.run)
+        if len(tasks[row.task]) == 0:
+            del tasks[row.task]
+        if row.ses != '' and len(tasks) == 0:
+            del pruned[subid]['ses-' + row.ses]
+        if len(pruned[subid]) == 0:
+            del pruned[subid]
+    return pruned
+
+
+def _get_fileprefix(row):
+    # prefix of the files of the run of a row of the motion table
+    ses = row.ses if row.ses != '' else None
+    return setup_utils.get_run_prefix(setup_utils.RunObj(row.sub, ses, row.task, row.run))
+
+
+def run_motion_qc(studyid, basedir, modelname, specificruns, hasSessions, nworkers=None):
+    """Computes the motion of all runs in specificruns, writes motion_qc.tsv under the level 1 model directory and
+    prints the runs that are excluded
+
+    Returns:
+        specificruns without the excluded runs (exits if all runs are excluded)
+    """
+    thresholds = get_thresholds(studyid, basedir, modelname)
+    table, runs_without_confounds = get_motion_table(studyid, basedir, specificruns, hasSessions, thresholds, nworkers)
+    path = os.path.join(basedir, studyid, 'model', 'level1', 'model-%s' % modelname, MOTION_TABLE_FILENAME)
+    write_motion_table(table, path)
+    excluded = table[table['excluded'] == 1]
+    print('Motion QC of %d runs (see %s): %d runs are excluded' % (len(table), path, len(excluded)))
+    for row in excluded.itertuples():
+        print('\t%s: %s' % (_get_fileprefix(row), row.reason))
+    unassessed = table[table['pct_over'].isnull()]
+    if len(runs_without_confounds) > 0 or len(unassessed) > 0:
+        print('WARNING: the motion of the following runs could not be assessed (they are not excluded):')
+        for spef_run in runs_without_confounds:
+            print('\t%s (no confounds file)' % setup_utils.get_run_prefix(spef_run))
+        for row in unassessed.itertuples():
+            print('\t%s (no %s column)' % (_get_fileprefix(row), FD_COLUMN))
+    pruned = prune_specificruns(specificruns, table)
+    if len(pruned) == 0:
+        print('ERROR: All runs are excluded by the motion QC. Change the thresholds in %s.' % os.path.join(
+            basedir, studyid, 'model', 'level1', 'model-%s' % modelname, MOTION_QC_FILENAME))
+        sys.exit(-1)
+    return pruned
+
+
+def main(argv=None):
+    args = parse_command_line(argv)
+    studyid = args.studyid
+    basedir = args.basedir
+    modelname = args.modelname
+
+    studydir = os.path.join(basedir, studyid)
+    study_info, hasSessions = directory_struct_utils.get_study_info(studydir)
+    specificruns = args.specificruns
+    if specificruns == {}:
+        specificruns = setup_utils.model_params_json_to_namespace(studyid, basedir, modelname).specificruns
+    if specificruns == {}:
+        specificruns = study_info
+
+    pruned = run_motion_qc(studyid, basedir, modelname, specificruns, hasSessions, args.nworkers)
+    if pruned != specificruns:
+        print('\nspecificruns without the excluded runs:')
+        print(json.dumps(pruned))
+
+
+if __name__ == '__main__':
+    main()
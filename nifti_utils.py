@@ -1,29 +1,129 @@
 #!/usr/bin/env python
 """
 Processes header of Nifti files
+Headers are read directly from the file (NIfTI-1 or NIfTI-2, gzipped or not), without calling fslinfo
 """
 
 # Created by Alice Xue, 06/2018
 
-import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import struct
+import zlib
+
+# size of the header in bytes, which is also the first field of the header
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# the compressed file is read in blocks of this size until the header has been decompressed
+_READ_SIZE = 4096
+
+# factor to convert the time unit in xyzt_units to seconds
+_TIME_UNITS = {8: 1.0, 16: 1e-3, 24: 1e-6}
+
+
+class NiftiHeader(namedtuple('NiftiHeader', ['version', 'dims', 'pixdims', 'datatype', 'bitpix', 'vox_offset',
+                                             'xyzt_units', 'tr'])):
+    """Fields of a NIfTI header that the pipeline uses
+
+    version: 1 or 2 (NIfTI-1 or NIfTI-2)
+    dims: tuple with the size of each dimension (dim[1] to dim[dim[0]]), e.g. (97, 115, 97, 200)
+    pixdims: tuple with the voxel size of each dimension (pixdim[1] to pixdim[dim[0]]), as stored in the header
+    datatype: NIfTI datatype code (e.g. 16 for float32)
+    bitpix: number of bits per voxel
+    vox_offset: offset of the image data in the (uncompressed) file
+    xyzt_units: NIfTI code of the spatial and temporal units
+    tr: Repetition Time in seconds (pixdim[4], converted from ms or us if the header says so)
+    """
+    __slots__ = ()
+
+    @property
+    def npts(self):
+        """Number of timepoints (volumes)"""
+        if len(self.dims) > 3:
+            return self.dims[3]
+        return 1
+
+
+def _read_header_bytes(niftifile, nbytes):
+    """Reads the first nbytes of a NIfTI file, decompressing only as much of a .nii.gz as is needed"""
+    with open(niftifile, 'rb') as f:
+        block = f.read(_READ_SIZE)
+        if block[:2] != b'\x1f\x8b':  # not gzipped
+            return block[:nbytes]
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = decompressor.decompress(block, nbytes)
+        while len(data) < nbytes:
+            block = decompressor.unconsumed_tail or f.read(_READ_SIZE)
+            if not block:
+                break
+            data += decompressor.decompress(block, nbytes - len(data))
+        return data
 
 
 def read_nifti_header(niftifile):
     """
     Args:
-        niftifile (str): full path of niftifile
+        niftifile (str): full path of niftifile (.nii or .nii.gz)
     Returns:
-        dictionary with original variables in header as keys and the values as their respective values
+        NiftiHeader with the dimensions, voxel sizes, datatype and TR of the image
+    Raises:
+        ValueError if niftifile is not a NIfTI-1 or NIfTI-2 file
     """
-    p = subprocess.Popen(['fslinfo', niftifile], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-    output, errors = p.communicate()
-    l1 = output.split('\n')
-    header_vals = {}
-    for line in l1:
-        tmp = line.replace('\t', ' ').split(' ')
-        if tmp[0] != '':
-            header_vals[tmp[0]] = tmp[-1]
-    return header_vals
+    data = _read_header_bytes(niftifile, NIFTI2_HEADER_SIZE)
+    if len(data) < NIFTI1_HEADER_SIZE:
+        raise ValueError('%s is too short to be a NIfTI file' % niftifile)
+    for endian in '<>':
+        sizeof_hdr = struct.unpack(endian + 'i', data[:4])[0]
+        if sizeof_hdr in (NIFTI1_HEADER_SIZE, NIFTI2_HEADER_SIZE):
+            break
+    else:
+        raise ValueError('%s is not a NIfTI-1 or NIfTI-2 file' % niftifile)
+
+    if sizeof_hdr == NIFTI1_HEADER_SIZE:
+        version = 1
+        dim = struct.unpack(endian + '8h', data[40:56])
+        datatype, bitpix = struct.unpack(endian + '2h', data[70:74])
+        pixdim = struct.unpack(endian + '8f', data[76:108])
+        vox_offset = struct.unpack(endian + 'f', data[108:112])[0]
+        xyzt_units = struct.unpack(endian + 'B', data[123:124])[0]
+    else:
+        if len(data) < NIFTI2_HEADER_SIZE:
+            raise ValueError('%s is too short to be a NIfTI-2 file' % niftifile)
+        version = 2
+        datatype, bitpix = struct.unpack(endian + '2h', data[12:16])
+        dim = struct.unpack(endian + '8q', data[16:80])
+        pixdim = struct.unpack(endian + '8d', data[104:168])
+        vox_offset = struct.unpack(endian + 'q', data[168:176])[0]
+        xyzt_units = struct.unpack(endian + 'i', data[500:504])[0]
+
+    ndim = dim[0]
+    if ndim < 1 or ndim > 7:
+        raise ValueError('%s has an invalid number of dimensions in its header: %d' % (niftifile, ndim))
+    tr = float(pixdim[4]) * _TIME_UNITS.get(xyzt_units & 0x38, 1.0)
+    return NiftiHeader(version, tuple(int(d) for d in dim[1:ndim + 1]), tuple(float(p) for p in pixdim[1:ndim + 1]),
+                       datatype, bitpix, int(vox_offset), xyzt_units, tr)
+
+
+def read_nifti_headers(niftifiles, nworkers=8):
+    """Reads the headers of many Nifti files in a thread pool
+
+    Args:
+        niftifiles (list): full paths of niftifiles
+        nworkers (int): number of threads
+    Returns:
+        dictionary with the paths as keys and NiftiHeaders as values (None if a header could not be read)
+    """
+    def read(niftifile):
+        try:
+            return read_nifti_header(niftifile)
+        except (OSError, ValueError) as e:
+            print('WARNING: Could not read the header of %s: %s' % (niftifile, e))
+            return None
+
+    niftifiles = list(niftifiles)
+    with ThreadPoolExecutor(max_workers=max(1, nworkers)) as pool:
+        return dict(zip(niftifiles, pool.map(read, niftifiles)))
 
 
 def get_tr(niftifile):
@@ -33,5 +133,14 @@ def get_tr(niftifile):
     Returns:
         the Repetition Time as a floating number
     """
-    header_vals = read_nifti_header(niftifile)
-    return float(header_vals['pixdim4'])
+    return read_nifti_header(niftifile).tr
+
+
+def get_npts(niftifile):
+    """
+    Args:
+        niftifile (str): full path of niftifile
+    Returns:
+        the number of timepoints (volumes) as an integer
+    """
+    return read_nifti_header(niftifile).npts
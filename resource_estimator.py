@@ -0,0 +1,275 @@
+"""
+Predicts the time and memory each feat job needs, so that job arrays ask slurm for what their jobs use
+The size of a job is read from the header of its preprocessed func file (number of voxels and timepoints) and from the
+model (number of EVs, confounds and copes). Time and memory are fitted to the runtimes and peak memory of earlier jobs
+of the same level that succeeded (recorded in the state store, see job_state.py); without enough of them, the time
+given on the command line is scaled by the size of each job relative to the others and the memory is estimated from
+the size of the data.
+Jobs are then grouped into a few size classes, each submitted as its own job array with the limits of its largest job.
+"""
+
+import math
+import os
+
+import directory_struct_utils
+import fsf_utils
+import job_state
+import model_spec
+import slurm_utils
+import study_catalog
+
+# number of earlier jobs needed before time and memory are fitted to them
+MIN_HISTORY = 3
+# the fitted rates are this percentile of the earlier jobs' rates, times a safety margin
+RATE_PERCENTILE = 90
+TIME_MARGIN = 1.25
+MEM_MARGIN = 1.25
+
+MIN_TIME = 10 * 60  # seconds
+MIN_MEM = 512  # MB
+MEM_STEP = 256  # memory limits are rounded up to a multiple of this (MB)
+# feat's memory without history: a fixed overhead plus a few copies of the data as float32
+BASE_MEM = 256  # MB
+MEM_PER_DATA_MB = 4.0
+
+# time limits of the size classes are rounded up to MIN_TIME * TIME_STEP ** k
+TIME_STEP = 1.5
+
+
+def _get_arg(job, flag, default=''):
+    if flag in job:
+        return job[job.index(flag) + 1]
+    return default
+
+
+def _get_list_arg(job, flag):
+    # values of a flag that takes several values (e.g. --runs 1 2)
+    if flag not in job:
+        return []
+    values = []
+    for arg in job[job.index(flag) + 1:]:
+        if arg.startswith('--'):
+            break
+        values.append(arg)
+    return values
+
+
+def _get_func_header(studydir, sub, ses, task, run):
+    # the jobs are sized in the planning process, which fills the header cache of the study catalog (compute jobs only
+    # read it, see study_catalog.use_read_only_catalogs)
+    index = directory_struct_utils.get_bids_index(studydir, use_catalog=True)
+    funcdir = index.get_dir(sub, ses, 'func')
+    for name in index.get_run_files(sub, ses, task, run):
+        if directory_struct_utils.is_preproc_bold(name) and name.endswith('.nii.gz'):
+            return study_catalog.open_catalog(studydir).get_nifti_header(os.path.join(funcdir, name))
+    return None
+
+
+def get_job_size(job, level):
+    """Gets the size of a job, which its time and memory are predicted from
+
+    Args:
+        job: list of arguments for mk_level1_fsf_bbr, mk_level2_fsf or mk_level3_fsf, or path of a level 3 fsf
+        level (int): level of analysis
+    Returns:
+        dictionary with 'work' (relative amount of computation: voxels x timepoints x regressors at level 1, voxels x
+        inputs x copes at level 2 and inputs at level 3) and 'data_mb' (size of the data the job loads at once, as
+        float32), or None if the size could not be read
+    """
+    try:
+        if level == 3:
+            if isinstance(job, list):
+                return None
+            settings = fsf_utils.read_settings(job)
+            ninputs = float(settings.get('fmri(npts)', 0))
+            return {'work': ninputs, 'data_mb': 0.0} if ninputs > 0 else None
+
+        studydir = os.path.join(_get_arg(job, '--basedir'), _get_arg(job, '--studyid'))
+        sub = _get_arg(job, '--sub')
+        ses = _get_arg(job, '--ses')
+        task = _get_arg(job, '--taskname')
+        runs = [_get_arg(job, '--runname')] if level == 1 else _get_list_arg(job, '--runs')
+        if len(runs) == 0:
+            return None
+        header = _get_func_header(studydir, sub, ses, task, runs[0])
+        if header is None:
+            return None
+        voxels = 1
+        for dim in header.dims[:3]:
+            voxels *= dim
+        spec = model_spec.get_model_spec(_get_arg(job, '--studyid'), _get_arg(job, '--basedir'),
+                                         _get_arg(job, '--modelname', _get_arg(job, '-m')))
+        if level == 1:
+            conditions = spec.get_conditions(task) or {}
+            nregressors = len(conditions) + spec.get_num_confounds() + 1
+            return {'work': float(voxels) * header.npts * nregressors,
+                    'data_mb': voxels * header.npts * 4 / 1048576.0}
+        ncopes = spec.get_ncopes(task) or 1
+        return {'work': float(voxels) * len(runs) * ncopes, 'data_mb': voxels * len(runs) * 4 / 1048576.0}
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    k = (len(values) - 1) * percentile / 100.0
+    lower = int(math.floor(k))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def fit_rates(studydir, level):
+    """Fits the time and memory of a level to the jobs of the study that succeeded before
+
+    Args:
+        studydir (str): path of parent directory of fmriprep directory (basedir + studyid)
+        level (int): level of analysis
+    Returns:
+        dictionary with 'seconds_per_work' and 'mb_per_data_mb' (None if fewer than MIN_HISTORY jobs recorded them)
+        and 'njobs' (number of earlier jobs whose size could be read)
+    """
+    time_rates = []
+    mem_rates = []
+    for record in job_state.open_store(studydir).get_records(level):
+        if record.get('state') != job_state.SUCCEEDED or 'job' not in record:
+            continue
+        size = get_job_size(record['job'], level)
+        if size is None or size['work'] <= 0:
+            continue
+        if record.get('runtime'):
+            time_rates.append(record['runtime'] / size['work'])
+        if record.get('max_rss_mb') and size['data_mb'] > 0:
+            mem_rates.append(max(0.0, record['max_rss_mb'] - BASE_MEM) / size['data_mb'])
+    rates = {'seconds_per_work': None, 'mb_per_data_mb': None, 'njobs': len(time_rates)}
+    if len(time_rates) >= MIN_HISTORY:
+        rates['seconds_per_work'] = _percentile(time_rates, RATE_PERCENTILE) * TIME_MARGIN
+    if len(mem_rates) >= MIN_HISTORY:
+        rates['mb_per_data_mb'] = _percentile(mem_rates, RATE_PERCENTILE) * MEM_MARGIN
+    return rates
+
+
+def _round_mem(mem):
+    return int(max(MIN_MEM, math.ceil(mem / float(MEM_STEP)) * MEM_STEP))
+
+
+def predict_resources(jobs, level, time, mem):
+    """Predicts the time and memory of each job
+
+    Args:
+        jobs (list): jobs of one level (see get_job_size)
+        level (int): level of analysis
+        time (str): time limit given on the command line (hh:mm:ss); without history, it is the time of a job of
+            median size, and it is used as is for jobs whose size could not be read
+        mem (int): memory given on the command line (MB), used for jobs whose size could not be read
+    Returns:
+        list with a dictionary for each job: 'time' (seconds), 'mem' (MB), 'expected' (predicted runtime in seconds,
+        without the safety margin) and 'source' ('history', 'size' or 'default')
+    """
+    sizes = [get_job_size(job, level) for job in jobs]
+    studydirs = set(job_state.get_job_output(job, level)[0] for job in jobs)
+    rates = {'seconds_per_work': None, 'mb_per_data_mb': None}
+    if len(studydirs) == 1:
+        rates = fit_rates(studydirs.pop(), level)
+
+    works = [size['work'] for size in sizes if size is not None and size['work'] > 0]
+    median_work = _percentile(works, 50) if len(works) > 0 else 0
+    default_time = slurm_utils.parse_time(time)
+
+    predictions = []
+    for size in sizes:
+        if size is None or size['work'] <= 0:
+            predictions.append({'time': default_time, 'mem': mem, 'expected': default_time, 'source': 'default'})
+            continue
+        if rates['seconds_per_work'] is not None:
+            expected = rates['seconds_per_work'] / TIME_MARGIN * size['work']
+            job_time = rates['seconds_per_work'] * size['work']
+            source = 'history'
+        else:
+            job_time = default_time * size['work'] / median_work
+            expected = job_time
+            source = 'size'
+        if rates['mb_per_data_mb'] is not None:
+            job_mem = BASE_MEM + rates['mb_per_data_mb'] * size['data_mb']
+        elif size['data_mb'] > 0:
+            job_mem = BASE_MEM + MEM_PER_DATA_MB * size['data_mb']
+        else:
+            job_mem = mem
+        predictions.append({'time': max(MIN_TIME, int(math.ceil(job_time))), 'mem': _round_mem(job_mem),
+                            'expected': expected, 'source': source})
+    return predictions
+
+
+def _round_time(seconds):
+    k = max(0, int(math.ceil(math.log(max(seconds, MIN_TIME) / float(MIN_TIME), TIME_STEP) - 1e-9)))
+    return int(math.ceil(MIN_TIME * TIME_STEP ** k / 60.0)) * 60
+
+
+def _reserved(size_class):
+    # MB-seconds reserved by a size class if each job gets the limits of the class
+    return len(size_class['indices']) * size_class['time'] * size_class['mem']
+
+
+def get_size_classes(predictions, max_classes=3):
+    """Groups jobs into size classes with shared time and memory limits
+
+    Each job is first put in the class of its time (rounded up to MIN_TIME * TIME_STEP ** k) and memory. While there are
+    more than max_classes classes, the two classes next to each other (by time) whose merge reserves the least extra
+    memory x time are merged.
+
+    Args:
+        predictions (list): predictions of the jobs (see predict_resources)
+        max_classes (int): maximum number of size classes
+    Returns:
+        list of dictionaries with 'indices' (indices of the jobs of the class), 'time' (seconds) and 'mem' (MB), from
+        the shortest to the longest class
+    """
+    classes = {}
+    for i, prediction in enumerate(predictions):
+        key = (_round_time(prediction['time']), prediction['mem'])
+        classes.setdefault(key, []).append(i)
+    size_classes = [{'indices': indices, 'time': key[0], 'mem': key[1]} for key, indices in sorted(classes.items())]
+    while len(size_classes) > max(1, max_classes):
+        best = None
+        for k in range(len(size_classes) - 1):
+            a, b = size_classes[k], size_classes[k + 1]
+            merged = {'indices': a['indices'] + b['indices'], 'time': max(a['time'], b['time']),
+                      'mem': max(a['mem'], b['mem'])}
+            extra = _reserved(merged) - _reserved(a) - _reserved(b)
+            if best is None or extra < best[0]:
+                best = (extra, k, merged)
+        extra, k, merged = best
+        size_classes[k:k + 2] = [merged]
+    for size_class in size_classes:
+        size_class['indices'].sort()
+    return size_classes
+
+
+def print_projection(size_classes, predictions, time, jobs_per_task=1, cpus_per_task=1):
+    """Prints the limits of each size class and the projected core-hours
+
+    Args:
+        size_classes (list): see get_size_classes
+        predictions (list): see predict_resources
+        time (str): time limit given on the command line, to compare with
+        jobs_per_task (int): number of jobs run by each array task
+        cpus_per_task (int): number of CPUs of each array task
+    Returns:
+        tuple of the core-hours reserved by the time limits of the size classes and the expected core-hours
+    """
+    sources = [prediction['source'] for prediction in predictions]
+    print('\nPredicted the resources of %d jobs (%d from earlier runtimes, %d from their size, %d with the defaults)'
+          % (len(predictions), sources.count('history'), sources.count('size'), sources.count('default')))
+    reserved = 0.0
+    for k, size_class in enumerate(size_classes):
+        njobs = len(size_class['indices'])
+        ntasks = slurm_utils.get_num_tasks(njobs, jobs_per_task)
+        task_time = slurm_utils.get_task_time(slurm_utils.format_time(size_class['time']), jobs_per_task,
+                                              cpus_per_task)
+        reserved += ntasks * cpus_per_task * slurm_utils.parse_time(task_time) / 3600.0
+        print('\tSize class %d: %d jobs, time limit %s, memory %d MB' % (
+            k + 1, njobs, slurm_utils.format_time(size_class['time']), size_class['mem']))
+    expected = sum(prediction['expected'] for prediction in predictions) / 3600.0
+    default = len(predictions) * slurm_utils.parse_time(time) / 3600.0
+    print('Projected core-hours: %.1f reserved by the time limits, %.1f expected (%.1f with --time %s for every job)'
+          % (reserved, expected, default, time))
+    return reserved, expected
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Resubmits the jobs of a run that failed because they ran out of memory or time, with more memory or time
+The jobs of a run are read from the job manifests in its sbatch output directory (e.g. level1-feat_<date>), which also
+hold the time and memory each job was given. The state of each job is read from the state store (see job_state.py) and,
+for jobs run by slurm, from sacct. Without sacct, the exit code and peak memory recorded for the job are used instead.
+Each failure is classified as 'oom', 'timeout' or 'other'; jobs that ran out of memory get --mem-factor times more
+memory and jobs that ran out of time --time-factor times more time, up to --max-mem and --max-time. Other failures (e.g.
+an error in the fsf) are not fixed by more resources, so they are only resubmitted with --retry-other.
+The resubmitted jobs are saved to the same output directory (jobs_retry-<round>_<k>.jsonl), so running this script
+again on it escalates their resources further, up to --max-retries retries.
+"""
+
+import argparse
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+import job_manifest
+import job_state
+import local_executor
+import slurm_utils
+
+OOM = 'oom'
+TIMEOUT = 'timeout'
+OTHER = 'other'
+
+# exit codes of a job killed by the kernel's OOM killer (SIGKILL, as a signal or through a shell), and of a job that hit
+# a time limit (timeout(1), or SIGXCPU from a CPU time limit)
+OOM_EXIT_CODES = [-9, 137]
+TIMEOUT_EXIT_CODES = [124, -24, 152]
+# without sacct, a job that failed after using this fraction of its memory is assumed to have run out of memory
+OOM_RSS_FRACTION = 0.95
+MEM_STEP = 256  # escalated memory is rounded up to a multiple of this (MB)
+
+_RETRY_ROUND = re.compile(r'_retry-(\d+)')
+_SACCT_MEM = re.compile(r'^([\d.]+)([KMGT]?)$')
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Resubmit the jobs of a run that ran out of memory or time')
+
+    parser.add_argument('--outputdir', dest='outputdir',
+                        required=True, help='sbatch output directory of the run (e.g. <studyid>/level1-feat_<date>)')
+    parser.add_argument('-e', '--email', dest='email',
+                        required=True, help='Email to send job updates to')
+    parser.add_argument('-A', '--account', dest='account',
+                        required=True, help='Slurm account')
+    parser.add_argument('-N', '--nodes', dest='nodes', type=int,
+                        default=1, help='Number of nodes')
+    parser.add_argument('-t', '--time', dest='time',
+                        default="02:00:00", help='Time limit the jobs were given, if it wasn\'t saved in their job '
+                                                 'manifest - hh:mm:ss')
+    parser.add_argument('-M', '--mem', dest='mem', type=int,
+                        default=1024, help='Memory the jobs were given in MB, if it wasn\'t saved in their job '
+                                           'manifest. Defaults to 1024 MB.')
+    parser.add_argument('--mem-factor', dest='mem_factor', type=float,
+                        default=2.0, help='Factor the memory of jobs that ran out of memory is multiplied by. '
+                                          'Defaults to 2.')
+    parser.add_argument('--time-factor', dest='time_factor', type=float,
+                        default=2.0, help='Factor the time limit of jobs that ran out of time is multiplied by. '
+                                          'Defaults to 2.')
+    parser.add_argument('--max-mem', dest='max_mem', type=int,
+                        default=32768, help='Maximum memory of a job in MB. Defaults to 32768 MB.')
+    parser.add_argument('--max-time', dest='max_time',
+                        default="24:00:00", help='Maximum time limit of a job - hh:mm:ss. Defaults to 24:00:00.')
+    parser.add_argument('--max-retries', dest='max_retries', type=int,
+                        default=3, help='Maximum number of times a job is retried. Defaults to 3.')
+    parser.add_argument('--retry-other', dest='retry_other', action='store_true',
+                        default=False, help='Also resubmit the jobs that failed for other reasons, with the same '
+                                            'resources')
+    parser.add_argument('--max-array-size', dest='max_array_size', type=int,
+                        default=None, help='Maximum number of tasks of each job array; larger arrays are split into '
+                                           'arrays that run one after the other. Defaults to the MaxArraySize of the '
+                                           'cluster.')
+    parser.add_argument('--array-throttle', dest='array_throttle', type=int,
+                        default=0, help='Maximum number of array tasks that run at the same time (%%N). Defaults to 0 '
+                                        '(no limit).')
+    parser.add_argument('--local', dest='local', action='store_true',
+                        default=False, help='Run the jobs on this machine even if sbatch is available')
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def _get_retry_round(manifest_path):
+    match = _RETRY_ROUND.search(os.path.basename(manifest_path))
+    return int(match.group(1)) if match is not None else 0
+
+
+def find_manifests(outputdir):
+    """Returns the paths of the job manifests under outputdir, the original ones first and then by retry round"""
+    manifests = []
+    for dirpath, dirnames, filenames in os.walk(outputdir):
+        for filename in filenames:
+            if filename.startswith('jobs') and filename.endswith('.jsonl'):
+                manifests.append(os.path.join(dirpath, filename))
+    return sorted(manifests, key=lambda path: (_get_retry_round(path), path))
+
+
+def get_attempts(outputdir, time, mem):
+    """Gets the latest attempt of each job of a run
+
+    Args:
+        outputdir (str): sbatch output directory of the run
+        time (str): time limit of the jobs whose manifest didn't save it
+        mem (int): memory of the jobs whose manifest didn't save it
+    Returns:
+        dictionary with the output directory of each job (.feat or .gfeat) as keys and dictionaries with 'job', 'level',
+        'time' and 'mem' (resources of its latest attempt) and 'attempts' (number of times it was submitted) as values
+    """
+    attempts = {}
+    for manifest_path in find_manifests(outputdir):
+        header = job_manifest.read_header(manifest_path)
+        for job in job_manifest.read_jobs(manifest_path):
+            featdir = job_state.get_job_output(job, header['level'])[1]
+            attempt = attempts.setdefault(featdir, {'job': job, 'level': header['level'], 'attempts': 0})
+            attempt['time'] = header.get('time', time)
+            attempt['mem'] = header.get('mem', mem)
+            attempt['attempts'] += 1
+    return attempts
+
+
+def _parse_sacct_mem(value):
+    # MaxRSS of sacct (e.g. 1234K, 512M, 1.5G) in MB
+    match = _SACCT_MEM.match(value.strip())
+    if match is None:
+        return None
+    factor = {'': 1.0 / 1048576, 'K': 1.0 / 1024, 'M': 1.0, 'G': 1024.0, 'T': 1048576.0}[match.group(2)]
+    return float(match.group(1)) * factor
+
+
+def query_sacct(slurm_job_ids):
+    """Gets the final state of slurm jobs (or array tasks) from sacct
+
+    Args:
+        slurm_job_ids (list): IDs of the jobs (e.g. 1234_5 for an array task)
+    Returns:
+        dictionary with the IDs as keys and dictionaries with 'states' (states of the job and its steps, e.g.
+        OUT_OF_MEMORY or TIMEOUT) and 'max_rss_mb' as values; empty if sacct is not available
+    """
+    slurm_job_ids = sorted(set(slurm_job_ids))
+    if len(slurm_job_ids) == 0 or shutil.which('sacct') is None:
+        return {}
+    rows = {}
+    for k in range(0, len(slurm_job_ids), 500):
+        try:
+            output = subprocess.check_output(['sacct', '-n', '-P', '-o', 'JobID,State,MaxRSS', '-j',
+                                              ','.join(slurm_job_ids[k:k + 500])], universal_newlines=True)
+        except subprocess.CalledProcessError as e:
+            print("WARNING: sacct failed with exit code %d, the exit codes recorded for the jobs are used instead" %
+                  e.returncode)
+            return {}
+        for line in output.splitlines():
+            fields = line.split('|')
+            if len(fields) < 3:
+                continue
+            row = rows.setdefault(fields[0].split('.')[0], {'states': [], 'max_rss_mb': None})
+            row['states'].append(fields[1].split(' ')[0])
+            max_rss_mb = _parse_sacct_mem(fields[2]) if fields[2] != '' else None
+            if max_rss_mb is not None:
+                row['max_rss_mb'] = max(row['max_rss_mb'] or 0, max_rss_mb)
+    return rows
+
+
+def classify_failure(record, sacct_row, mem, time):
+    """Classifies why a job failed
+
+    Args:
+        record (dict): state of the job recorded in the state store (None if it was never recorded)
+        sacct_row (dict): state of its slurm job (see query_sacct), or None
+        mem (int): memory the job was given in MB
+        time (str): time limit the job was given
+    Returns:
+        OOM, TIMEOUT or OTHER
+    """
+    if sacct_row is not None:
+        if 'OUT_OF_MEMORY' in sacct_row['states']:
+            return OOM
+        if 'TIMEOUT' in sacct_row['states'] or 'DEADLINE' in sacct_row['states']:
+            return TIMEOUT
+        # older versions of slurm report jobs killed by the OOM killer as FAILED
+        if (sacct_row['max_rss_mb'] or 0) >= OOM_RSS_FRACTION * mem:
+            return OOM
+    if record is None:
+        return OTHER
+    # local stand-in for sacct: the exit code and the usage recorded when the job finished
+    exit_code = record.get('exit_code')
+    if exit_code in OOM_EXIT_CODES or (record.get('max_rss_mb') or 0) >= OOM_RSS_FRACTION * mem:
+        return OOM
+    if exit_code in TIMEOUT_EXIT_CODES or (record.get('runtime') or 0) >= slurm_utils.parse_time(time):
+        return TIMEOUT
+    return OTHER
+
+
+def get_failed_jobs(attempts):
+    """Gets the jobs of a run that failed and why
+
+    Args:
+        attempts (dict): see get_attempts
+    Returns:
+        list of the attempts of the failed jobs, each with 'featdir' and 'reason' added
+    """
+    failed = []
+    for featdir, attempt in sorted(attempts.items()):
+        status, featdir = job_state.get_job_status(attempt['job'], attempt['level'])
+        # jobs that were killed by slurm are left as running in the state store, so they are found as missing or
+        # failed once their slurm job is gone
+        if status in ['failed', 'missing']:
+            studydir = job_state.get_job_output(attempt['job'], attempt['level'])[0]
+            failed.append(dict(attempt, featdir=featdir, record=job_state.open_store(studydir).get(featdir)))
+    sacct_rows = query_sacct([attempt['record']['slurm_job_id'] for attempt in failed
+                              if attempt['record'] is not None and attempt['record'].get('slurm_job_id')])
+    for attempt in failed:
+        record = attempt['record']
+        sacct_row = sacct_rows.get(record.get('slurm_job_id')) if record is not None else None
+        attempt['reason'] = classify_failure(record, sacct_row, attempt['mem'], attempt['time'])
+    return failed
+
+
+def escalate(failed, mem_factor, time_factor, max_mem, max_time, max_retries, retry_other=False):
+    """Gets the resources each failed job is retried with
+
+    Args:
+        failed (list): see get_failed_jobs
+        mem_factor (float): factor the memory of jobs that ran out of memory is multiplied by
+        time_factor (float): factor the time limit of jobs that ran out of time is multiplied by
+        max_mem (int): maximum memory of a job in MB
+        max_time (str): maximum time limit of a job
+        max_retries (int): maximum number of times a job is retried
+        retry_other (bool): whether jobs that failed for other reasons are retried with the same resources
+    Returns:
+        tuple of the list of the jobs to retry (the failed jobs with their new 'time' and 'mem') and the list of
+        (failed job, reason) of the jobs that are not retried
+    """
+    max_seconds = slurm_utils.parse_time(max_time)
+    retries = []
+    skipped = []
+    for attempt in failed:
+        time = slurm_utils.parse_time(attempt['time'])
+        mem = attempt['mem']
+        if attempt['attempts'] > max_retries:
+            skipped.append((attempt, 'already retried %d times' % (attempt['attempts'] - 1)))
+            continue
+        if attempt['reason'] == OOM:
+            if mem >= max_mem:
+                skipped.append((attempt, 'already has the maximum memory (%d MB)' % max_mem))
+                continue
+            mem = min(max_mem, int(math.ceil(mem * mem_factor / MEM_STEP)) * MEM_STEP)
+        elif attempt['reason'] == TIMEOUT:
+            if time >= max_seconds:
+                skipped.append((attempt, 'already has the maximum time (%s)' % max_time))
+                continue
+            time = min(max_seconds, int(math.ceil(time * time_factor / 60.0)) * 60)
+        elif not retry_other:
+            skipped.append((attempt, 'failed for another reason (pass --retry-other to retry it anyway)'))
+            continue
+        retries.append(dict(attempt, time=slurm_utils.format_time(time), mem=mem))
+    return retries, skipped
+
+
+def get_retry_groups(retries):
+    """Groups the jobs to retry by level, time and memory (one job array each)
+
+    Returns:
+        list of (level, time, mem, jobs), by level
+    """
+    groups = {}
+    for retry in retries:
+        key = (retry['level'], slurm_utils.parse_time(retry['time']), retry['mem'])
+        groups.setdefault(key, []).append(retry['job'])
+    return [(level, slurm_utils.format_time(seconds), mem, jobs)
+            for (level, seconds, mem), jobs in sorted(groups.items())]
+
+
+def main(argv=None):
+    args = parse_command_line(argv)
+    outputdir = os.path.abspath(args.outputdir)
+
+    if not os.path.isdir(outputdir):
+        print("ERROR: %s does not exist" % outputdir)
+        sys.exit(-1)
+    error = slurm_utils.check_array_options(args.max_array_size, args.array_throttle)
+    if error is None and (args.mem_factor < 1 or args.time_factor < 1):
+        error = '--mem-factor and --time-factor must be at least 1'
+    if error is not None:
+        print("ERROR: %s" % error)
+        sys.exit(-1)
+
+    attempts = get_attempts(outputdir, args.time, args.mem)
+    if len(attempts) == 0:
+        print("ERROR: No job manifests (jobs*.jsonl) were found in %s" % outputdir)
+        sys.exit(-1)
+    failed = get_failed_jobs(attempts)
+    reasons = [attempt['reason'] for attempt in failed]
+    print('\n%d of %d jobs failed: %d ran out of memory, %d ran out of time, %d failed for other reasons' % (
+        len(failed), len(attempts), reasons.count(OOM), reasons.count(TIMEOUT), reasons.count(OTHER)))
+
+    retries, skipped = escalate(failed, args.mem_factor, args.time_factor, args.max_mem, args.max_time,
+                                args.max_retries, args.retry_other)
+    for attempt, reason in skipped:
+        print('WARNING: Not retrying %s (%s): it %s' % (attempt['featdir'], attempt['reason'], reason))
+    # a job can only be retried once the jobs of the levels below it succeeded, so only the lowest level is retried
+    levels = sorted(set(retry['level'] for retry in retries))
+    if len(levels) > 1:
+        print('NOTE: Only retrying the level %d jobs; run retry_jobs.py again once they have finished, or use '
+              'run_pipeline.py --resume' % levels[0])
+        retries = [retry for retry in retries if retry['level'] == levels[0]]
+    if len(retries) == 0:
+        print('Nothing to retry.')
+        return
+
+    groups = get_retry_groups(retries)
+    for level, time, mem, jobs in groups:
+        print('\tLevel %d: %d jobs with time limit %s and memory %d MB' % (level, len(jobs), time, mem))
+
+    # feat doesn't overwrite the partial outputs of the failed jobs
+    existing_outputs = [retry['featdir'] for retry in retries if os.path.exists(retry['featdir'])]
+    if len(existing_outputs) > 0:
+        rsp = None
+        while rsp != 'y' and rsp != '':
+            rsp = input('Do you want to remove the feat dirs of the failed jobs? (y/ENTER) ')
+        if rsp == 'y':
+            for featdir in existing_outputs:
+                print('Removing %s' % featdir)
+                shutil.rmtree(featdir)
+    rsp = None
+    while rsp != '':
+        rsp = input('Press ENTER to continue:')
+
+    retry_round = max(_get_retry_round(path) for path in find_manifests(outputdir)) + 1
+    fmripipelinedir = os.path.dirname(os.path.abspath(__file__))
+    for k, (level, time, mem, jobs) in enumerate(groups):
+        suffix = '_retry-%d_%d' % (retry_round, k + 1)
+        manifest_path = job_manifest.write_manifest(outputdir, jobs, level, 'jobs%s.jsonl' % suffix, time, mem)
+        if args.local or shutil.which('sbatch') is None:
+            if not args.local:
+                print("\nNOTE: sbatch command was not found. Running the jobs on this machine now...\n")
+            exitcodes = local_executor.run_feat_jobs(jobs, level, outputdir, mem)
+            print('%d of %d jobs succeeded' % (list(exitcodes.values()).count(0), len(exitcodes)))
+            continue
+        sbatch_path = os.path.join(outputdir, 'run_level%d%s.sbatch' % (level, suffix))
+        output = os.path.join(outputdir, 'level%d-feat%s_%%a.o' % (level, suffix))
+        command = "python %s --manifest %s -i %s --level %d" % (
+            os.path.join(fmripipelinedir, 'run_feat_job.py'), manifest_path, slurm_utils.ARRAY_TASK_INDEX, level)
+        slurm_utils.write_sbatch(sbatch_path, 'level%d-feat-retry' % level, args.account, args.nodes, time, mem,
+                                 args.email, len(jobs), output, command)
+        try:
+            task_ids = slurm_utils.submit_array(sbatch_path, len(jobs), args.max_array_size, args.array_throttle,
+                                                output=output)
+        except subprocess.CalledProcessError as e:
+            print("ERROR: sbatch failed with exit code %d" % e.returncode)
+            sys.exit(-1)
+        print('Submitted batch job %s' % ' '.join(sorted(set(task_id.split('_')[0] for task_id in task_ids))))
+        job_state.record_queued(jobs, level, task_ids)
+    print('Saving sbatch output to %s' % outputdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,53 +1,315 @@
 """Calls mk_level1_fsf_bbr, mk_level2_fsf, mk_level3_fsf to create a particular fsf or call feat The feat created is
-determined by the parameters in jobs[i], where jobs is a dictionary and i is the key of the job to run """
+determined by the parameters in jobs[i], where jobs is a dictionary and i is the key of the job to run
+Job arrays pass a job manifest (see job_manifest.py) instead of the jobs dictionary, and only job i is read from it
+With --jobs-per-task K, i is the index of an array task that runs jobs i*K to i*K+K-1 of the manifest, --cpus-per-task
+at a time, and reports the exit code of each job
+The state of each job that calls feat is recorded in the state store of the study (see job_state.py) and the runtime
+metrics of its commands in the metrics store (see job_metrics.py) """
 
 # Created by Alice Xue, 06/2018
 
 import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import io
 import json
+import os
 import subprocess
 import sys
+import time
+import traceback
 
+import job_manifest
+import job_metrics
+import job_state
 import mk_level1_fsf_bbr
 import mk_level2_fsf
+import mk_level3_fsf
+import study_catalog
+
+# argument parsers of mk_level1_fsf_bbr, mk_level2_fsf and mk_level3_fsf, keyed by level
+_parsers = {}
+_get_parsers = {1: mk_level1_fsf_bbr.get_parser, 2: mk_level2_fsf.get_parser, 3: mk_level3_fsf.get_parser}
 
 
 def parse_command_line(argv):
     parser = argparse.ArgumentParser(description='get_jobs')
-    parser.add_argument('--jobs', dest='jobs', type=json.loads,
-                        required=True,
-                        help='JSON object in a string where the keys are indices for slurm job arrays and keys are the '
-                             'jobs to run in a subprocess.')
+    jobs_group = parser.add_mutually_exclusive_group(required=True)
+    jobs_group.add_argument('--jobs', dest='jobs', type=json.loads,
+                            help='JSON object in a string where the keys are indices for slurm job arrays and keys are '
+                                 'the jobs to run in a subprocess.')
+    jobs_group.add_argument('--manifest', dest='manifest',
+                            help='Path of a job manifest (jobs.jsonl) written by run_level1/2/3.py')
     parser.add_argument('-i', '--jobtorun', dest='i',
                         required=True, help='Key (index) of job to run')
     parser.add_argument('--level', dest='level', type=int,
                         required=True, help='Analysis of level')
+    parser.add_argument('--jobs-per-task', dest='jobs_per_task', type=int,
+                        default=None, help='With --manifest, run jobs i*K to i*K+K-1 (where K is this number) instead '
+                                           'of job i')
+    parser.add_argument('--cpus-per-task', dest='cpus_per_task', type=int,
+                        default=1, help='With --jobs-per-task, number of jobs to run at the same time')
     args = parser.parse_args(argv)
     return args
 
 
+def make_fsf(job, level):
+    """Creates the fsf of a job in this process, without calling feat
+
+    Args:
+        job (list): arguments for mk_level1_fsf_bbr, mk_level2_fsf or mk_level3_fsf
+        level (int): level of analysis
+    Returns:
+        tuple of the path of the fsf (None if it could not be created; the last fsf if a level 3 job creates several),
+        the commands that --callfeat would run (list of argument lists) and everything the job printed
+    """
+    # the argument parser of each level is only built once per process
+    if level not in _parsers:
+        _parsers[level] = _get_parsers[level]()
+    log = io.StringIO()
+    outfilename = None
+    feat_commands = []
+    with contextlib.redirect_stdout(log):
+        try:
+            args = _parsers[level].parse_args([arg for arg in job if arg != '--callfeat'])
+            if level == 1:
+                outfilename = mk_level1_fsf_bbr.mk_level1_fsf_bbr(args, feat_commands)
+            elif level == 2:
+                outfilename = mk_level2_fsf.mk_level2_fsf(args, feat_commands)
+            else:
+                fsfs = mk_level3_fsf.mk_level3_fsf(args, feat_commands)
+                outfilename = fsfs[-1] if len(fsfs) > 0 else None
+        except SystemExit:  # the mk_*_fsf scripts exit after printing an ERROR
+            pass
+        except Exception:
+            traceback.print_exc(file=log)
+    return outfilename, feat_commands, log.getvalue()
+
+
+def _make_fsf_chunk(jobs, level):
+    results = [make_fsf(job, level) for job in jobs]
+    # worker processes don't run atexit handlers, so the header cache updates are written here
+    study_catalog.commit_catalogs()
+    return results
+
+
+def _make_fsfs(jobs, level, nworkers):
+    """Creates the fsf's of many jobs and prints the warnings and errors; returns the results of make_fsf"""
+    if level not in [1, 2, 3]:
+        print("%d is an invalid level of analysis" % level)
+        sys.exit(-1)
+    nworkers = max(1, min(nworkers, len(jobs)))
+    if nworkers == 1:
+        results = _make_fsf_chunk(jobs, level)
+    else:
+        # a few chunks per worker, so that a slow chunk doesn't leave the other workers idle
+        chunksize = max(1, len(jobs) // (nworkers * 4))
+        chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+        study_catalog.commit_catalogs()
+        with ProcessPoolExecutor(max_workers=nworkers, initializer=study_catalog.forget_catalogs) as pool:
+            results = [result for chunk_results in pool.map(_make_fsf_chunk, chunks, [level] * len(chunks))
+                       for result in chunk_results]
+
+    failed = []
+    for job, (outfilename, feat_commands, output) in zip(jobs, results):
+        if outfilename is None:
+            failed.append((job, output))
+            continue
+        for line in output.splitlines():
+            if 'WARNING' in line or 'ERROR' in line:
+                print(line)
+    if len(failed) > 0:
+        print('ERROR: Could not create the fsf\'s of %d jobs:' % len(failed))
+        for job, output in failed:
+            print('\t' + ' '.join(job))
+            print('\t\t' + output.strip().replace('\n', '\n\t\t'))
+    return results
+
+
+def make_fsfs(jobs, level, nworkers=1):
+    """Creates the fsf's of many level 1 or level 2 jobs without starting a python process per job
+
+    The stubs and model files are read once per process instead of once per fsf. Only the warnings and errors that
+    the jobs print are shown.
+
+    Args:
+        jobs (list): list of argument lists for mk_level1_fsf_bbr or mk_level2_fsf
+        level (int): 1 or 2
+        nworkers (int): number of processes; if 1, all fsf's are created in this process
+    Returns:
+        list of the paths of the fsf's that were created
+    """
+    return [outfilename for outfilename, feat_commands, output in _make_fsfs(jobs, level, nworkers)
+            if outfilename is not None]
+
+
+def get_feat_commands(jobs, level, nworkers=1):
+    """Gets the commands that run feat for each job, creating the fsf's of level 1 and level 2 jobs in a batch
+
+    Args:
+        jobs (list): list of argument lists for mk_level1_fsf_bbr, mk_level2_fsf or mk_level3_fsf, or list of paths of
+            fsf's (level 3)
+        level (int): level of analysis
+        nworkers (int): number of processes that create the fsf's
+    Returns:
+        list with the commands of each job (list of argument lists, run one after the other), or None for the jobs
+        whose fsf could not be created
+    """
+    if level == 3 and all(not isinstance(job, list) for job in jobs):
+        return [[['feat', job]] for job in jobs]
+    return [feat_commands if outfilename is not None else None
+            for outfilename, feat_commands, output in _make_fsfs(jobs, level, nworkers)]
+
+
+def run_job(job, level, usages=None):
+    """Creates the fsf of a level 1 or level 2 job (calling feat if the job says so) or calls feat on a level 3 fsf
+
+    Args:
+        job: list of arguments for mk_level1_fsf_bbr, mk_level2_fsf or mk_level3_fsf, or path of a level 3 fsf
+        level (int): level of analysis
+        usages (list): if a list is given, the usage of each command that is run is added to it (see job_metrics.py)
+    Returns:
+        exit code of the job (not 0 if one of its commands failed)
+    """
+    if level == 1 or level == 2:
+        module = mk_level1_fsf_bbr if level == 1 else mk_level2_fsf
+        args = module.parse_command_line(job)
+        print(args)
+        # the fsf is created without calling feat, so that the exit codes of the commands can be returned
+        callfeat = args.callfeat
+        args.callfeat = False
+        feat_commands = []
+        if level == 1:
+            mk_level1_fsf_bbr.mk_level1_fsf_bbr(args, feat_commands)  # create fsf
+        else:
+            mk_level2_fsf.mk_level2_fsf(args, feat_commands)  # create fsf
+        if not callfeat:
+            return 0
+    elif isinstance(job, list):
+        # job is a list of arguments for mk_level3_fsf (the level 3 jobs of run_pipeline.py), so the fsf's are
+        # created now, once the level 2 outputs exist
+        feat_commands = []
+        mk_level3_fsf.mk_level3_fsf(mk_level3_fsf.parse_command_line(job), feat_commands)
+    else:
+        # the fsf's were created in run_level3 when mk_all_level3_fsf was called
+        feat_commands = [['feat', job]]
+    exitcode = 0
+    for args in feat_commands:
+        print('Calling', ' '.join(args))  # call feat on fsf's specified in jobs
+        sys.stdout.flush()
+        command_exitcode, usage = job_metrics.run(args)
+        if usages is not None:
+            usages.append(usage)
+        exitcode = command_exitcode or exitcode
+        if exitcode != 0 and level != 3:  # e.g. feat isn't run if fslmaths failed
+            break
+    return exitcode
+
+
+def run_and_record_job(job, level):
+    """Runs a job with run_job and records its state (see job_state.py) if it calls feat
+
+    Returns:
+        exit code of the job
+    """
+    callfeat = level == 3 or '--callfeat' in job
+    if callfeat:
+        job_state.record_running(job, level)
+    usages = []
+    try:
+        exitcode = run_job(job, level, usages)
+    except SystemExit as e:  # the mk_*_fsf scripts exit after printing an ERROR
+        exitcode = e.code if isinstance(e.code, int) else 1
+    if callfeat:
+        sys.stdout.flush()
+        usage = job_metrics.combine_usages(usages)
+        job_metrics.record_job(job, level, exitcode, usage)
+        exitcode = job_state.record_finished(job, level, exitcode, usage['max_rss_mb'] if usage is not None else None)
+    return exitcode
+
+
+def get_task_jobs(task_index, njobs, jobs_per_task):
+    """Returns the indices of the jobs run by an array task when each task runs jobs_per_task jobs"""
+    return list(range(task_index * jobs_per_task, min(njobs, (task_index + 1) * jobs_per_task)))
+
+
+def _run_job_process(manifest_path, i, level):
+    start = time.time()
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--manifest', manifest_path, '-i', str(i),
+                           '--level', str(level)],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    return proc.returncode, proc.stdout, time.time() - start
+
+
+def run_packed_jobs(manifest_path, task_index, level, jobs_per_task, cpus_per_task=1):
+    """Runs the jobs of one array task, each in its own process, cpus_per_task at a time
+
+    The output of each job is printed when the job finishes, followed by the exit code of every job.
+
+    Args:
+        manifest_path (str): path of jobs.jsonl
+        task_index (int): index of the array task ($SLURM_ARRAY_TASK_ID)
+        level (int): level of analysis
+        jobs_per_task (int): number of jobs run by each array task
+        cpus_per_task (int): number of jobs to run at the same time
+    Returns:
+        dictionary with the indices of the jobs as keys and their exit codes as values
+    """
+    njobs = job_manifest.read_header(manifest_path)['njobs']
+    indices = get_task_jobs(task_index, njobs, jobs_per_task)
+    if len(indices) == 0:
+        print("ERROR: Array task %d has no jobs: %s only has %d jobs" % (task_index, manifest_path, njobs))
+        sys.exit(-1)
+    print('Running jobs %d to %d, %d at a time' % (indices[0], indices[-1], cpus_per_task))
+    sys.stdout.flush()
+    exitcodes = {}
+    with ThreadPoolExecutor(max_workers=cpus_per_task) as pool:
+        futures = dict((pool.submit(_run_job_process, manifest_path, i, level), i) for i in indices)
+        for future in as_completed(futures):
+            i = futures[future]
+            exitcodes[i], output, duration = future.result()
+            print('\n=== Job %d (exit code %d, %.0f s) ===' % (i, exitcodes[i], duration))
+            print(output.rstrip())
+            sys.stdout.flush()
+    print('\nExit codes:')
+    for i in indices:
+        print('\tjob %d: %d' % (i, exitcodes[i]))
+    return exitcodes
+
+
 def main():
     args = parse_command_line(argv=None)
-    jobs = args.jobs
     i = args.i
     level = args.level
+    # only the planning process (run_level*.py, run_pipeline.py) writes to the study catalog
+    study_catalog.use_read_only_catalogs()
 
     if level not in [1, 2, 3]:
         print("%d is an invalid level of analysis" % level)
         sys.exit(-1)
 
-    if i in jobs.keys():
-        if level == 1:
-            mk_level1_fsf_bbr.main(argv=jobs[i])  # create fsf
-        elif level == 2:
-            mk_level2_fsf.main(argv=jobs[i])  # create fsf
-        elif level == 3:
-            args = ['feat', jobs[i]]
-            print('Calling', ' '.join(args))  # call feat on fsf's specified in jobs
-            # the fsf's were created in run_level3 when mk_all_level3_fsf was called
-            subprocess.call(args)
+    if args.jobs_per_task is not None:
+        if args.manifest is None:
+            print("ERROR: --jobs-per-task can only be used with --manifest")
+            sys.exit(-1)
+        if args.jobs_per_task < 1 or args.cpus_per_task < 1:
+            print("ERROR: --jobs-per-task and --cpus-per-task must be at least 1")
+            sys.exit(-1)
+        exitcodes = run_packed_jobs(args.manifest, int(i), level, args.jobs_per_task, args.cpus_per_task)
+        # the array task fails if any of its jobs failed
+        if any(exitcode != 0 for exitcode in exitcodes.values()):
+            sys.exit(1)
+    elif args.manifest is not None:
+        try:
+            job = job_manifest.read_job(args.manifest, int(i))
+        except (IndexError, ValueError, OSError) as e:
+            print("ERROR: Could not read job %s from %s: %s" % (i, args.manifest, e))
+            sys.exit(-1)
+        sys.exit(run_and_record_job(job, level))
+    elif i in args.jobs.keys():
+        sys.exit(run_and_record_job(args.jobs[i], level))
     else:
-        print("%d is not a key in the jobs dictionary: %s" % i)
+        print("%s is not a key in the jobs dictionary: %s" % (i, args.jobs))
         sys.exit(-1)
 
 
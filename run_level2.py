@@ -8,17 +8,21 @@ Runs the generated sbatch file
 
 import argparse
 import datetime
-from joblib import Parallel, delayed
 import inspect
 import json
-import multiprocessing
 import os
 import shutil
 import subprocess
 import sys
 
+import job_manifest
+import job_state
+import local_executor
 import get_level2_jobs
+import run_feat_job
 import setup_utils
+import slurm_utils
+import work_queue
 
 
 def parse_command_line(argv):
@@ -34,6 +38,22 @@ def parse_command_line(argv):
                         default=1, help='Number of nodes')
     parser.add_argument('-M', '--mem', dest='mem', type=int,
                         default=1024, help='Memory allocation in MB. Defaults to 1024 MB.')
+    parser.add_argument('--jobs-per-task', dest='jobs_per_task', type=int,
+                        default=1, help='Number of jobs to run in each array task. Defaults to 1.')
+    parser.add_argument('--max-array-size', dest='max_array_size', type=int,
+                        default=None, help='Maximum number of tasks of each job array; larger arrays are split into '
+                                           'arrays that run one after the other. Defaults to the MaxArraySize of the '
+                                           'cluster.')
+    parser.add_argument('--array-throttle', dest='array_throttle', type=int,
+                        default=0, help='Maximum number of array tasks that run at the same time (%%N). Defaults to 0 '
+                                        '(no limit).')
+    parser.add_argument('--cpus-per-task', dest='cpus_per_task', type=int,
+                        default=1, help='Number of CPUs of each array task (number of jobs it runs at the same time). '
+                                        'Defaults to 1.')
+    parser.add_argument('--queue-workers', dest='queue_workers', type=int,
+                        default=0, help='Number of workers that pull the jobs from a shared queue, instead of one '
+                                        'array task per job (see work_queue.py). Each worker is an array task that '
+                                        'runs --cpus-per-task jobs at a time. Defaults to 0 (no queue).')
     parser.add_argument('--studyid', dest='studyid',
                         required=True, help='Study ID')
     parser.add_argument('--basedir', dest='basedir',
@@ -42,6 +62,12 @@ def parse_command_line(argv):
                         default="", help='Full path of directory where sbatch output should be saved')
     parser.add_argument('--nofeat', dest='nofeat', action='store_true',
                         default=False, help='Only create the fsf\'s, don\'t call feat')
+    parser.add_argument('--fsf-workers', dest='fsf_workers', type=int,
+                        default=1, help='With --nofeat, number of processes that create the fsf\'s. Defaults to 1 '
+                                        '(all fsf\'s are created in this process).')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        default=False, help='Only run the jobs that failed or were never run, based on the states '
+                                            'recorded by earlier runs (see job_state.py)')
     parser.add_argument('-s', '--specificruns', dest='specificruns', type=json.loads,
                         default={}, help="""JSON object in a string that details which runs to create fsf's for. Ex: 
                         If there are sessions: \'{"sub-01": {"ses-01": {"flanker": ["1", "2"]}}, "sub-02": {"ses-01": 
@@ -57,13 +83,6 @@ def parse_command_line(argv):
     return args
 
 
-def call_feat_job(i, jobsdict, level):
-    fmripipelinedir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
-    subprocess.call(
-        ['python', os.path.join(fmripipelinedir, 'run_feat_job.py'), '--jobs', '%s' % json.dumps(jobsdict), '-i',
-         str(i), '--level', str(level)])
-
-
 def main(argv=None):
     level = 2
     d = datetime.datetime.now()
@@ -78,66 +97,88 @@ def main(argv=None):
     mem = args.mem
     specificruns = args.specificruns
     nofeat = args.nofeat
+    resume = args.resume
+    fsf_workers = args.fsf_workers
     outdir = args.outdir
+    jobs_per_task = args.jobs_per_task
+    cpus_per_task = args.cpus_per_task
+    queue_workers = args.queue_workers
+
+    max_array_size = args.max_array_size
+    array_throttle = args.array_throttle
+
+    error = slurm_utils.check_packing(jobs_per_task, cpus_per_task) or \
+        slurm_utils.check_array_options(max_array_size, array_throttle)
+    if error is None and queue_workers < 0:
+        error = '--queue-workers must be at least 0'
+    if error is None and queue_workers > 0 and jobs_per_task > 1:
+        error = '--jobs-per-task can\'t be used with --queue-workers, each worker runs --cpus-per-task jobs at a time'
+    if error is not None:
+        print("ERROR: %s" % error)
+        sys.exit(-1)
 
     studydir = os.path.join(basedir, studyid)
 
     sys_argv = sys.argv[:]  # copies over the arguments passed in through the command line
     # removes the arguments that shouldn't be passed into get_level2_jobs.main() (removes the arguments only relevant
     # to run_level2)
-    params_to_remove = ['--email', '-e', '-A', '--account', '-t', '--time', '-N', '--nodes', '--outdir', '-M', '--mem']
+    params_to_remove = ['--email', '-e', '-A', '--account', '-t', '--time', '-N', '--nodes', '--outdir', '-M', '--mem',
+                        '--fsf-workers', '--jobs-per-task', '--cpus-per-task', '--max-array-size', '--array-throttle',
+                        '--queue-workers']
     for param in params_to_remove:
         if param in sys_argv:
             i = sys_argv.index(param)
             del sys_argv[i]
             del sys_argv[i]
+    if '--resume' in sys_argv:
+        del sys_argv[sys_argv.index('--resume')]
     del sys_argv[0]
 
     print(sys_argv)
 
     # get the list of jobs to run
-    existing_feat_files, jobs = get_level2_jobs.main(argv=sys_argv[:])
-    if len(existing_feat_files) > 0:  # status = 1 means existing feat dirs were found, if status = 1, jobs is the
-        # number of jobs
+    if resume:
+        # plan every subject and task (get_level2_jobs only skips existing feat dirs without -s), then keep the jobs
+        # that failed or were never run
+        if '-s' not in sys_argv and '--specificruns' not in sys_argv:
+            mp_args = setup_utils.model_params_json_to_namespace(studyid, basedir, modelname)
+            sys_argv.append('-s')
+            sys_argv.append(json.dumps(mp_args.specificruns))
+        _, jobs, _ = get_level2_jobs.main(argv=sys_argv[:])
+        jobs, rerun_feat_files = job_state.get_resume_jobs(jobs, level)
+        if len(jobs) == 0:
+            print('Nothing to resume.')
+            return
+        prompt = 'Do you want to remove the feat dirs of the failed jobs? (y/ENTER) '
+    else:
+        _, jobs, rerun_feat_files = get_level2_jobs.main(argv=sys_argv[:])
+        prompt = 'Do you want to remove the existing feat dirs of the jobs that will be run again? (y/ENTER) '
+    # the up to date feat dirs are kept; feat doesn't overwrite the feat dirs of the jobs that are run again
+    if len(rerun_feat_files) > 0:
+        for feat_file in rerun_feat_files:
+            print('\t%s' % feat_file)
         rsp = None
         while rsp != 'y' and rsp != '':
-            rsp = input('Do you want to remove existing feat dirs? (y/ENTER) ')
+            rsp = input(prompt)
         if rsp == 'y':
-            for feat_file in existing_feat_files:
+            for feat_file in rerun_feat_files:
                 print('Removing %s' % feat_file)
                 if os.path.exists(feat_file):
                     shutil.rmtree(feat_file)
-            existing_feat_files, jobs = get_level2_jobs.main(argv=sys_argv[:])
-            # existing_feat_files should all have been removed
+            rerun_feat_files = []
         else:
             print('Not removing feat_files')
-            if '-s' not in sys_argv and '--specificruns' not in sys_argv:
-                mp_args = setup_utils.model_params_json_to_namespace(studyid, basedir, modelname)
-                specificruns = mp_args.specificruns
-                str_specificruns = json.dumps(specificruns)
-                sys_argv.append('-s')
-                sys_argv.append(str_specificruns)
-                existing_feat_files, jobs = get_level2_jobs.main(argv=sys_argv[:])
-        if rsp == 'y':  # wanted to remove feat files
-            assert len(
-                existing_feat_files) == 0, 'There are still existing feat files, there was a problem removing those ' \
-                                           'files. '
 
     njobs = len(jobs)
-    # turn the list of jobs into a dictionary with the index as the key
-    jobsdict = {}
-    for i in range(0, njobs):
-        jobsdict[i] = jobs[i]
 
     if nofeat:
-        for i in range(njobs):
-            call_feat_job(i, jobsdict, level)
-        print('\n%s *.fsf files created.' % njobs)
+        # the fsf's are created in this process (or a pool of processes), not in a new python process per job
+        fsfs = run_feat_job.make_fsfs(jobs, level, fsf_workers)
+        print('\n%s *.fsf files created.' % len(fsfs))
     if not nofeat:
-        if len(existing_feat_files) > 0:
-            print(
-                "WARNING: The existing feat files (see printed warnings above) will not be overwritten if you continue."
-            )
+        if len(rerun_feat_files) > 0:
+            print("WARNING: feat will write the outputs of the jobs above to new feat dirs (ending in +.gfeat); the "
+                  "existing feat dirs are not overwritten and stay out of date.")
         rsp = None
         while rsp != '':
             rsp = input('Press ENTER to continue:')
@@ -155,48 +196,53 @@ def main(argv=None):
         outputdir = os.path.join(homedir, '%s_%s' % (j, dateandtime))
         if not os.path.exists(outputdir):
             os.mkdir(outputdir)
+        if queue_workers > 0:
+            # the workers pull the jobs from a queue in outputdir, so an array task that finishes early runs more jobs
+            output = '%s_%s_%s.o' % (os.path.join(outputdir, j), dateandtime, '%a')
+            counts = work_queue.submit_workers(outputdir, jobs, level, 'run_level2_feat', account, nodes, time, mem,
+                                               email, queue_workers, cpus_per_task, output, max_array_size,
+                                               array_throttle)
+            if counts is not None and counts[work_queue.FAILED] > 0:
+                sys.exit(1)
+            return
+        # each array task reads its own job from the manifest
+        manifest_path = job_manifest.write_manifest(outputdir, jobs, level, time=time, mem=mem)
 
         # create an sbatch file to run the job array
         sbatch_path = os.path.join(outputdir, 'run_level2.sbatch')
-        with open(sbatch_path, 'w') as qsubfile:
-            qsubfile.write('#!/bin/sh\n')
-            qsubfile.write('#\n')
-            qsubfile.write('#SBATCH -J run_level2_feat\n')
-            qsubfile.write('#SBATCH -A %s\n' % account)
-            qsubfile.write('#SBATCH -N %d\n' % nodes)
-            qsubfile.write('#SBATCH -c 1\n')
-            qsubfile.write('#SBATCH --time=%s\n' % time)
-            qsubfile.write('#SBATCH --mem=%d\n' % mem)
-            qsubfile.write('#SBATCH --mail-user=%s\n' % email)
-            qsubfile.write('#SBATCH --mail-type=ALL\n')
-            qsubfile.write('#SBATCH --array=%s-%s\n' % (0, njobs - 1))
-            qsubfile.write('#SBATCH -o %s_%s_%s.o\n' % (os.path.join(outputdir, j), dateandtime, '%a'))
-            qsubfile.write('#----------------\n')
-            qsubfile.write('# Job Submission\n')
-            qsubfile.write('#----------------\n')
-            qsubfile.write("python %s --jobs '%s' -i $SLURM_ARRAY_TASK_ID --level 2" % (
-                os.path.join(fmripipelinedir, 'run_feat_job.py'), json.dumps(jobsdict)))
+        ntasks = slurm_utils.get_num_tasks(njobs, jobs_per_task)
+        command = "python %s --manifest %s -i %s --level 2" % (
+            os.path.join(fmripipelinedir, 'run_feat_job.py'), manifest_path, slurm_utils.ARRAY_TASK_INDEX)
+        if jobs_per_task > 1:
+            # each array task runs jobs_per_task jobs, cpus_per_task at a time
+            command += ' --jobs-per-task %d --cpus-per-task %d' % (jobs_per_task, cpus_per_task)
+            print('Packing %d jobs into %d array tasks of %d jobs' % (njobs, ntasks, jobs_per_task))
+        output = '%s_%s_%s.o' % (os.path.join(outputdir, j), dateandtime, '%a')
+        slurm_utils.write_sbatch(sbatch_path, 'run_level2_feat', account, nodes,
+                                 slurm_utils.get_task_time(time, jobs_per_task, cpus_per_task),
+                                 slurm_utils.get_task_mem(mem, jobs_per_task, cpus_per_task), email, ntasks,
+                                 output, command,
+                                 cpus_per_task=cpus_per_task)
 
         try:
-            subprocess.call(['sbatch', sbatch_path])
+            task_ids = slurm_utils.submit_array(sbatch_path, ntasks, max_array_size, array_throttle, output=output)
+            print('Submitted batch job %s' % ' '.join(sorted(set(task_id.split('_')[0] for task_id in task_ids))))
+            job_state.record_queued(jobs, level, [task_ids[i // jobs_per_task] for i in range(njobs)])
             print('Saving sbatch output to %s' % outputdir)
+        except subprocess.CalledProcessError as e:
+            print("ERROR: sbatch failed with exit code %d" % e.returncode)
+            sys.exit(-1)
         except FileNotFoundError:
             print("\nNOTE: sbatch command was not found.")
-            # since not running sbatch, should remove created .sbatch file and outputdir
+            # since not running sbatch, should remove created .sbatch file (outputdir keeps the logs of the jobs, and
+            # the manifest for retry_jobs.py)
             os.remove(sbatch_path)
-            os.rmdir(outputdir)
             rsp = None
             while rsp != 'n' and rsp != '':
-                rsp = input('Do you want to run the jobs in parallel using multiprocessing? (ENTER/n) ')
-            if rsp == '':
-                inputs = range(njobs)
-                num_cores = multiprocessing.cpu_count()
-                print('NOTE: Running feat in parallel across %s cores now...\n' % num_cores)
-                Parallel(n_jobs=num_cores)(delayed(call_feat_job)(i, jobsdict, level) for i in inputs)
-            else:
+                rsp = input('Do you want to run the jobs in parallel? (ENTER/n) ')
+            if rsp != '':
                 print("NOTE: Running commands serially now...\n")
-                for i in range(njobs):
-                    call_feat_job(i, jobsdict, level)
+            local_executor.run_feat_jobs(jobs, level, outputdir, mem, parallel=(rsp == ''), fsf_workers=fsf_workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Runs the level 1, level 2 and level 3 analyses of a model in one go
+Each level 2 job is released as soon as the level 1 jobs of its runs succeed, and each level 3 cope as soon as the
+level 2 jobs of its task have finished (see job_graph.py). The jobs are submitted to slurm with dependencies, or run on
+the local machine if sbatch is not available.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+
+import directory_struct_utils
+import job_graph
+import motion_qc
+import setup_utils
+import slurm_utils
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='run_pipeline')
+
+    parser.add_argument('-e', '--email', dest='email',
+                        required=True, help='Email to send job updates to')
+    parser.add_argument('-A', '--account', dest='account',
+                        required=True, help='Slurm account')
+    parser.add_argument('--time-level1', dest='time_level1',
+                        default="02:00:00", help='Estimated time to run each level 1 job - hh:mm:ss')
+    parser.add_argument('--time-level2', dest='time_level2',
+                        default="00:30:00", help='Estimated time to run each level 2 job - hh:mm:ss')
+    parser.add_argument('--time-level3', dest='time_level3',
+                        default="00:30:00", help='Estimated time to run each level 3 job - hh:mm:ss')
+    parser.add_argument('-N', '--nodes', dest='nodes', type=int,
+                        default=1, help='Number of nodes')
+    parser.add_argument('-M', '--mem', dest='mem', type=int,
+                        default=1024, help='Memory allocation of each job in MB. Defaults to 1024 MB.')
+    parser.add_argument('--max-array-size', dest='max_array_size', type=int,
+                        default=None, help='Maximum number of tasks of each job array; larger arrays are split into '
+                                           'arrays that run one after the other. Defaults to the MaxArraySize of the '
+                                           'cluster.')
+    parser.add_argument('--array-throttle', dest='array_throttle', type=int,
+                        default=0, help='Maximum number of array tasks that run at the same time (%%N). Defaults to 0 '
+                                        '(no limit).')
+    parser.add_argument('--fsf-workers', dest='fsf_workers', type=int,
+                        default=1, help='When running locally, number of processes that create the level 1 fsf\'s. '
+                                        'Defaults to 1.')
+    parser.add_argument('--studyid', dest='studyid',
+                        required=True, help='Study ID')
+    parser.add_argument('--basedir', dest='basedir',
+                        required=True, help='Base directory (above studyid directory)')
+    parser.add_argument('--outdir', dest='outdir',
+                        default="", help='Full path of directory where sbatch output should be saved')
+    parser.add_argument('-m', '--modelname', dest='modelname',
+                        required=True, help='Model name')
+    parser.add_argument('--subs', dest='subids', nargs='+',
+                        default=[], help='subject identifiers to include in the level 3 analysis (not including '
+                                         'prefix "sub-")')
+    parser.add_argument('--randomise', dest='randomise', action='store_true',
+                        default=False, help='Use Randomise for the level 3 stats instead of FLAME 1')
+    parser.add_argument('--motion-qc', dest='motion_qc', action='store_true',
+                        default=False, help='Compute the motion of every run from its fmriprep confounds file (written '
+                                            'to motion_qc.tsv under the model directory) and exclude the runs with too '
+                                            'much motion before the jobs are built. The thresholds are read from '
+                                            'motion_qc.json under the model directory (see motion_qc.py).')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        default=False, help='Only run the jobs that failed or were never run, based on the states '
+                                            'recorded by earlier runs (see job_state.py)')
+    parser.add_argument('--local', dest='local', action='store_true',
+                        default=False, help='Run the jobs on this machine even if sbatch is available')
+    parser.add_argument('-s', '--specificruns', dest='specificruns', type=json.loads,
+                        default={}, help="""JSON object in a string that details which runs to create fsf's for. If
+                        specified, ignores specificruns specified in model_params.json. Ex: If there are sessions:
+                        \'{"sub-01": {"ses-01": {"flanker": ["1", "2"]}}, "sub-02": {"ses-01": {"flanker": ["1",
+                        "2"]}}}\' where flanker is a task name and ["1", "2"] is a list of the runs. If there aren't
+                        sessions: \'{"sub-01":{"flanker":["1"]},"sub-02":{"flanker":["1","2"]}}\'. Make sure this
+                        describes the fmriprep folder, which should be in BIDS format. Make sure to have single
+                        quotes around the JSON object and double quotes within. """
+                        )
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def main(argv=None):
+    d = datetime.datetime.now()
+    args = parse_command_line(argv)
+
+    studyid = args.studyid
+    basedir = args.basedir
+    modelname = args.modelname
+    sys_args_specificruns = args.specificruns
+    outdir = args.outdir
+
+    error = slurm_utils.check_array_options(args.max_array_size, args.array_throttle)
+    if error is not None:
+        print("ERROR: %s" % error)
+        sys.exit(-1)
+
+    studydir = os.path.join(basedir, studyid)
+    study_info, hasSessions = directory_struct_utils.get_study_info(studydir)
+
+    # get specificruns from model_params
+    model_params = setup_utils.model_params_json_to_namespace(studyid, basedir, modelname)
+    if sys_args_specificruns == {}:
+        specificruns = model_params.specificruns
+    else:
+        specificruns = sys_args_specificruns
+    if len(specificruns) == 0:
+        specificruns = study_info
+    if args.motion_qc:
+        specificruns = motion_qc.run_motion_qc(studyid, basedir, modelname, specificruns, hasSessions)
+
+    setup_utils.generate_confounds_files(studyid, basedir, specificruns, modelname, hasSessions)
+
+    graph = job_graph.build_graph(studyid, basedir, modelname, specificruns, sys_args_specificruns, args.subids,
+                                  args.randomise, args.resume)
+    counts = [len(job_graph.get_level_jobs(graph, level)) for level in [1, 2, 3]]
+    print('\nPlanned %d level 1 jobs, %d level 2 jobs and %d level 3 jobs.' % tuple(counts))
+    if len(graph) == 0:
+        print('Nothing to run.')
+        return
+
+    # outputs of jobs that are run again (partial outputs of failed jobs, outputs whose inputs changed or whose inputs
+    # are run again) are not overwritten by feat
+    existing_outputs = job_graph.get_existing_outputs(graph)
+    if len(existing_outputs) > 0:
+        for featdir in existing_outputs:
+            print('\t%s' % featdir)
+        rsp = None
+        while rsp != 'y' and rsp != '':
+            rsp = input('Do you want to remove the existing outputs of the jobs that will be run again? (y/ENTER) ')
+        if rsp == 'y':
+            for featdir in existing_outputs:
+                print('Removing %s' % featdir)
+                shutil.rmtree(featdir)
+
+    rsp = None
+    while rsp != '':
+        rsp = input('Press ENTER to continue:')
+
+    j = 'pipeline'
+    # save sbatch output to studydir by default
+    if outdir == '':
+        homedir = studydir
+    else:
+        homedir = outdir
+        if not os.path.exists(homedir):
+            os.makedirs(homedir)
+    dateandtime = d.strftime("%d_%B_%Y_%Hh_%Mm_%Ss")
+    outputdir = os.path.join(homedir, '%s_%s' % (j, dateandtime))
+    if not os.path.exists(outputdir):
+        os.mkdir(outputdir)
+
+    if not args.local and shutil.which('sbatch') is not None:
+        times = {1: args.time_level1, 2: args.time_level2, 3: args.time_level3}
+        job_graph.submit_graph(graph, outputdir, j, args.account, args.nodes, times, args.mem, args.email,
+                               args.max_array_size, args.array_throttle)
+        print('Saving sbatch output to %s' % outputdir)
+    else:
+        if not args.local:
+            print("\nNOTE: sbatch command was not found.")
+        rsp = None
+        while rsp != 'n' and rsp != '':
+            rsp = input('Do you want to run the jobs in parallel? (ENTER/n) ')
+        if rsp != '':
+            print("NOTE: Running commands serially now...\n")
+        exitcodes = job_graph.run_graph_locally(graph, outputdir, args.mem, parallel=(rsp == ''),
+                                                fsf_workers=args.fsf_workers)
+        if any(exitcode != 0 for exitcode in exitcodes.values()):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
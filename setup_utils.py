@@ -4,14 +4,26 @@ Functions for interacting with model_params, condition_key, and task_contrasts
 
 # Created by Alice Xue, 06/2018
 from argparse import Namespace
+import collections
+from concurrent.futures import ProcessPoolExecutor
 import copy
+import hashlib
 import json
 import numpy as np
 import pandas as pd
 import os
 import sys
+import time
 
+import confound_expansions
 import directory_struct_utils
+import model_spec
+import study_catalog
+
+# confounds files are written in parallel by up to MAX_CONFOUNDS_WORKERS processes, if there are at least
+# MIN_PARALLEL_CONFOUNDS runs
+MAX_CONFOUNDS_WORKERS = 8
+MIN_PARALLEL_CONFOUNDS = 32
 
 """
 Converts parameters in model_params.json to Namespace object 
@@ -21,13 +33,8 @@ Converts parameters in model_params.json to Namespace object
 def model_params_json_to_namespace(studyid, basedir, modelname):
     modeldir = os.path.join(basedir, studyid, 'model', 'level1', 'model-%s' % modelname)
     default_params = get_default_params()
-    model_params_json_path = modeldir + '/model_params.json'
-    if os.path.exists(model_params_json_path):
-        try:
-            params = json.load(open(model_params_json_path, 'r'))
-        except ValueError:
-            print("\nERROR: Could not read the %s file. Make sure it is formatted correctly." % model_params_json_path)
-            sys.exit(-1)
+    params = model_spec.get_model_spec(studyid, basedir, modelname).get_model_params()
+    if params is not None:
         args = Namespace()
         args.modelname = params['modelname']
         args.specificruns = params['specificruns']
@@ -60,10 +67,8 @@ The list can be called on in a subprocess
 
 def model_params_json_to_list(studyid, basedir, modelname):
     modeldir = os.path.join(basedir, studyid, 'model', 'level1', 'model-%s' % modelname)
-    if os.path.exists(modeldir + '/model_params.json'):
-        with open(modeldir + '/model_params.json', 'r') as f:
-            params = json.load(f)
-
+    params = model_spec.get_model_spec(studyid, basedir, modelname).get_model_params()
+    if params is not None:
         # no_action_params: parameters that don't have store_true or store_false as an action
         no_action_params = ['studyid', 'basedir', 'smoothing', 'use_inplane', 'modelname', 'anatimg', 'spacetag']
         action_params = {'nonlinear': False, 'nohpf': True, 'nowhiten': True, 'noconfound': True, 'doreg': False,
@@ -220,7 +225,6 @@ class RunObj:
 
 """
 Returns list of RunObj for all runs in specificruns
-Checks for existence of functional file before adding to the list
 """
 
 
@@ -240,27 +244,13 @@ def traverse_specificruns(studyid, basedir, specificruns, hasSessions):
                     runs = study_info[subid][ses][task]
                     list.sort(runs)
                     for run in runs:
-                        funcdir = os.path.join(basedir, studyid, 'fmriprep', 'sub-' + sub, 'ses-' + sesname, 'func')
-                        fileprefix = 'sub-' + sub + '_ses-' + sesname + '_task-' + task + '_run-' + run
-                        funcdirfiles = os.listdir(funcdir)
-                        if os.path.exists(funcdir):
-                            for f in funcdirfiles:
-                                if f.startswith(fileprefix):
-                                    pass
-                            run_objects.append(RunObj(sub, sesname, task, run))
+                        run_objects.append(RunObj(sub, sesname, task, run))
         else:  # no sessions
             tasks = sorted(study_info[subid].keys())
             for task in tasks:
                 runs = sorted(study_info[subid][task])
                 for run in runs:
-                    funcdir = os.path.join(basedir, studyid, 'fmriprep', 'sub-' + sub, 'func')
-                    fileprefix = 'sub-' + sub + '_task-' + task + '_run-' + run
-                    funcdirfiles = os.listdir(funcdir)
-                    if os.path.exists(funcdir):
-                        for f in funcdirfiles:
-                            if f.startswith(fileprefix):
-                                pass
-                        run_objects.append(RunObj(sub, None, task, run))
+                    run_objects.append(RunObj(sub, None, task, run))
     return run_objects
 
 
@@ -277,6 +267,63 @@ def get_possible_confounds_stems():
     ]
 
 
+"""
+Returns the prefix of the files of a run (sub-<sub>[_ses-<ses>]_task-<task>_run-<run>)
+"""
+
+
+def get_run_prefix(spef_run):
+    if spef_run.ses is not None:  # there are sessions
+        return 'sub-' + spef_run.sub + '_ses-' + spef_run.ses + '_task-' + spef_run.task + '_run-' + spef_run.run
+    return 'sub-' + spef_run.sub + '_task-' + spef_run.task + '_run-' + spef_run.run
+
+
+"""
+Returns the path of the fmriprep confounds file of a run, or None if the run has none
+Looks the run up in the listing of its func directory (see directory_struct_utils.BidsIndex) instead of trying to open
+a file for each stem. If there are files with several stems, the last stem in get_possible_confounds_stems() is used.
+"""
+
+
+def get_confounds_filepath(index, spef_run):
+    ses = spef_run.ses if spef_run.ses is not None else ''
+    runfiles = set(index.get_run_files(spef_run.sub, ses, spef_run.task, spef_run.run))
+    fileprefix = get_run_prefix(spef_run)
+    confounds_filepath = None
+    for stem in get_possible_confounds_stems():
+        if fileprefix + stem in runfiles:
+            confounds_filepath = os.path.join(index.get_dir(spef_run.sub, ses, 'func'), fileprefix + stem)
+    return confounds_filepath
+
+
+"""
+Returns the column names of a confounds file (its first line)
+"""
+
+
+def read_confounds_header(confounds_filepath):
+    with open(confounds_filepath, 'r') as f:
+        return f.readline().split()
+
+
+"""
+Reads the given columns of a confounds file, in the given order
+Only the columns that are asked for are parsed (the C parser skips the others); columns that the file doesn't have are
+filled with NaN, or left out if reindex is False
+"""
+
+
+def read_confounds(confounds_filepath, columns, reindex=True):
+    header = read_confounds_header(confounds_filepath)
+    wanted = set(columns)
+    usecols = [i for i, column in enumerate(header) if column in wanted]
+    # at least one column is parsed, so that the frame has a row per volume even if none of the columns exist
+    df = pd.read_csv(confounds_filepath, sep=r'\s+', engine='c', usecols=usecols if len(usecols) > 0 else [0])
+    if not reindex:
+        return df
+    return df.reindex(columns=columns)
+
+
 """
 Gets list of all possible confounds from a *_bold_confounds.tsv file in fmriprep
 (by iterating through fmriprep until a confounds file is found)
@@ -289,35 +336,90 @@ def get_possible_confounds(studyid, basedir):
     studydir = os.path.join(basedir, studyid)
     study_info, hasSessions = directory_struct_utils.get_study_info(studydir)
     run_objects = traverse_specificruns(studyid, basedir, study_info, hasSessions)
-    run_objects_count = 0
-    found_bold_confounds = False
-    while run_objects_count < len(run_objects) and not found_bold_confounds:
+    index = directory_struct_utils.get_bids_index(studydir, use_catalog=True)
+    for spef_run in run_objects:
         # iterates through all runs in fmriprep to look for bold_confounds
-        spef_run = run_objects[run_objects_count]  # checks one run in list
-        if spef_run.ses is not None:  # there are sessions
-            funcdir = os.path.join(basedir, studyid, 'fmriprep', 'sub-' + spef_run.sub, 'ses-' + spef_run.ses, 'func')
-            fileprefix = 'sub-' + spef_run.sub + '_ses-' + spef_run.ses + '_task-' + spef_run.task + '_run-' + \
-                         spef_run.run
-        else:  # no sessions
-            funcdir = os.path.join(basedir, studyid, 'fmriprep', 'sub-' + spef_run.sub, 'func')
-            fileprefix = 'sub-' + spef_run.sub + '_task-' + spef_run.task + '_run-' + spef_run.run
-
-        possible_confounds_filepath_stems = get_possible_confounds_stems()
-
-        for stem in possible_confounds_filepath_stems:
-            confounds_filepath = os.path.join(funcdir, fileprefix + stem)
-            try:
-                df = pd.read_csv(confounds_filepath, delim_whitespace=True)
-                possible_confounds = df.columns.tolist()
-                return possible_confounds
-            except FileNotFoundError:
-                continue
-        run_objects_count += 1
-    print('Could not find confounds files in %s. Looked for files ending with the following strings:' % funcdir,
-          possible_confounds_filepath_stems)
+        confounds_filepath = get_confounds_filepath(index, spef_run)
+        if confounds_filepath is not None:
+            return study_catalog.open_catalog(studydir).get_confounds_header(confounds_filepath)
+    print('Could not find confounds files in %s. Looked for files ending with the following strings:' %
+          index.fmriprep_dir, get_possible_confounds_stems())
     return []
 
 
+"""
+Reads the column names of the fmriprep confounds files of all runs in specificruns (only their first lines, in nworkers
+threads, cached in the study catalog)
+Returns an OrderedDict with the prefixes of the runs (see get_run_prefix) as keys and lists of column names as values,
+and a list of the prefixes of the runs without a confounds file
+"""
+
+
+def scan_confounds_headers(studyid, basedir, specificruns, hasSessions, nworkers=MAX_CONFOUNDS_WORKERS):
+    studydir = os.path.join(basedir, studyid)
+    index = directory_struct_utils.get_bids_index(studydir, use_catalog=True)
+    confounds_filepaths = collections.OrderedDict()
+    runs_without_confounds = []
+    for spef_run in traverse_specificruns(studyid, basedir, specificruns, hasSessions):
+        confounds_filepath = get_confounds_filepath(index, spef_run)
+        if confounds_filepath is not None:
+            confounds_filepaths[get_run_prefix(spef_run)] = confounds_filepath
+        else:
+            runs_without_confounds.append(get_run_prefix(spef_run))
+    catalog = study_catalog.open_catalog(studydir)
+    headers = catalog.prefetch_confounds_headers(confounds_filepaths.values(), nworkers)
+    run_headers = collections.OrderedDict()
+    for fileprefix, confounds_filepath in confounds_filepaths.items():
+        if headers[confounds_filepath] is not None:
+            run_headers[fileprefix] = headers[confounds_filepath]
+    return run_headers, runs_without_confounds
+
+
+"""
+Checks that the fmriprep confounds file of every run in specificruns has the columns that confounds.json asks for (the
+confounds and the columns their expansions are made of, see confound_expansions.get_required_columns), before any
+confounds file is written or job is submitted
+Prints the number of columns that all runs have, the columns that only some runs have, and the runs that are missing
+requested columns (these columns would be filled with 0's)
+Returns a dictionary with the prefixes of the runs that are missing requested columns as keys and lists of the missing
+columns as values
+"""
+
+
+def check_confounds_columns(studyid, basedir, specificruns, modelname, hasSessions, nworkers=MAX_CONFOUNDS_WORKERS):
+    spec = model_spec.get_model_spec(studyid, basedir, modelname)
+    if spec.confounds is None:
+        return {}
+    required_columns = confound_expansions.get_required_columns(spec.confounds, spec.get_confound_expansions())
+    run_headers, _ = scan_confounds_headers(studyid, basedir, specificruns, hasSessions, nworkers)
+    if len(run_headers) == 0:
+        return {}
+
+    union = []
+    intersection = None
+    for columns in run_headers.values():
+        union += [column for column in columns if column not in union]
+        intersection = set(columns) if intersection is None else intersection & set(columns)
+    print('Scanned the confounds files of %d runs: %d columns are in every file, %d columns in total' % (
+        len(run_headers), len(intersection), len(union)))
+    partial_columns = [column for column in union if column not in intersection]
+    if len(partial_columns) > 0:
+        print('Columns that only some confounds files have: %s' % ', '.join(partial_columns))
+
+    missing = collections.OrderedDict()
+    for fileprefix, columns in run_headers.items():
+        columns = set(columns)
+        missing_columns = [column for column in required_columns if column not in columns]
+        if len(missing_columns) > 0:
+            missing[fileprefix] = missing_columns
+    if len(missing) > 0:
+        print('WARNING: the confounds files of the following runs are missing columns listed in confounds.json '
+              '(they will be filled with 0\'s):')
+        for fileprefix, missing_columns in missing.items():
+            print('\t%s: %s' % (fileprefix, ', '.join(missing_columns)))
+    return missing
+
+
 """
 Asks if user wants to create a confounds.json file and whether or not to overwrite
 Default confounds.json file {"confounds":[<list of all possible confounds>]}
@@ -350,69 +452,129 @@ def create_default_confounds_json(studyid, basedir, modelname):
         print('Did not overwrite existing confounds file found here: %s' % (modeldir + '/confounds.json'))
 
 
+"""
+Writes the confounds file of a run (the columns of confounds_list and their expansions, see confound_expansions.py,
+with missing values replaced by 0's)
+Returns the prefix of the run, to print
+"""
+
+
+def write_confounds_file(confounds_filepath, confounds_list, output_confounds_filepath, expansions=None):
+    if expansions:
+        df = read_confounds(confounds_filepath, confound_expansions.get_source_columns(confounds_list, expansions),
+                            reindex=False)
+        cf = confound_expansions.expand_confounds(df, confounds_list, expansions)
+    else:
+        cf = read_confounds(confounds_filepath, confounds_list)
+    # replace np values with 0's
+    cf = cf.replace({np.nan: 0})
+    cf.to_csv(output_confounds_filepath, sep='\t', header=0, index=False)
+    return os.path.basename(output_confounds_filepath)[:-len('_ev-confounds.tsv')]
+
+
+def _write_confounds_files(confounds_files):
+    return [write_confounds_file(*confounds_file) for confounds_file in confounds_files]
+
+
+"""
+Returns the fingerprint of a confounds file in an onset directory: the path, size and mtime of its fmriprep confounds
+file, a hash of the columns it is made of (and of their expansions), and the size and mtime of the confounds file itself
+(so that a confounds file that was edited or removed is written again)
+Returns None if either file doesn't exist
+"""
+
+
+def get_confounds_fingerprint(confounds_filepath, confounds_list, output_confounds_filepath, expansions=None):
+    try:
+        source = os.stat(confounds_filepath)
+        output = os.stat(output_confounds_filepath)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    columns = [confounds_list, expansions] if expansions else confounds_list
+    columns_hash = hashlib.sha1(json.dumps(columns, sort_keys=True).encode('utf-8')).hexdigest()
+    return [confounds_filepath, source.st_size, source.st_mtime_ns, columns_hash, output.st_size, output.st_mtime_ns]
+
+
 """
 Auto-generates confounds files in onset directories based on list of confounds in confounds.json
+The columns of the fmriprep confounds files are checked first (see check_confounds_columns)
+Only the confounds files that are missing, or whose fmriprep confounds file or list of confounds changed since they were
+written (see get_confounds_fingerprint), are written again. The runs are written by nworkers processes (by default, one
+per core up to MAX_CONFOUNDS_WORKERS); studies with fewer than MIN_PARALLEL_CONFOUNDS runs are written in this process
 """
 
 
-def generate_confounds_files(studyid, basedir, specificruns, modelname, hasSessions):
-    modeldir = os.path.join(basedir, studyid, 'model', 'level1', 'model-%s' % modelname)
-    if os.path.exists(modeldir + '/confounds.json'):
-        with open(modeldir + '/confounds.json', 'r') as f:
-            confounds_dict = json.load(f)
-            confounds_list = confounds_dict['confounds']
+def generate_confounds_files(studyid, basedir, specificruns, modelname, hasSessions, nworkers=None):
+    spec = model_spec.get_model_spec(studyid, basedir, modelname)
+    confounds_list = spec.confounds
+    if confounds_list is not None:
+        check_confounds_columns(studyid, basedir, specificruns, modelname, hasSessions)
+        confounds_list = list(confounds_list)
+        expansions = spec.get_confound_expansions()
         run_objects = traverse_specificruns(studyid, basedir, specificruns, hasSessions)
+        studydir = os.path.join(basedir, studyid)
+        index = directory_struct_utils.get_bids_index(studydir, use_catalog=True)
+        catalog = study_catalog.open_catalog(studydir)
+        unchanged = 0
+        # (fmriprep confounds file, confounds_list, output confounds file, expansions) of each run
+        confounds_files = []
         runs_without_bold_confounds = []
         for spef_run in run_objects:
             if spef_run.ses is not None:  # there are sessions
-                funcdir = os.path.join(basedir, studyid, 'fmriprep', 'sub-' + spef_run.sub, 'ses-' + spef_run.ses,
-                                       'func')
-                fileprefix = 'sub-' + spef_run.sub + '_ses-' + spef_run.ses + '_task-' + spef_run.task + '_run-' + \
-                             spef_run.run
                 modeldir = os.path.join(basedir, studyid, 'model', 'level1', 'model-' + modelname,
                                         'sub-' + spef_run.sub, 'ses-' + spef_run.ses,
                                         'task-' + spef_run.task + '_run-' + spef_run.run, 'onsets')
             else:  # no sessions
-                funcdir = os.path.join(basedir, studyid, 'fmriprep', 'sub-' + spef_run.sub, 'func')
-                fileprefix = 'sub-' + spef_run.sub + '_task-' + spef_run.task + '_run-' + spef_run.run
                 modeldir = os.path.join(basedir, studyid, 'model', 'level1', 'model-' + modelname,
                                         'sub-' + spef_run.sub, 'task-' + spef_run.task + '_run-' + spef_run.run,
                                         'onsets')
 
-            possible_confounds_filepath_stems = get_possible_confounds_stems()
-
-            foundConfounds = False
-            for stem in possible_confounds_filepath_stems:
-                potential_confounds_filepath = os.path.join(funcdir, fileprefix + stem)
-                try:
-                    df = pd.read_csv(potential_confounds_filepath, delim_whitespace=True)
-                    foundConfounds = True
-                    confounds_filepath = potential_confounds_filepath
-                except FileNotFoundError:
+            confounds_filepath = get_confounds_filepath(index, spef_run)
+            if confounds_filepath is not None:
+                output_confounds_filepath = os.path.join(modeldir, get_run_prefix(spef_run) + '_ev-confounds.tsv')
+                fingerprint = get_confounds_fingerprint(confounds_filepath, confounds_list, output_confounds_filepath,
+                                                        expansions)
+                if fingerprint is not None and \
+                        fingerprint == catalog.get_confounds_fingerprint(output_confounds_filepath):
+                    unchanged += 1
                     continue
-
-            if foundConfounds:
-                confounds_tsv = pd.read_csv(confounds_filepath, delim_whitespace=True)
-                cf = confounds_tsv.reindex(columns=confounds_list)
-                # replace np values with 0's
-                cf = cf.replace({np.nan: 0})
-                output_confounds_filename = fileprefix + '_ev-confounds.tsv'
-                cf.to_csv(os.path.join(modeldir, output_confounds_filename), sep='\t', header=0, index=False)
-                print('Created confounds file for %s' % fileprefix)
+                confounds_files.append((confounds_filepath, confounds_list, output_confounds_filepath, expansions))
             else:
                 # keep track of all runs for which *_bold_confounds.tsv files can't be found
                 runs_without_bold_confounds.append(spef_run)
 
+        if nworkers is None:
+            nworkers = min(MAX_CONFOUNDS_WORKERS, os.cpu_count() or 1)
+        if nworkers <= 1 or len(confounds_files) < MIN_PARALLEL_CONFOUNDS:
+            fileprefixes = _write_confounds_files(confounds_files)
+        else:
+            # a few chunks per worker, so that a slow chunk doesn't leave the other workers idle
+            chunksize = max(1, len(confounds_files) // (nworkers * 4))
+            chunks = [confounds_files[i:i + chunksize] for i in range(0, len(confounds_files), chunksize)]
+            with ProcessPoolExecutor(max_workers=nworkers) as pool:
+                fileprefixes = [fileprefix for chunk_fileprefixes in pool.map(_write_confounds_files, chunks)
+                                for fileprefix in chunk_fileprefixes]
+        for fileprefix in fileprefixes:
+            print('Created confounds file for %s' % fileprefix)
+        if unchanged > 0:
+            print('%d confounds files are up to date' % unchanged)
+
+        # fmriprep confounds files modified in the last RACY_MTIME_WINDOW seconds may change again within the same
+        # mtime tick, so their fingerprints aren't recorded and they are written again next time
+        fingerprints = {}
+        for confounds_file in confounds_files:
+            fingerprint = get_confounds_fingerprint(*confounds_file)
+            output_confounds_filepath = confounds_file[2]
+            if fingerprint is not None and time.time() - fingerprint[2] / 1e9 >= study_catalog.RACY_MTIME_WINDOW:
+                fingerprints[output_confounds_filepath] = fingerprint
+        catalog.record_confounds_fingerprints(fingerprints)
+        catalog.commit()
+
         # print warning message for runs without confounds
         if len(runs_without_bold_confounds) > 0:
             print('WARNING: confounds files were not found for the following runs:')
             for spef_run in runs_without_bold_confounds:
-                if spef_run.ses is not None:
-                    print(
-                        '\t' + 'sub-' + spef_run.sub + '_ses-' + spef_run.ses + '_task-' + spef_run.task + '_run-' +
-                        spef_run.run)
-                else:
-                    print('\t' + 'sub-' + spef_run.sub + '_task-' + spef_run.task + '_run-' + spef_run.run)
+                print('\t' + get_run_prefix(spef_run))
 
 
 """
@@ -0,0 +1,217 @@
+"""
+Functions to write the sbatch files that run_level1.py, run_level2.py and run_level3.py submit as job arrays
+"""
+
+import math
+import re
+import shutil
+import subprocess
+
+# slurm's default MaxArraySize (array indices go from 0 to MaxArraySize - 1)
+DEFAULT_MAX_ARRAY_SIZE = 1001
+
+# index of the job (or packed array task) an array task runs: arrays that are split into chunks start each chunk at
+# index 0, and the offset of the chunk is exported in FMRI_PIPELINE_ARRAY_OFFSET (see submit_array)
+ARRAY_TASK_INDEX = '$((SLURM_ARRAY_TASK_ID + ${FMRI_PIPELINE_ARRAY_OFFSET:-0}))'
+
+_max_array_size = []
+
+
+def parse_time(time):
+    """
+    Args:
+        time (str): slurm time limit, hh:mm:ss, mm:ss or d-hh:mm:ss
+    Returns:
+        number of seconds
+    """
+    days = 0
+    if '-' in time:
+        days, time = time.split('-', 1)
+        days = int(days)
+    fields = [int(field) for field in time.split(':')]
+    while len(fields) < 3:
+        fields.insert(0, 0)
+    hours, minutes, seconds = fields
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def format_time(seconds):
+    """Returns a number of seconds as a slurm time limit (hh:mm:ss, hours may be more than 24)"""
+    seconds = int(math.ceil(seconds))
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def get_num_tasks(njobs, jobs_per_task):
+    """Returns the number of array tasks needed to run njobs jobs, jobs_per_task jobs per task"""
+    return int(math.ceil(njobs / float(jobs_per_task)))
+
+
+def get_task_time(time, jobs_per_task, cpus_per_task):
+    """Returns the time limit of an array task that runs jobs_per_task jobs, cpus_per_task at a time
+
+    Args:
+        time (str): estimated time to run each job
+        jobs_per_task (int): number of jobs run by each array task
+        cpus_per_task (int): number of jobs run at the same time by each array task
+    Returns:
+        time limit of each array task (str)
+    """
+    if jobs_per_task <= 1:
+        return time
+    waves = int(math.ceil(jobs_per_task / float(min(cpus_per_task, jobs_per_task))))
+    return format_time(parse_time(time) * waves)
+
+
+def get_task_mem(mem, jobs_per_task, cpus_per_task):
+    """Returns the memory allocation (MB) of an array task that runs up to cpus_per_task jobs of mem MB at a time"""
+    return mem * max(1, min(cpus_per_task, jobs_per_task))
+
+
+def check_packing(jobs_per_task, cpus_per_task):
+    """Returns an error message if the packing options are invalid, None otherwise"""
+    if jobs_per_task < 1:
+        return '--jobs-per-task must be at least 1'
+    if cpus_per_task < 1:
+        return '--cpus-per-task must be at least 1'
+    return None
+
+
+def write_sbatch(sbatch_path, jobname, account, nodes, time, mem, email, ntasks, output, command, cpus_per_task=1):
+    """Writes an sbatch file that runs a command in a job array
+
+    Args:
+        sbatch_path (str): path of the sbatch file
+        jobname (str): name of the job
+        account (str): slurm account
+        nodes (int): number of nodes
+        time (str): time limit of each array task
+        mem (int): memory allocation of each array task in MB
+        email (str): email to send job updates to
+        ntasks (int): number of array tasks
+        output (str): path of the output file of each array task (%a is replaced by the index of the task)
+        command (str): command run by each array task
+        cpus_per_task (int): number of CPUs allocated to each array task
+    """
+    with open(sbatch_path, 'w') as qsubfile:
+        qsubfile.write('#!/bin/sh\n')
+        qsubfile.write('#\n')
+        qsubfile.write('#SBATCH -J %s\n' % jobname)
+        qsubfile.write('#SBATCH -A %s\n' % account)
+        qsubfile.write('#SBATCH -N %d\n' % nodes)
+        qsubfile.write('#SBATCH -c %d\n' % cpus_per_task)
+        qsubfile.write('#SBATCH --time=%s\n' % time)
+        qsubfile.write('#SBATCH --mem=%d\n' % mem)
+        qsubfile.write('#SBATCH --mail-user=%s\n' % email)
+        qsubfile.write('#SBATCH --mail-type=ALL\n')
+        qsubfile.write('#SBATCH --array=%s-%s\n' % (0, ntasks - 1))
+        qsubfile.write('#SBATCH -o %s\n' % output)
+        qsubfile.write('#----------------\n')
+        qsubfile.write('# Job Submission\n')
+        qsubfile.write('#----------------\n')
+        qsubfile.write(command)
+
+
+def get_max_array_size():
+    """Returns the MaxArraySize of the cluster (from scontrol show config), or DEFAULT_MAX_ARRAY_SIZE if it can't be
+    read"""
+    if len(_max_array_size) == 0:
+        size = DEFAULT_MAX_ARRAY_SIZE
+        if shutil.which('scontrol') is not None:
+            try:
+                output = subprocess.check_output(['scontrol', 'show', 'config'], universal_newlines=True)
+                match = re.search(r'^MaxArraySize\s*=\s*(\d+)', output, re.MULTILINE)
+                if match:
+                    size = int(match.group(1))
+            except (subprocess.CalledProcessError, OSError):
+                pass
+        _max_array_size.append(size)
+    return _max_array_size[0]
+
+
+def check_array_options(max_array_size, throttle):
+    """Returns an error message if the array options are invalid, None otherwise"""
+    if max_array_size is not None and max_array_size < 1:
+        return '--max-array-size must be at least 1'
+    if throttle < 0:
+        return '--array-throttle must be 0 (no limit) or more'
+    return None
+
+
+def get_array_chunks(ntasks, max_array_size):
+    """Splits the tasks of an array into chunks of at most max_array_size tasks
+
+    Returns:
+        list of (offset, number of tasks) of each chunk
+    """
+    return [(offset, min(max_array_size, ntasks - offset)) for offset in range(0, ntasks, max_array_size)]
+
+
+def submit(sbatch_path, array=None, dependency=None, export=None, output=None):
+    """Submits an sbatch file
+
+    Args:
+        sbatch_path (str): path of the sbatch file
+        array (str): array indices to submit (e.g. '3', '0-5' or '0-999%50'), replacing the --array of the sbatch file
+        dependency (str): slurm dependency, e.g. 'afterok:1234_0:1234_1'; the job is cancelled if the dependency can
+            never be satisfied
+        export (dict): environment variables to set in the job, on top of the submitting environment
+        output (str): path of the output file, replacing the -o of the sbatch file
+    Returns:
+        ID of the submitted job (str)
+    Raises:
+        FileNotFoundError if sbatch is not found, subprocess.CalledProcessError if sbatch fails
+    """
+    args = ['sbatch', '--parsable']
+    if array is not None:
+        args.append('--array=%s' % array)
+    if dependency is not None:
+        args += ['--dependency=%s' % dependency, '--kill-on-invalid-dep=yes']
+    if export is not None:
+        args.append('--export=' + ','.join(['ALL'] + ['%s=%s' % item for item in sorted(export.items())]))
+    if output is not None:
+        args.append('--output=%s' % output)
+    output = subprocess.check_output(args + [sbatch_path], universal_newlines=True)
+    # --parsable prints <job id>[;<cluster name>]
+    return output.strip().split(';')[0]
+
+
+def submit_array(sbatch_path, ntasks, max_array_size=None, throttle=0, dependency=None, output=None, offset=0):
+    """Submits the tasks of a job array, split into chunks that fit in the MaxArraySize of the cluster
+
+    Each chunk is submitted with array indices 0 to (size of the chunk - 1) and exports the index of its first task in
+    FMRI_PIPELINE_ARRAY_OFFSET, so the command of the sbatch file should use ARRAY_TASK_INDEX instead of
+    $SLURM_ARRAY_TASK_ID. Each chunk only starts once the chunk before it has finished (afterany), so the chunks run in
+    order, and throttle limits the number of tasks of a chunk that run at the same time (%N).
+
+    Args:
+        sbatch_path (str): path of the sbatch file
+        ntasks (int): number of array tasks
+        max_array_size (int): maximum number of tasks per array (defaults to get_max_array_size())
+        throttle (int): maximum number of tasks running at the same time (0 for no limit)
+        dependency (str): slurm dependency of the first chunk
+        output (str): path of the output file of each array task, as in the sbatch file (%a is the index of the task);
+            if the array is split or doesn't start at the first task, %A (the ID of the chunk) is added so that the
+            arrays don't overwrite each other's output
+        offset (int): index of the first task to submit
+    Returns:
+        list with the slurm ID of each array task ('<job id>_<index in its chunk>')
+    Raises:
+        FileNotFoundError if sbatch is not found, subprocess.CalledProcessError if sbatch fails
+    """
+    if max_array_size is None:
+        max_array_size = get_max_array_size()
+    chunks = get_array_chunks(ntasks, max_array_size)
+    if len(chunks) > 1:
+        print('Splitting %d array tasks into %d arrays of at most %d tasks' % (ntasks, len(chunks), max_array_size))
+    if output is not None:
+        output = output.replace('%a', '%A_%a') if len(chunks) > 1 or offset > 0 else None
+    task_ids = []
+    for chunk_offset, size in chunks:
+        array = '0-%d' % (size - 1)
+        if throttle > 0:
+            array += '%%%d' % throttle
+        array_id = submit(sbatch_path, array=array, dependency=dependency,
+                          export={'FMRI_PIPELINE_ARRAY_OFFSET': offset + chunk_offset}, output=output)
+        task_ids += ['%s_%d' % (array_id, i) for i in range(size)]
+        dependency = 'afterany:%s' % array_id
+    return task_ids
@@ -0,0 +1,383 @@
+"""
+Persistent catalog of the directories of a study, stored in a single SQLite file under the study directory
+Directory listings are cached together with the mtime of the directory, so only directories that changed since the
+last call are listed again
+Also records the runs found in fmriprep (with their preproc, confounds and brain mask files), which level 1, 2 and 3
+outputs exist, the NIfTI headers of the preprocessed files and the column names of the fmriprep confounds files (both
+keyed by path, size and mtime) and the fingerprints of the confounds files written in the onset directories
+"""
+
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import stat
+import threading
+import time
+from urllib.request import pathname2url
+
+import nifti_utils
+
+CATALOG_FILENAME = '.fmri_pipeline_catalog.sqlite'
+
+# a listing is only trusted if the directory was last modified at least this many seconds before it was listed
+# (shared filesystems can have coarse mtimes, so a change in the same tick as the listing would otherwise be missed)
+RACY_MTIME_WINDOW = 2.0
+
+# catalog for each study directory, keyed by the path of the study directory
+_catalogs = {}
+
+# if True, the catalogs opened by this process are read-only (see use_read_only_catalogs)
+_read_only = False
+
+
+def _list_dir(path):
+    with os.scandir(path) as it:
+        return [(entry.name, entry.is_dir()) for entry in it]
+
+
+class StudyCatalog(object):
+    """Catalog of the directory listings, runs and outputs of a study
+
+    Args:
+        studydir (str): path of parent directory of fmriprep directory (basedir + studyid)
+        persistent (bool): if False, the catalog is kept in memory and nothing is written under studydir
+        read_only (bool): if True, the catalog file must exist and is only read; updates are dropped
+    """
+
+    def __init__(self, studydir, persistent=True, read_only=False):
+        self.studydir = studydir
+        self.path = os.path.join(studydir, CATALOG_FILENAME) if persistent else ':memory:'
+        self.read_only = read_only and persistent
+        self.rescanned = set()  # directories that were listed (not read from the catalog) by this process
+        self._lock = threading.Lock()
+        self._pending = []  # (statement, rows) waiting to be committed
+        if self.read_only:
+            self._conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(self.path), timeout=5,
+                                         check_same_thread=False, uri=True)
+            # fails if the file is not an SQLite database, so that open_catalog falls back to a catalog in memory
+            self._conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            return
+        self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS listings '
+                               '(path TEXT PRIMARY KEY, mtime_ns INTEGER, entries TEXT)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS runs '
+                               '(sub TEXT, ses TEXT, task TEXT, run TEXT, preproc TEXT, confounds TEXT, '
+                               'brainmask TEXT, PRIMARY KEY (sub, ses, task, run))')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS outputs '
+                               '(path TEXT PRIMARY KEY, level INTEGER, output_exists INTEGER)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS headers '
+                               '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, header TEXT)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS confounds '
+                               '(path TEXT PRIMARY KEY, fingerprint TEXT)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS confounds_headers '
+                               '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, columns TEXT)')
+
+    def _write(self, statement, rows):
+        # writes are queued and committed together in commit(), so checking many paths costs a single transaction
+        if self.read_only:
+            return
+        with self._lock:
+            self._pending.append((statement, rows))
+
+    def commit(self):
+        """Writes the queued updates to the catalog"""
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            if len(pending) == 0:
+                return
+            # the catalog is only a cache: if another process holds the lock for too long, skip the update
+            try:
+                with self._conn:
+                    for statement, rows in pending:
+                        self._conn.executemany(statement, rows)
+            except sqlite3.Error as e:
+                print("WARNING: Could not update %s: %s" % (self.path, e))
+
+    def scandir(self, path):
+        """Lists a directory, reusing the listing stored in the catalog if the directory has not changed
+
+        Args:
+            path (str): path of directory
+        Returns:
+            list of (name, is_dir) tuples, or an empty list if path is not a directory
+
+        """
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        if not stat.S_ISDIR(st.st_mode):
+            return []
+        with self._lock:
+            row = self._conn.execute('SELECT mtime_ns, entries FROM listings WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == st.st_mtime_ns:
+            return [tuple(entry) for entry in json.loads(row[1])]
+        try:
+            entries = _list_dir(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        self.rescanned.add(path)
+        if time.time() - st.st_mtime_ns / 1e9 >= RACY_MTIME_WINDOW:
+            self._write('INSERT OR REPLACE INTO listings VALUES (?, ?, ?)',
+                        [(path, st.st_mtime_ns, json.dumps(entries))])
+        return entries
+
+    def path_exists(self, path):
+        """Returns True if path exists, based on the (cached) listing of its parent directory"""
+        parent, name = os.path.split(os.path.normpath(path))
+        for entry_name, is_dir in self.scandir(parent):
+            if entry_name == name:
+                return True
+        return False
+
+    def output_exists(self, level, path):
+        """Checks whether a level 1, 2 or 3 output (.feat or .gfeat directory) exists and records it in the catalog
+
+        Args:
+            level (int): level of analysis
+            path (str): full path of the feat directory
+        Returns:
+            True if the output exists
+
+        """
+        exists = self.path_exists(path)
+        self._write('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)', [(path, level, int(exists))])
+        return exists
+
+    def get_outputs(self, level):
+        """Returns the paths of the outputs of a level that were found the last time they were checked"""
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM outputs WHERE level = ? AND output_exists = 1 ORDER BY path',
+                                      (level,)).fetchall()
+        return [row[0] for row in rows]
+
+    def record_runs(self, index):
+        """Records the runs in a BidsIndex along with their preproc, confounds and brain mask files
+
+        Only subjects and sessions whose func directory was listed again (or that are not in the catalog yet) are
+        updated.
+
+        Args:
+            index: directory_struct_utils.BidsIndex of the fmriprep directory of this study
+        """
+        with self._lock:
+            recorded = set(self._conn.execute('SELECT DISTINCT sub, ses FROM runs').fetchall())
+        deletes = []
+        rows = []
+        for sub in index.get_all_subs():
+            for ses in [''] + index.get_sessions(sub):
+                if (sub, ses) in recorded and index.get_dir(sub, ses, 'func') not in self.rescanned:
+                    continue
+                deletes.append((sub, ses))
+                funcdir = index.get_dir(sub, ses, 'func')
+                for task, runs in index.get_task_runs(sub, ses).items():
+                    for run in runs:
+                        files = get_run_paths(index.get_run_files(sub, ses, task, run))
+                        rows.append((sub, ses, task, run) + tuple(
+                            os.path.join(funcdir, files[key]) if files[key] else ''
+                            for key in ['preproc', 'confounds', 'brainmask']))
+        self._write('DELETE FROM runs WHERE sub = ? AND ses = ?', deletes)
+        self._write('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def get_run(self, sub, ses, task, run):
+        """Returns dictionary with the paths of the preproc, confounds and brainmask files of a run (or None)"""
+        with self._lock:
+            row = self._conn.execute('SELECT preproc, confounds, brainmask FROM runs '
+                                     'WHERE sub = ? AND ses = ? AND task = ? AND run = ?',
+                                     (sub, ses or '', task, run)).fetchone()
+        if row is None:
+            return None
+        return {'preproc': row[0], 'confounds': row[1], 'brainmask': row[2]}
+
+    def get_nifti_header(self, path):
+        """Gets the header of a NIfTI file, reading the file only if it is new or its size or mtime changed
+
+        Args:
+            path (str): full path of NIfTI file
+        Returns:
+            nifti_utils.NiftiHeader
+        Raises:
+            OSError if the file can't be read, ValueError if it is not a NIfTI file
+
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime_ns, header FROM headers WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            fields = json.loads(row[2])
+            return nifti_utils.NiftiHeader(**dict(fields, dims=tuple(fields['dims']), pixdims=tuple(fields['pixdims'])))
+        header = nifti_utils.read_nifti_header(path)
+        self._write('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)',
+                    [(path, st.st_size, st.st_mtime_ns, json.dumps(header._asdict()))])
+        return header
+
+    def prefetch_nifti_headers(self, paths, nworkers=8):
+        """Fills the header cache for many NIfTI files in one parallel pass
+
+        Args:
+            paths (list): full paths of NIfTI files
+            nworkers (int): number of threads
+        Returns:
+            dictionary with the paths as keys and NiftiHeaders as values (None if a header could not be read)
+
+        """
+        def get(path):
+            try:
+                return self.get_nifti_header(path)
+            except (OSError, ValueError) as e:
+                print('WARNING: Could not read the header of %s: %s' % (path, e))
+                return None
+
+        paths = list(paths)
+        with ThreadPoolExecutor(max_workers=max(1, nworkers)) as pool:
+            headers = dict(zip(paths, pool.map(get, paths)))
+        self.commit()
+        return headers
+
+    def get_confounds_header(self, path):
+        """Gets the column names of an fmriprep confounds file, reading its first line only if the file is new or its
+        size or mtime changed
+
+        Args:
+            path (str): full path of confounds file
+        Returns:
+            list of column names
+        Raises:
+            OSError if the file can't be read
+
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime_ns, columns FROM confounds_headers WHERE path = ?',
+                                     (path,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return json.loads(row[2])
+        with open(path, 'r') as f:
+            columns = f.readline().split()
+        if time.time() - st.st_mtime_ns / 1e9 >= RACY_MTIME_WINDOW:
+            self._write('INSERT OR REPLACE INTO confounds_headers VALUES (?, ?, ?, ?)',
+                        [(path, st.st_size, st.st_mtime_ns, json.dumps(columns))])
+        return columns
+
+    def prefetch_confounds_headers(self, paths, nworkers=8):
+        """Reads the column names of many confounds files in one parallel pass
+
+        Args:
+            paths (list): full paths of confounds files
+            nworkers (int): number of threads
+        Returns:
+            dictionary with the paths as keys and lists of column names as values (None if a file could not be read)
+
+        """
+        def get(path):
+            try:
+                return self.get_confounds_header(path)
+            except OSError as e:
+                print('WARNING: Could not read the header of %s: %s' % (path, e))
+                return None
+
+        paths = list(paths)
+        with ThreadPoolExecutor(max_workers=max(1, nworkers)) as pool:
+            headers = dict(zip(paths, pool.map(get, paths)))
+        self.commit()
+        return headers
+
+    def get_confounds_fingerprint(self, path):
+        """Returns the fingerprint recorded when the confounds file at path was written (see
+        setup_utils.get_confounds_fingerprint), or None"""
+        with self._lock:
+            row = self._conn.execute('SELECT fingerprint FROM confounds WHERE path = ?', (path,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def record_confounds_fingerprints(self, fingerprints):
+        """Records the fingerprints of confounds files that were written
+
+        Args:
+            fingerprints (dict): paths of the confounds files as keys and their fingerprints as values
+        """
+        self._write('INSERT OR REPLACE INTO confounds VALUES (?, ?)',
+                    [(path, json.dumps(fingerprint)) for path, fingerprint in fingerprints.items()])
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            self._conn.close()
+
+
+def get_run_paths(names):
+    """Picks the preproc, confounds and brain mask files out of the files of a single run
+
+    Args:
+        names (list): names of the files in the func directory that belong to the run
+    Returns:
+        dictionary with 'preproc', 'confounds' and 'brainmask' as keys and file names (or '') as values
+
+    """
+    files = {'preproc': '', 'confounds': '', 'brainmask': ''}
+    for name in names:
+        if name.endswith('.nii.gz') and 'preproc' in name and 'bold' in name and 'brain' not in name:
+            if files['preproc'] == '':
+                files['preproc'] = name
+        elif name.endswith('_brainmask.nii.gz') or name.endswith('-brain_mask.nii.gz'):
+            if files['brainmask'] == '':
+                files['brainmask'] = name
+        elif name.endswith('confounds.tsv') or name.endswith('confounds_regressors.tsv') or \
+                name.endswith('confounds_timeseries.tsv'):
+            files['confounds'] = name
+    return files
+
+
+def open_catalog(studydir):
+    """Opens (or creates) the catalog of a study
+
+    The catalog is opened once per process. If it cannot be created under studydir (e.g. the directory is read-only),
+    a catalog that only lives in memory is used instead. After use_read_only_catalogs() is called, the catalog file is
+    opened read-only (or, if it doesn't exist, a catalog in memory is used).
+
+    Args:
+        studydir (str): path of parent directory of fmriprep directory (basedir + studyid)
+    Returns:
+        StudyCatalog object
+
+    """
+    studydir = os.path.abspath(studydir)
+    if studydir not in _catalogs:
+        try:
+            catalog = StudyCatalog(studydir, read_only=_read_only)
+        except sqlite3.Error as e:
+            print("WARNING: Could not open the study catalog in %s (%s). Directories will be listed again." % (
+                studydir, e))
+            catalog = StudyCatalog(studydir, persistent=False)
+        _catalogs[studydir] = catalog
+        atexit.register(catalog.close)
+    return _catalogs[studydir]
+
+
+def use_read_only_catalogs():
+    """Makes the catalogs opened by this process from now on read-only
+
+    Called by the compute jobs (run_feat_job.py), many of which run at the same time: they only read the listings and
+    headers that the planning process cached, and only the planning process writes to the catalog.
+    """
+    global _read_only
+    _read_only = True
+
+
+def commit_catalogs():
+    """Writes the queued updates of every catalog opened by this process"""
+    for catalog in list(_catalogs.values()):
+        catalog.commit()
+
+
+def forget_catalogs():
+    """Drops the catalogs opened by this process without closing them
+
+    Used in forked worker processes, which must open their own connections instead of sharing the parent's.
+    """
+    _catalogs.clear()
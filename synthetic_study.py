@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Creates a synthetic fmriprep study for benchmarking and testing the pipeline
+Files have the names and layout that fmriprep uses, but the NIfTI files only contain a valid header and a tiny image
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import struct
+import sys
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='synthetic_study')
+
+    parser.add_argument('--studyid', dest='studyid',
+                        required=True, help='Study ID')
+    parser.add_argument('--basedir', dest='basedir',
+                        required=True, help='Base directory (above studyid directory)')
+    parser.add_argument('-m', '--modelname', dest='modelname',
+                        default='bench', help='Model name')
+    parser.add_argument('--nsubs', dest='nsubs', type=int,
+                        default=10, help='Number of subjects')
+    parser.add_argument('--nsessions', dest='nsessions', type=int,
+                        default=0, help='Number of sessions per subject (0 for no session folders)')
+    parser.add_argument('--tasks', dest='tasks', nargs='+',
+                        default=['flanker'], help='Task names')
+    parser.add_argument('--nruns', dest='nruns', type=int,
+                        default=2, help='Number of runs per task')
+    parser.add_argument('--nevs', dest='nevs', type=int,
+                        default=4, help='Number of EVs per task')
+    parser.add_argument('--npts', dest='npts', type=int,
+                        default=200, help='Number of timepoints in each functional run')
+    parser.add_argument('--nconfounds', dest='nconfounds', type=int,
+                        default=200, help='Number of columns in each fmriprep confounds file')
+    parser.add_argument('--featdirs', dest='featdirs', action='store_true',
+                        default=False, help='Also create empty level 1 feat and level 2 gfeat directories, so that '
+                                            'level 2 and level 3 fsf\'s can be generated')
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def nifti1_header(dims, pixdims, datatype=16, bitpix=32, xyzt_units=10):
+    """Returns the bytes of a little-endian NIfTI-1 header (348 bytes) followed by an empty extension block
+
+    Args:
+        dims (list): size of each dimension, e.g. [91, 109, 91, 200]
+        pixdims (list): voxel size of each dimension; the 4th is the repetition time
+        datatype (int): NIfTI datatype code (16 = float32)
+        bitpix (int): number of bits per voxel
+        xyzt_units (int): NIfTI units code (10 = mm and seconds)
+    """
+    dim = [len(dims)] + list(dims) + [1] * (7 - len(dims))
+    pixdim = [1.0] + list(pixdims) + [1.0] * (7 - len(pixdims))
+    header = struct.pack('<i', 348)
+    header += b'\x00' * 36  # data_type, db_name, extents, session_error, regular, dim_info
+    header += struct.pack('<8h', *dim)
+    header += struct.pack('<3f', 0, 0, 0)  # intent_p1, intent_p2, intent_p3
+    header += struct.pack('<hhhh', 0, datatype, bitpix, 0)  # intent_code, datatype, bitpix, slice_start
+    header += struct.pack('<8f', *pixdim)
+    header += struct.pack('<f', 352)  # vox_offset
+    header += struct.pack('<ff', 1, 0)  # scl_slope, scl_inter
+    header += struct.pack('<hbb', 0, 0, xyzt_units)  # slice_end, slice_code, xyzt_units
+    header += b'\x00' * (348 - 4 - len(header) - 4)
+    header += b'n+1\x00'
+    return header + b'\x00' * 4
+
+
+def write_nifti(path, dims, pixdims):
+    """Writes a gzipped NIfTI-1 file with the given header and a single voxel of data"""
+    with gzip.open(path, 'wb', compresslevel=1) as f:
+        f.write(nifti1_header(dims, pixdims))
+        f.write(b'\x00' * 4)
+
+
+def confound_columns(nconfounds):
+    """Returns the columns of a synthetic fmriprep confounds file"""
+    columns = ['global_signal', 'csf', 'white_matter', 'dvars', 'std_dvars', 'framewise_displacement',
+               'trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+    i = 0
+    while len(columns) < nconfounds:
+        columns.append('a_comp_cor_%02d' % i)
+        i += 1
+    return columns
+
+
+def write_confounds(path, columns, npts, rng):
+    with open(path, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for t in range(npts):
+            values = []
+            for c in columns:
+                if t == 0 and c in ('dvars', 'std_dvars', 'framewise_displacement'):
+                    values.append('n/a')
+                elif c == 'framewise_displacement':
+                    values.append('%.4f' % abs(rng.gauss(0.15, 0.1)))
+                else:
+                    values.append('%.4f' % rng.gauss(0, 1))
+            f.write('\t'.join(values) + '\n')
+
+
+def make_feat_dirs(featdir, ncopes):
+    """Creates an empty feat directory with the folders FEAT writes (stats, reg) and, for a gfeat, cope directories"""
+    if featdir.endswith('.gfeat'):
+        for cope in range(1, ncopes + 1):
+            make_feat_dirs(os.path.join(featdir, 'cope%d.feat' % cope), ncopes)
+    else:
+        os.makedirs(os.path.join(featdir, 'stats'), exist_ok=True)
+        os.makedirs(os.path.join(featdir, 'reg'), exist_ok=True)
+        for cope in range(1, ncopes + 1):
+            open(os.path.join(featdir, 'stats', 'zstat%d.nii.gz' % cope), 'w').close()
+
+
+def make_study(studyid, basedir, modelname='bench', nsubs=10, nsessions=0, tasks=('flanker',), nruns=2, nevs=4,
+               npts=200, nconfounds=200, featdirs=False, seed=0):
+    """Creates a synthetic fmriprep directory and a level 1 model directory under basedir/studyid
+    If featdirs is True, empty level 1 feat and level 2 gfeat directories are created as well
+
+    Returns:
+        the specificruns dictionary describing all the runs that were created
+    """
+    rng = random.Random(seed)
+    studydir = os.path.join(basedir, studyid)
+    fmriprep = os.path.join(studydir, 'fmriprep')
+    modeldir = os.path.join(studydir, 'model', 'level1', 'model-%s' % modelname)
+    lev2_modeldir = os.path.join(studydir, 'model', 'level2', 'model-%s' % modelname)
+    ncopes = nevs + 2  # one per EV, one across all EVs and one task contrast
+    columns = confound_columns(nconfounds)
+    space = 'space-MNI152NLin2009cAsym'
+
+    specificruns = {}
+    for s in range(1, nsubs + 1):
+        subid = 'sub-%03d' % s
+        specificruns[subid] = {}
+        anatdir = os.path.join(fmriprep, subid, 'anat')
+        os.makedirs(anatdir, exist_ok=True)
+        write_nifti(os.path.join(anatdir, '%s_%s_desc-preproc_T1w.nii.gz' % (subid, space)), [97, 115, 97],
+                    [2.0, 2.0, 2.0])
+        sessions = ['ses-%02d' % i for i in range(1, nsessions + 1)] or ['']
+        for ses in sessions:
+            prefix = subid + ('_' + ses if ses else '')
+            funcdir = os.path.join(fmriprep, subid, ses, 'func')
+            os.makedirs(funcdir, exist_ok=True)
+            task_runs = {}
+            for task in tasks:
+                runs = [str(r) for r in range(1, nruns + 1)]
+                task_runs[task] = runs
+                for run in runs:
+                    fileprefix = '%s_task-%s_run-%s' % (prefix, task, run)
+                    write_nifti(os.path.join(funcdir, '%s_%s_desc-preproc_bold.nii.gz' % (fileprefix, space)),
+                                [97, 115, 97, npts], [2.0, 2.0, 2.0, 2.0])
+                    write_nifti(os.path.join(funcdir, '%s_%s_desc-brain_mask.nii.gz' % (fileprefix, space)),
+                                [97, 115, 97], [2.0, 2.0, 2.0])
+                    with open(os.path.join(funcdir, '%s_%s_desc-preproc_bold.json' % (fileprefix, space)), 'w') as f:
+                        json.dump({'RepetitionTime': 2.0}, f)
+                    write_confounds(os.path.join(funcdir, '%s_desc-confounds_timeseries.tsv' % fileprefix), columns,
+                                    npts, rng)
+                    # EV files
+                    onsetsdir = os.path.join(modeldir, subid, ses, 'task-%s_run-%s' % (task, run), 'onsets')
+                    os.makedirs(onsetsdir, exist_ok=True)
+                    for ev in range(1, nevs + 1):
+                        with open(os.path.join(onsetsdir, '%s_ev-%03d.tsv' % (fileprefix, ev)), 'w') as f:
+                            for trial in range(10):
+                                f.write('%.1f\t1.0\t1\n' % (trial * 20 + ev * 2))
+                    if featdirs:
+                        make_feat_dirs(os.path.join(os.path.dirname(onsetsdir), '%s.feat' % fileprefix), ncopes)
+                if featdirs:
+                    make_feat_dirs(os.path.join(lev2_modeldir, subid, ses, 'task-%s' % task,
+                                                '%s_task-%s.gfeat' % (prefix, task)), ncopes)
+            if ses:
+                specificruns[subid][ses] = task_runs
+            else:
+                specificruns[subid] = task_runs
+
+    params = {'studyid': studyid, 'basedir': basedir, 'specificruns': specificruns, 'modelname': modelname,
+              'smoothing': 0, 'use_inplane': 0, 'nonlinear': False, 'nohpf': True, 'nowhiten': True,
+              'noconfound': False, 'anatimg': '', 'doreg': False, 'spacetag': '', 'usebrainmask': False}
+    with open(os.path.join(modeldir, 'model_params.json'), 'w') as f:
+        json.dump(params, f, sort_keys=True, indent=4)
+    with open(os.path.join(modeldir, 'condition_key.json'), 'w') as f:
+        json.dump({task: {str(ev): 'cond%d' % ev for ev in range(1, nevs + 1)} for task in tasks}, f, indent=4)
+    with open(os.path.join(modeldir, 'task_contrasts.json'), 'w') as f:
+        json.dump({task: {'cond2_vs_cond1': [-1, 1] + [0] * (nevs - 2)} for task in tasks}, f, indent=4)
+    with open(os.path.join(modeldir, 'confounds.json'), 'w') as f:
+        json.dump({'confounds': columns[6:12] + ['framewise_displacement']}, f, indent=4)
+    return specificruns
+
+
+def main(argv=None):
+    args = parse_command_line(argv)
+    if os.path.exists(os.path.join(args.basedir, args.studyid)):
+        print("ERROR: %s already exists" % os.path.join(args.basedir, args.studyid))
+        sys.exit(-1)
+    make_study(args.studyid, args.basedir, args.modelname, args.nsubs, args.nsessions, args.tasks, args.nruns,
+               args.nevs, args.npts, args.nconfounds, args.featdirs)
+    print('Created synthetic study in %s' % os.path.join(args.basedir, args.studyid))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the pipeline are scripts at the top of the repository, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+import confound_expansions
+
+MOTION = pd.DataFrame({
+    'trans_x': [0.0, 1.0, 3.0, 2.0],
+    'framewise_displacement': [np.nan, 0.2, 0.9, 0.1],
+    'std_dvars': [np.nan, 1.0, 1.0, 2.0],
+    'a_comp_cor_00': [0.1, 0.2, 0.3, 0.4],
+    'a_comp_cor_01': [0.5, 0.6, 0.7, 0.8],
+})
+
+
+def test_no_expansions():
+    cf = confound_expansions.expand_confounds(MOTION, ['trans_x', 'missing'], None)
+    assert list(cf.columns) == ['trans_x', 'missing']
+    assert np.isnan(cf['missing']).all()
+
+
+def test_derivatives_and_squares():
+    expansions = {'derivatives': ['trans_x'], 'squares': ['trans_x', 'trans_x_derivative1']}
+    cf = confound_expansions.expand_confounds(MOTION, ['trans_x'], expansions)
+    assert list(cf.columns) == ['trans_x', 'trans_x_derivative1', 'trans_x_power2', 'trans_x_derivative1_power2']
+    # backward difference: the first volume has no derivative
+    np.testing.assert_array_equal(cf['trans_x_derivative1'], [np.nan, 1.0, 2.0, -1.0])
+    np.testing.assert_array_equal(cf['trans_x_power2'], [0.0, 1.0, 9.0, 4.0])
+    np.testing.assert_array_equal(cf['trans_x_derivative1_power2'], [np.nan, 1.0, 4.0, 1.0])
+
+
+def test_columns_from_the_file_are_reused():
+    df = MOTION.assign(trans_x_derivative1=[0.0, 7.0, 7.0, 7.0])
+    cf = confound_expansions.expand_confounds(df, ['trans_x'], {'squares': ['trans_x_derivative1']})
+    np.testing.assert_array_equal(cf['trans_x_derivative1_power2'], [0.0, 49.0, 49.0, 49.0])
+
+
+def test_missing_columns_are_nan():
+    cf = confound_expansions.expand_confounds(MOTION, ['trans_x'], {'derivatives': ['rot_x'], 'acompcor': 3})
+    assert np.isnan(cf['rot_x_derivative1']).all()
+    np.testing.assert_array_equal(cf['a_comp_cor_01'], MOTION['a_comp_cor_01'])
+    assert np.isnan(cf['a_comp_cor_02']).all()
+
+
+def test_spikes():
+    cf = confound_expansions.expand_confounds(MOTION, ['trans_x'],
+                                              {'spikes': {'framewise_displacement': 0.5, 'std_dvars': 1.5}})
+    # volumes 2 (FD) and 3 (DVARS) are over a threshold; the NaN of the first volume never is
+    assert list(cf.columns) == ['trans_x', 'spike_00', 'spike_01']
+    np.testing.assert_array_equal(cf['spike_00'], [0, 0, 1, 0])
+    np.testing.assert_array_equal(cf['spike_01'], [0, 0, 0, 1])
+    assert confound_expansions.get_spikes(MOTION, {'framewise_displacement': 5.0}).shape == (4, 0)
+
+
+def test_check_expansions():
+    assert confound_expansions.check_expansions({'derivatives': ['trans_x'], 'spikes': {'std_dvars': 1.5},
+                                                 'acompcor': 6}) is None
+    assert confound_expansions.check_expansions([]) is not None
+    assert confound_expansions.check_expansions({'cubes': ['trans_x']}) is not None
+    assert confound_expansions.check_expansions({'squares': 'trans_x'}) is not None
+    assert confound_expansions.check_expansions({'spikes': {'std_dvars': True}}) is not None
+    assert confound_expansions.check_expansions({'acompcor': -1}) is not None
+
+
+def test_required_columns():
+    expansions = {'derivatives': ['trans_x'], 'squares': ['trans_x_derivative1'],
+                  'spikes': {'framewise_displacement': 0.5}, 'acompcor': 2}
+    assert confound_expansions.get_required_columns(['trans_x', 'csf'], expansions) == [
+        'trans_x', 'csf', 'framewise_displacement', 'a_comp_cor_00', 'a_comp_cor_01']
+    assert confound_expansions.get_num_columns(expansions) == 4
@@ -0,0 +1,78 @@
+import os
+
+import fingerprint
+
+SETTINGS = {'smoothing': 6, 'confounds': ['trans_x']}
+
+
+def _write_fsf(fsfname, settings, inputs):
+    fp = fingerprint.Fingerprint(settings)
+    for path in inputs:
+        fp.add(path)
+    with open(fsfname, 'w') as f:
+        f.write('set fmri(level) 1\n')
+        f.write('\n' + fp.comment())
+
+
+def _write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def test_is_up_to_date(tmp_path):
+    ev = str(tmp_path / 'ev.tsv')
+    missing = str(tmp_path / 'missing.tsv')
+    fsfname = str(tmp_path / 'run.fsf')
+    _write(ev, '0\t1\t1\n')
+    _write_fsf(fsfname, SETTINGS, [ev, missing])
+    assert fingerprint.is_up_to_date(fsfname, SETTINGS) is True
+    assert fingerprint.is_up_to_date(fsfname, dict(SETTINGS, smoothing=5)) is False
+
+    # the same contents with a new mtime don't make the fsf out of date
+    os.utime(ev, ns=(0, 0))
+    assert fingerprint.is_up_to_date(fsfname, SETTINGS) is True
+
+    _write(ev, '0\t1\t1\n10\t1\t1\n')
+    assert fingerprint.is_up_to_date(fsfname, SETTINGS) is False
+
+
+def test_new_input_file(tmp_path):
+    missing = str(tmp_path / 'missing.tsv')
+    fsfname = str(tmp_path / 'run.fsf')
+    _write_fsf(fsfname, SETTINGS, [missing])
+    assert fingerprint.is_up_to_date(fsfname, SETTINGS) is True
+    _write(missing, '0\t1\t1\n')
+    assert fingerprint.is_up_to_date(fsfname, SETTINGS) is False
+
+
+def test_no_fingerprint(tmp_path):
+    fsfname = str(tmp_path / 'run.fsf')
+    _write(fsfname, 'set fmri(level) 1\n')
+    assert fingerprint.is_up_to_date(fsfname, SETTINGS) is None
+    assert fingerprint.is_up_to_date(str(tmp_path / 'missing.fsf'), SETTINGS) is None
+
+
+def test_is_output_up_to_date_reads_design_fsf(tmp_path):
+    ev = str(tmp_path / 'ev.tsv')
+    fsfname = str(tmp_path / 'run.fsf')
+    featdir = str(tmp_path / 'run.feat')
+    _write(ev, '0\t1\t1\n')
+    _write_fsf(fsfname, SETTINGS, [ev])
+    os.mkdir(featdir)
+    _write(fingerprint.get_output_fsfname(featdir), open(fsfname).read())
+    assert fingerprint.is_output_up_to_date(featdir, fsfname, SETTINGS) is True
+
+    # writing the fsf again (e.g. with --nofeat) doesn't make the existing output up to date
+    _write(ev, '0\t1\t1\n10\t1\t1\n')
+    _write_fsf(fsfname, SETTINGS, [ev])
+    assert fingerprint.is_up_to_date(fsfname, SETTINGS) is True
+    assert fingerprint.is_output_up_to_date(featdir, fsfname, SETTINGS) is False
+
+
+def test_is_output_up_to_date_without_design_fsf(tmp_path):
+    # feat didn't get as far as saving design.fsf, so the fsf it was run on is used
+    fsfname = str(tmp_path / 'run.fsf')
+    featdir = str(tmp_path / 'run.feat')
+    _write_fsf(fsfname, SETTINGS, [])
+    os.mkdir(featdir)
+    assert fingerprint.is_output_up_to_date(featdir, fsfname, SETTINGS) is True
@@ -0,0 +1,36 @@
+import pytest
+
+import job_manifest
+
+JOBS = [['--studyid', 's', '--basedir', '/data', '--sub', sub, '--runname', run] for sub in ['01', '02'] for run in
+        ['1', '2', '3']]
+
+
+def test_read_job_returns_each_job(tmp_path):
+    manifest_path = job_manifest.write_manifest(str(tmp_path), JOBS, 1)
+    assert job_manifest.read_header(manifest_path)['shared'] == ['--studyid', 's', '--basedir', '/data', '--sub']
+    for i, job in enumerate(JOBS):
+        assert job_manifest.read_job(manifest_path, i) == job
+    assert job_manifest.read_jobs(manifest_path) == JOBS
+
+
+def test_read_job_level3_paths(tmp_path):
+    jobs = ['/data/cope1.fsf', '/data/cope2.fsf']
+    manifest_path = job_manifest.write_manifest(str(tmp_path), jobs, 3)
+    assert [job_manifest.read_job(manifest_path, i) for i in range(len(jobs))] == jobs
+
+
+@pytest.mark.parametrize('i', [-1, -100, len(JOBS), len(JOBS) + 10])
+def test_read_job_out_of_bounds(tmp_path, i):
+    manifest_path = job_manifest.write_manifest(str(tmp_path), JOBS, 1)
+    with pytest.raises(IndexError):
+        job_manifest.read_job(manifest_path, i)
+
+
+def test_read_job_truncated_index(tmp_path):
+    manifest_path = job_manifest.write_manifest(str(tmp_path), JOBS, 1)
+    with open(manifest_path + job_manifest.INDEX_SUFFIX, 'r+b') as f:
+        f.truncate(2 * job_manifest._OFFSET.size)
+    assert job_manifest.read_job(manifest_path, 1) == JOBS[1]
+    with pytest.raises(ValueError):
+        job_manifest.read_job(manifest_path, 2)
@@ -0,0 +1,28 @@
+import signal
+import subprocess
+import sys
+import time
+
+import job_metrics
+
+
+def test_run_exit_codes():
+    assert job_metrics.run([sys.executable, '-c', 'pass'])[0] == 0
+    exitcode, usage = job_metrics.run([sys.executable, '-c', 'import sys; sys.exit(3)'])
+    assert exitcode == 3
+    assert usage['wall_s'] >= 0
+    # a command killed by a signal has the negative signal number, like Popen.returncode
+    exitcode, usage = job_metrics.run([sys.executable, '-c', 'import os, signal; os.kill(os.getpid(), signal.SIGKILL)'])
+    assert exitcode == -signal.SIGKILL
+
+
+def test_poll_exit_code():
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', 'import time, sys; time.sleep(0.5); sys.exit(2)'])
+    assert job_metrics.poll(proc, start) is None
+    result = None
+    while result is None:
+        time.sleep(0.05)
+        result = job_metrics.poll(proc, start)
+    assert result[0] == 2
+    assert proc.returncode == 2
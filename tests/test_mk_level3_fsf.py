@@ -0,0 +1,53 @@
+import os
+import re
+
+import job_state
+import mk_level3_fsf
+import synthetic_study
+
+NCOPES = 3  # one EV, one across all EVs and one task contrast
+
+
+def _make_gfeat(studydir, sub, ncopes):
+    gfeat = os.path.join(studydir, 'model/level2/model-bench/sub-%s/task-flanker' % sub,
+                         'sub-%s_task-flanker.gfeat' % sub)
+    for copenum in range(1, ncopes + 1):
+        statsdir = os.path.join(gfeat, 'cope%d.feat' % copenum, 'stats')
+        os.makedirs(statsdir)
+        open(os.path.join(statsdir, 'zstat1.nii.gz'), 'w').close()
+    return gfeat
+
+
+def _get_feat_files(studyid, basedir, complete_inputs):
+    argv = ['--studyid', studyid, '--basedir', basedir, '-m', 'bench', '--taskname', 'flanker', '--copes', '1']
+    if complete_inputs:
+        argv.append('--complete-inputs')
+    fsfname = mk_level3_fsf.mk_level3_fsf(mk_level3_fsf.parse_command_line(argv))[0]
+    with open(fsfname) as f:
+        return re.findall(r'set feat_files\(\d+\) "(.*)"', f.read())
+
+
+def test_incomplete_level2_outputs_are_left_out(tmp_path, capsys):
+    basedir = str(tmp_path)
+    studydir = os.path.join(basedir, 's')
+    synthetic_study.make_study('s', basedir, nsubs=4, nevs=1, nruns=1, npts=10, nconfounds=5)
+    complete = _make_gfeat(studydir, '001', NCOPES)
+    # feat failed after writing the first cope
+    partial = _make_gfeat(studydir, '002', 1)
+    # the outputs look complete, but the job failed
+    failed = _make_gfeat(studydir, '003', NCOPES)
+    job_state.open_store(studydir).set(failed, 2, job_state.FAILED)
+    # the job was killed while it was running (e.g. by slurm when it ran out of time)
+    killed = _make_gfeat(studydir, '004', NCOPES)
+    job_state.open_store(studydir).set(killed, 2, job_state.RUNNING)
+
+    assert job_state.check_finished_output(studydir, complete, 2, NCOPES) == (True, '')
+    assert not job_state.check_finished_output(studydir, partial, 2, NCOPES)[0]
+
+    assert _get_feat_files('s', basedir, False) == [
+        os.path.join(gfeat, 'cope1.feat') for gfeat in [complete, partial, failed, killed]]
+    capsys.readouterr()
+    assert _get_feat_files('s', basedir, True) == [os.path.join(complete, 'cope1.feat')]
+    out = capsys.readouterr().out
+    for gfeat in [partial, failed, killed]:
+        assert 'WARNING: The level 2 output %s is incomplete' % os.path.join(gfeat, 'cope1.feat') in out
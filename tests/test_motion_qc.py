@@ -0,0 +1,65 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import motion_qc
+
+THRESHOLDS = dict(motion_qc.DEFAULT_THRESHOLDS)
+
+
+def _motion(mean_fd=0.1, max_fd=0.3, pct_over=0.0):
+    return {'nvols': 100, 'mean_fd': mean_fd, 'max_fd': max_fd, 'pct_fd_over': pct_over, 'mean_dvars': np.nan,
+            'pct_dvars_over': np.nan, 'pct_over': pct_over}
+
+
+def test_get_exclusion_reason():
+    assert motion_qc.get_exclusion_reason(_motion(), THRESHOLDS) == ''
+    assert motion_qc.get_exclusion_reason(_motion(mean_fd=0.25), THRESHOLDS) == 'mean FD 0.2500 > 0.2'
+    assert motion_qc.get_exclusion_reason(_motion(mean_fd=0.25, pct_over=30.0), THRESHOLDS) == \
+        'mean FD 0.2500 > 0.2; 30.0% of volumes over threshold > 20.0%'
+    # max_fd is not checked unless it is set
+    assert motion_qc.get_exclusion_reason(_motion(max_fd=5.0), THRESHOLDS) == ''
+    assert motion_qc.get_exclusion_reason(_motion(max_fd=5.0), dict(THRESHOLDS, max_fd=3)) == 'max FD 5.0000 > 3'
+    # runs whose motion couldn't be computed are not excluded
+    assert motion_qc.get_exclusion_reason(_motion(mean_fd=np.nan, max_fd=np.nan, pct_over=np.nan), THRESHOLDS) == ''
+    assert motion_qc.get_exclusion_reason(_motion(mean_fd=1.0, pct_over=100.0),
+                                          dict(THRESHOLDS, max_mean_fd=None, max_pct_over=None)) == ''
+
+
+def _table(rows):
+    return pd.DataFrame([dict(zip(['sub', 'ses', 'task', 'run', 'excluded'], row)) for row in rows])
+
+
+def test_prune_specificruns_with_sessions():
+    specificruns = {'sub-01': {'ses-01': {'flanker': ['1', '2'], 'stroop': ['1']}, 'ses-02': {'flanker': ['1']}},
+                    'sub-02': {'ses-01': {'flanker': ['1']}}}
+    original = copy.deepcopy(specificruns)
+    table = _table([('01', '01', 'flanker', '1', 1), ('01', '01', 'flanker', '2', 0), ('01', '01', 'stroop', '1', 1),
+                    ('01', '02', 'flanker', '1', 1), ('02', '01', 'flanker', '1', 1)])
+    assert motion_qc.prune_specificruns(specificruns, table) == {'sub-01': {'ses-01': {'flanker': ['2']}}}
+    assert specificruns == original
+
+
+def test_prune_specificruns_without_sessions():
+    specificruns = {'sub-01': {'flanker': ['1', '2']}, 'sub-02': {'flanker': ['1']}}
+    table = _table([('01', '', 'flanker', '2', 1), ('02', '', 'flanker', '1', 1)])
+    assert motion_qc.prune_specificruns(specificruns, table) == {'sub-01': {'flanker': ['1']}}
+    assert motion_qc.prune_specificruns(specificruns, _table([('01', '', 'flanker', '2', 0)])) == specificruns
+
+
+def test_get_run_motion(tmp_path):
+    path = str(tmp_path / 'sub-01_task-flanker_run-1_desc-confounds_timeseries.tsv')
+    pd.DataFrame({'csf': [1.0, 2.0, 3.0, 4.0], 'framewise_displacement': [np.nan, 0.2, 0.8, 0.2],
+                  'std_dvars': [np.nan, 1.0, 1.0, 2.0]}).to_csv(path, sep='\t', index=False, na_rep='n/a')
+    motion = motion_qc.get_run_motion(path, 0.5)
+    assert motion['nvols'] == 4
+    assert motion['mean_fd'] == pytest.approx(0.4)
+    assert motion['max_fd'] == pytest.approx(0.8)
+    assert motion['pct_over'] == pytest.approx(25.0)
+    assert np.isnan(motion['mean_dvars'])
+    # a volume over either threshold counts once
+    motion = motion_qc.get_run_motion(path, 0.5, dvars_threshold=1.5)
+    assert motion['pct_dvars_over'] == pytest.approx(25.0)
+    assert motion['pct_over'] == pytest.approx(50.0)
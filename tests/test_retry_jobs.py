@@ -0,0 +1,48 @@
+import pytest
+
+import retry_jobs
+
+
+@pytest.mark.parametrize('sacct_row, expected', [
+    ({'states': ['FAILED', 'OUT_OF_MEMORY'], 'max_rss_mb': None}, retry_jobs.OOM),
+    ({'states': ['TIMEOUT'], 'max_rss_mb': 100.0}, retry_jobs.TIMEOUT),
+    ({'states': ['DEADLINE'], 'max_rss_mb': None}, retry_jobs.TIMEOUT),
+    # older versions of slurm report jobs killed by the OOM killer as FAILED
+    ({'states': ['FAILED'], 'max_rss_mb': 1000.0}, retry_jobs.OOM),
+    ({'states': ['FAILED'], 'max_rss_mb': 100.0}, retry_jobs.OTHER),
+])
+def test_classify_failure_sacct(sacct_row, expected):
+    assert retry_jobs.classify_failure(None, sacct_row, 1024, '01:00:00') == expected
+
+
+@pytest.mark.parametrize('record, expected', [
+    (None, retry_jobs.OTHER),
+    ({'exit_code': 137}, retry_jobs.OOM),
+    ({'exit_code': -9}, retry_jobs.OOM),
+    ({'exit_code': 1, 'max_rss_mb': 1000.0}, retry_jobs.OOM),
+    ({'exit_code': 124}, retry_jobs.TIMEOUT),
+    ({'exit_code': 1, 'runtime': 3600.0}, retry_jobs.TIMEOUT),
+    ({'exit_code': 1, 'max_rss_mb': 100.0, 'runtime': 60.0}, retry_jobs.OTHER),
+])
+def test_classify_failure_record(record, expected):
+    assert retry_jobs.classify_failure(record, None, 1024, '01:00:00') == expected
+
+
+def test_parse_sacct_mem():
+    assert retry_jobs._parse_sacct_mem('2048K') == 2.0
+    assert retry_jobs._parse_sacct_mem('1.5G') == 1536.0
+    assert retry_jobs._parse_sacct_mem('') is None
+
+
+def test_escalate():
+    failed = [dict(job=['--sub', str(i)], attempts=1, time='01:00:00', mem=1000, reason=reason)
+              for i, reason in enumerate([retry_jobs.OOM, retry_jobs.TIMEOUT, retry_jobs.OTHER])]
+    retries, skipped = retry_jobs.escalate(failed, 2.0, 1.5, 4096, '02:00:00', 2)
+    assert [(retry['mem'], retry['time']) for retry in retries] == [(2048, '01:00:00'), (1000, '01:30:00')]
+    assert [attempt['reason'] for attempt, reason in skipped] == [retry_jobs.OTHER]
+
+    # the escalated resources are capped, and jobs that already have the maximum are not retried
+    retries, skipped = retry_jobs.escalate([dict(failed[0], mem=3000), dict(failed[1], time='02:00:00')], 2.0, 1.5,
+                                           4096, '02:00:00', 2)
+    assert [retry['mem'] for retry in retries] == [4096]
+    assert len(skipped) == 1
@@ -0,0 +1,46 @@
+import slurm_utils
+
+
+def _record_submits(monkeypatch):
+    calls = []
+
+    def submit(sbatch_path, array=None, dependency=None, export=None, output=None):
+        calls.append({'array': array, 'dependency': dependency, 'export': export, 'output': output})
+        return str(1000 + len(calls))
+
+    monkeypatch.setattr(slurm_utils, 'submit', submit)
+    return calls
+
+
+def test_get_array_chunks():
+    assert slurm_utils.get_array_chunks(5, 2) == [(0, 2), (2, 2), (4, 1)]
+    assert slurm_utils.get_array_chunks(4, 4) == [(0, 4)]
+    assert slurm_utils.get_array_chunks(0, 4) == []
+
+
+def test_submit_array_single_chunk(monkeypatch):
+    calls = _record_submits(monkeypatch)
+    task_ids = slurm_utils.submit_array('x.sbatch', 3, max_array_size=10, output='out_%a.txt')
+    assert task_ids == ['1001_0', '1001_1', '1001_2']
+    assert calls == [{'array': '0-2', 'dependency': None, 'export': {'FMRI_PIPELINE_ARRAY_OFFSET': 0},
+                      'output': None}]
+
+
+def test_submit_array_chunks(monkeypatch):
+    calls = _record_submits(monkeypatch)
+    task_ids = slurm_utils.submit_array('x.sbatch', 5, max_array_size=2, throttle=3, dependency='afterok:7',
+                                        output='out_%a.txt')
+    assert task_ids == ['1001_0', '1001_1', '1002_0', '1002_1', '1003_0']
+    assert [call['array'] for call in calls] == ['0-1%3', '0-1%3', '0-0%3']
+    assert [call['export']['FMRI_PIPELINE_ARRAY_OFFSET'] for call in calls] == [0, 2, 4]
+    # each chunk waits for the one before it
+    assert [call['dependency'] for call in calls] == ['afterok:7', 'afterany:1001', 'afterany:1002']
+    # the chunks don't overwrite each other's output
+    assert all(call['output'] == 'out_%A_%a.txt' for call in calls)
+
+
+def test_submit_array_offset(monkeypatch):
+    calls = _record_submits(monkeypatch)
+    slurm_utils.submit_array('x.sbatch', 3, max_array_size=10, output='out_%a.txt', offset=6)
+    assert calls[0]['export'] == {'FMRI_PIPELINE_ARRAY_OFFSET': 6}
+    assert calls[0]['output'] == 'out_%A_%a.txt'
@@ -0,0 +1,91 @@
+import sqlite3
+
+import pytest
+
+import work_queue
+
+JOBS = ['/data/cope1.fsf', '/data/cope2.fsf', '/data/cope3.fsf']
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return work_queue.create_queue(str(tmp_path), JOBS, 3, priorities=[1, 5, 1])
+
+
+def _age_heartbeats(queue_path, seconds):
+    conn = sqlite3.connect(queue_path)
+    with conn:
+        conn.execute('UPDATE jobs SET heartbeat = heartbeat - ?', (seconds,))
+    conn.close()
+
+
+def test_claim_order(queue_path):
+    queue = work_queue.WorkQueue(queue_path, 'w0')
+    # highest priority first, then in the order of the jobs
+    assert queue.claim() == (1, 3)
+    assert queue.claim() == (0, 3)
+    assert queue.claim() == (2, 3)
+    assert queue.claim() == (None, 3)
+    assert queue.finish(1, 0)
+    assert queue.finish(0, 2)
+    assert queue.claim() == (None, 1)
+    assert queue.get_counts() == {work_queue.PENDING: 0, work_queue.CLAIMED: 1, work_queue.DONE: 1,
+                                  work_queue.FAILED: 1}
+    assert queue.get_failed() == [(0, 2, 1)]
+    queue.close()
+
+
+def test_stale_job_is_given_back(queue_path):
+    first = work_queue.WorkQueue(queue_path, 'w0')
+    second = work_queue.WorkQueue(queue_path, 'w1')
+    i, _ = first.claim()
+    assert first.heartbeat(i)
+    _age_heartbeats(queue_path, work_queue.HEARTBEAT_TIMEOUT + 1)
+    # the next claim gives the job back and claims it again, as it has the highest priority
+    assert second.claim()[0] == i
+    assert not first.heartbeat(i)
+    assert not first.finish(i, 0)
+    assert second.finish(i, 0)
+    first.close()
+    second.close()
+
+
+def test_job_fails_after_max_attempts(queue_path):
+    queue = work_queue.WorkQueue(queue_path, 'w0')
+    for attempt in range(work_queue.MAX_ATTEMPTS):
+        assert queue.claim()[0] == 1
+        _age_heartbeats(queue_path, work_queue.HEARTBEAT_TIMEOUT + 1)
+    # the job that stopped its worker MAX_ATTEMPTS times is not claimed again
+    assert queue.claim()[0] == 0
+    assert queue.get_failed() == [(1, None, work_queue.MAX_ATTEMPTS)]
+    queue.close()
+
+
+def test_heartbeat_retries(queue_path, monkeypatch):
+    monkeypatch.setattr(work_queue, 'WRITE_RETRY_INTERVAL', 0)
+    queue = work_queue.WorkQueue(queue_path, 'w0')
+    i, _ = queue.claim()
+    conn = queue._conn
+    failures = [sqlite3.OperationalError('database is locked')] * 2
+
+    class FlakyConnection(object):
+        def execute(self, *args):
+            if len(failures) > 0:
+                raise failures.pop()
+            return conn.execute(*args)
+
+    queue._conn = FlakyConnection()
+    assert queue.heartbeat(i)
+    assert len(failures) == 0
+
+    class LockedConnection(object):
+        def execute(self, *args):
+            raise sqlite3.OperationalError('database is locked')
+
+    queue._conn = LockedConnection()
+    # the job keeps running if its heartbeat can't be written, but its end has to be recorded
+    assert queue.heartbeat(i)
+    with pytest.raises(sqlite3.OperationalError):
+        queue.finish(i, 0)
+    queue._conn = conn
+    queue.close()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+"""
+Shared work queue of feat jobs, so that long-lived workers pull jobs instead of each array task running a fixed job
+The jobs are written to a job manifest (see job_manifest.py) and their states to an SQLite file next to it
+(queue.sqlite). Each worker claims the next pending job in a transaction that locks the database (BEGIN IMMEDIATE),
+runs it with run_feat_job.py and updates a heartbeat while it runs. A job whose worker stopped sending heartbeats (e.g.
+the slurm task was killed) is given back to the queue, up to MAX_ATTEMPTS times, by the next worker that claims a job;
+if the first worker is still alive, it stops its copy of the job at its next heartbeat.
+Jobs are claimed from the largest to the smallest (by their priority), so a worker that finishes a short job picks up
+the next one instead of sitting idle.
+SQLite locks with fcntl, which needs a shared filesystem with working POSIX locks (NFSv4, Lustre and GPFS have them).
+Run this script on a queue to start workers (e.g. from each task of a job array) or to print the state of its jobs.
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import job_manifest
+import job_state
+import slurm_utils
+
+QUEUE_FILENAME = 'queue.sqlite'
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+# seconds between the heartbeats of a running job, and seconds without a heartbeat after which a job is given back
+HEARTBEAT_INTERVAL = 60
+HEARTBEAT_TIMEOUT = 10 * 60
+# number of times a job is claimed before it is considered failed (a job that kills its worker isn't run forever)
+MAX_ATTEMPTS = 3
+# seconds a worker waits before checking again when the remaining jobs are all claimed by other workers
+IDLE_INTERVAL = 30
+# number of times a heartbeat or the end of a job is written again if the queue can't be written (e.g. it is locked
+# for longer than the busy timeout, or the shared filesystem returned an I/O error), and seconds before the first retry
+# (doubled after each attempt)
+WRITE_RETRIES = 5
+WRITE_RETRY_INTERVAL = 5
+# seconds a job is given to stop after SIGTERM before it is killed
+TERMINATE_TIMEOUT = 30
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Run the jobs of a work queue, or print the state of its jobs')
+
+    parser.add_argument('--queue', dest='queue',
+                        required=True, help='Path of the queue (queue.sqlite) written by run_level1/2/3.py')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        default=1, help='Number of jobs this process runs at the same time. Defaults to 1.')
+    parser.add_argument('--status', dest='status', action='store_true',
+                        default=False, help='Print the number of jobs in each state and the jobs that failed, without '
+                                            'running any jobs')
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def _connect(queue_path):
+    # transactions are started explicitly, so that a claim reads and updates the queue under a single lock
+    conn = sqlite3.connect(queue_path, timeout=120, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout = 120000')
+    return conn
+
+
+def create_queue(outputdir, jobs, level, priorities=None, time=None, mem=None):
+    """Writes the jobs of a level to a job manifest and a queue in outputdir
+
+    Args:
+        outputdir (str): directory of the queue (where the sbatch file and the output are saved)
+        jobs (list): jobs to run (see job_manifest.write_manifest)
+        level (int): level of analysis
+        priorities (list): priority of each job (e.g. its predicted runtime); jobs with a higher priority are claimed
+            first, then in the order of jobs
+        time (str): time limit of each job, saved in the job manifest (see job_manifest.write_manifest)
+        mem (int): memory allocation of each job in MB, saved in the job manifest
+    Returns:
+        path of the queue
+    """
+    manifest_path = job_manifest.write_manifest(outputdir, jobs, level, time=time, mem=mem)
+    queue_path = os.path.join(outputdir, QUEUE_FILENAME)
+    if os.path.exists(queue_path):
+        os.remove(queue_path)
+    conn = _connect(queue_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE jobs (id INTEGER PRIMARY KEY, priority REAL, state TEXT, attempts INTEGER, '
+                     'worker TEXT, heartbeat REAL, started REAL, finished REAL, exit_code INTEGER)')
+        conn.execute('CREATE INDEX jobs_state ON jobs (state, priority)')
+        conn.executemany('INSERT INTO meta VALUES (?, ?)', [('manifest', manifest_path), ('level', str(level))])
+        conn.executemany('INSERT INTO jobs (id, priority, state, attempts) VALUES (?, ?, ?, 0)',
+                         [(i, priorities[i] if priorities is not None else 0, PENDING) for i in range(len(jobs))])
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return queue_path
+
+
+class WorkQueue(object):
+    """Connection of a worker to a queue written by create_queue
+
+    Args:
+        queue_path (str): path of queue.sqlite
+        worker (str): name of the worker, recorded with the jobs it claims
+    """
+
+    def __init__(self, queue_path, worker):
+        self.path = queue_path
+        self.worker = worker
+        self._conn = _connect(queue_path)
+        meta = dict(self._conn.execute('SELECT key, value FROM meta').fetchall())
+        self.manifest = meta['manifest']
+        self.level = int(meta['level'])
+
+    def _release_stale(self, now):
+        # gives back the jobs whose worker stopped sending heartbeats (called inside a transaction)
+        rows = self._conn.execute('SELECT id, attempts, worker FROM jobs WHERE state = ? AND heartbeat < ?',
+                                  (CLAIMED, now - HEARTBEAT_TIMEOUT)).fetchall()
+        for i, attempts, worker in rows:
+            state = PENDING if attempts < MAX_ATTEMPTS else FAILED
+            self._conn.execute('UPDATE jobs SET state = ?, worker = NULL, finished = ? WHERE id = ?',
+                               (state, now if state == FAILED else None, i))
+            print('WARNING: Worker %s stopped while running job %d, %s' % (
+                worker, i, 'it is given back to the queue' if state == PENDING else
+                'it failed %d times and will not be run again' % attempts))
+
+    def claim(self):
+        """Claims the pending job with the highest priority
+
+        Returns:
+            tuple of the index of the job in the manifest (None if no job is pending) and the number of jobs that are
+            not finished (pending or claimed by a worker)
+        """
+        now = time.time()
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._release_stale(now)
+            row = self._conn.execute('SELECT id FROM jobs WHERE state = ? ORDER BY priority DESC, id LIMIT 1',
+                                     (PENDING,)).fetchone()
+            if row is not None:
+                self._conn.execute('UPDATE jobs SET state = ?, worker = ?, heartbeat = ?, started = ?, '
+                                   'attempts = attempts + 1 WHERE id = ?', (CLAIMED, self.worker, now, now, row[0]))
+            remaining = self._conn.execute('SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)',
+                                           (PENDING, CLAIMED)).fetchone()[0]
+            self._conn.execute('COMMIT')
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        return (row[0] if row is not None else None), remaining
+
+    def _update(self, statement, get_params):
+        # runs an update, trying again with a growing delay if the queue can't be written; get_params is called before
+        # each attempt, so that the times written are those of the attempt that succeeds
+        interval = WRITE_RETRY_INTERVAL
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                return self._conn.execute(statement, get_params()).rowcount
+            except sqlite3.OperationalError as e:
+                if attempt == WRITE_RETRIES:
+                    raise
+                print('WARNING: Could not write to %s (%s), trying again in %d s' % (self.path, e, interval))
+                sys.stdout.flush()
+                time.sleep(interval)
+                interval *= 2
+
+    def heartbeat(self, i):
+        """Records that job i is still running; returns False if the job was given to another worker
+
+        If the heartbeat can't be written after WRITE_RETRIES attempts, a warning is printed and True is returned (the
+        job keeps running, and the next heartbeat tries again).
+        """
+        try:
+            return self._update('UPDATE jobs SET heartbeat = ? WHERE id = ? AND state = ? AND worker = ?',
+                                lambda: (time.time(), i, CLAIMED, self.worker)) > 0
+        except sqlite3.OperationalError as e:
+            print('WARNING: Could not write the heartbeat of job %d to %s: %s' % (i, self.path, e))
+            return True
+
+    def finish(self, i, exitcode):
+        """Records that job i finished; returns False if the job was given to another worker in the meantime
+
+        Raises:
+            sqlite3.OperationalError if the queue can't be written after WRITE_RETRIES attempts
+        """
+        return self._update('UPDATE jobs SET state = ?, finished = ?, exit_code = ? '
+                            'WHERE id = ? AND state = ? AND worker = ?',
+                            lambda: (DONE if exitcode == 0 else FAILED, time.time(), exitcode, i, CLAIMED,
+                                     self.worker)) > 0
+
+    def get_counts(self):
+        """Returns dictionary with the number of jobs in each state"""
+        counts = dict((state, 0) for state in [PENDING, CLAIMED, DONE, FAILED])
+        counts.update(self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return counts
+
+    def get_failed(self):
+        """Returns list of (index, exit code, attempts) of the jobs that failed"""
+        return self._conn.execute('SELECT id, exit_code, attempts FROM jobs WHERE state = ? ORDER BY id',
+                                  (FAILED,)).fetchall()
+
+    def close(self):
+        self._conn.close()
+
+
+def get_worker_name(k=0):
+    """Returns the name of worker k of this process: host, slurm job (or process ID) and k"""
+    task = _get_slurm_task() or str(os.getpid())
+    return '%s:%s:%d' % (socket.gethostname(), task, k)
+
+
+def _get_slurm_task():
+    if 'SLURM_ARRAY_JOB_ID' in os.environ and 'SLURM_ARRAY_TASK_ID' in os.environ:
+        return '%s_%s' % (os.environ['SLURM_ARRAY_JOB_ID'], os.environ['SLURM_ARRAY_TASK_ID'])
+    return os.environ.get('SLURM_JOB_ID', '')
+
+
+def _stop_job(proc):
+    # stops a job and the commands it started (feat runs many), which are in the process group of the job
+    for sig, timeout in [(signal.SIGTERM, TERMINATE_TIMEOUT), (signal.SIGKILL, None)]:
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            return proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def _run_claimed_job(queue, i, logdir):
+    # runs job i in its own process group and sends heartbeats until it finishes; returns the exit code of the job, or
+    # None if the job was stopped because it was given to another worker
+    start = time.time()
+    with open(os.path.join(logdir, 'job_%d.log' % i), 'a') as log:
+        proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              'run_feat_job.py'),
+                                 '--manifest', queue.manifest, '-i', str(i), '--level', str(queue.level)],
+                                stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        while True:
+            try:
+                exitcode = proc.wait(timeout=HEARTBEAT_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if not queue.heartbeat(i):
+                    # the other worker writes to the same output directory, so this copy of the job is stopped
+                    print('WARNING: Job %d was given to another worker while %s was running it, stopping it' % (
+                        i, queue.worker))
+                    sys.stdout.flush()
+                    _stop_job(proc)
+                    return None
+    try:
+        if not queue.finish(i, exitcode):
+            print('WARNING: Job %d finished on %s after it was given to another worker' % (i, queue.worker))
+    except sqlite3.OperationalError as e:
+        print('WARNING: Could not record that job %d finished on %s (%s), it will be given back to the queue once its '
+              'heartbeat is older than %d s' % (i, queue.worker, e, HEARTBEAT_TIMEOUT))
+    print('%s job %d on %s (exit code %d, %.0f s)' % ('Finished' if exitcode == 0 else 'FAILED:', i, queue.worker,
+                                                     exitcode, time.time() - start))
+    sys.stdout.flush()
+    return exitcode
+
+
+def run_worker(queue_path, k=0):
+    """Claims and runs jobs until every job of the queue has finished
+
+    Args:
+        queue_path (str): path of queue.sqlite
+        k (int): number of the worker in this process
+    Returns:
+        number of jobs this worker ran
+    """
+    queue = WorkQueue(queue_path, get_worker_name(k))
+    logdir = os.path.dirname(os.path.abspath(queue_path))
+    njobs = 0
+    try:
+        while True:
+            i, remaining = queue.claim()
+            if i is None:
+                if remaining == 0:
+                    break
+                # the remaining jobs are running on other workers; one of them may be given back if its worker dies
+                time.sleep(IDLE_INTERVAL)
+                continue
+            _run_claimed_job(queue, i, logdir)
+            njobs += 1
+    finally:
+        queue.close()
+    return njobs
+
+
+def run_workers(queue_path, nworkers=1):
+    """Runs nworkers workers in this process (one thread each, every job runs in its own process)
+
+    Returns:
+        dictionary with the number of jobs in each state once the queue is empty
+    """
+    threads = [threading.Thread(target=run_worker, args=(queue_path, k)) for k in range(nworkers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue = WorkQueue(queue_path, get_worker_name())
+    try:
+        return queue.get_counts()
+    finally:
+        queue.close()
+
+
+def print_status(queue_path):
+    queue = WorkQueue(queue_path, get_worker_name())
+    try:
+        counts = queue.get_counts()
+        print('%d jobs: %d pending, %d running, %d done, %d failed' % (
+            sum(counts.values()), counts[PENDING], counts[CLAIMED], counts[DONE], counts[FAILED]))
+        for i, exitcode, attempts in queue.get_failed():
+            job = job_manifest.read_job(queue.manifest, i)
+            print('\tjob %d (exit code %s, %d attempts): %s' % (
+                i, exitcode if exitcode is not None else 'none', attempts,
+                ' '.join(job) if isinstance(job, list) else job))
+    finally:
+        queue.close()
+
+
+def submit_workers(outputdir, jobs, level, jobname, account, nodes, time, mem, email, nworkers, workers_per_task,
+                   output, max_array_size=None, throttle=0, priorities=None):
+    """Writes the jobs to a queue in outputdir and submits a job array whose tasks are workers of the queue
+    If sbatch is not available, the workers are run on this machine instead.
+
+    Args:
+        outputdir (str): directory of the queue, the sbatch file and the output
+        jobs (list): jobs to run (see job_manifest.write_manifest)
+        level (int): level of analysis
+        jobname (str): name of the job
+        account (str): slurm account
+        nodes (int): number of nodes
+        time (str): estimated time to run each job; the time limit of each task covers its share of the jobs
+        mem (int): memory allocation of each job in MB
+        email (str): email to send job updates to
+        nworkers (int): number of array tasks (no more than the number of jobs)
+        workers_per_task (int): number of jobs each array task runs at the same time (CPUs of each task)
+        output (str): path of the output file of each array task (%a is replaced by the index of the task)
+        max_array_size (int): maximum number of tasks of the job array (see slurm_utils.submit_array)
+        throttle (int): maximum number of array tasks that run at the same time (0 for no limit)
+        priorities (list): see create_queue
+    Returns:
+        dictionary with the number of jobs in each state if the workers were run on this machine, None if they were
+        submitted
+    """
+    njobs = len(jobs)
+    nworkers = max(1, min(nworkers, njobs))
+    queue_path = create_queue(outputdir, jobs, level, priorities, time, mem)
+    sbatch_path = os.path.join(outputdir, 'run_level%d_workers.sbatch' % level)
+    jobs_per_task = slurm_utils.get_num_tasks(njobs, nworkers)
+    command = 'python %s --queue %s --workers %d' % (os.path.abspath(__file__), queue_path, workers_per_task)
+    slurm_utils.write_sbatch(sbatch_path, jobname, account, nodes,
+                             slurm_utils.get_task_time(time, jobs_per_task, workers_per_task),
+                             slurm_utils.get_task_mem(mem, jobs_per_task, workers_per_task), email, nworkers, output,
+                             command, cpus_per_task=workers_per_task)
+    print('Queued %d jobs for %d workers running %d jobs at a time' % (njobs, nworkers, workers_per_task))
+    try:
+        task_ids = slurm_utils.submit_array(sbatch_path, nworkers, max_array_size, throttle, output=output)
+        print('Submitted batch job %s' % ' '.join(sorted(set(task_id.split('_')[0] for task_id in task_ids))))
+        # any worker may run any job, so a job is alive as long as one of the workers is
+        job_state.record_queued(jobs, level, [task_ids[i % nworkers] for i in range(njobs)])
+        print('Saving sbatch output to %s' % outputdir)
+        return None
+    except subprocess.CalledProcessError as e:
+        print("ERROR: sbatch failed with exit code %d" % e.returncode)
+        sys.exit(-1)
+    except FileNotFoundError:
+        print("\nNOTE: sbatch command was not found. Running %d workers on this machine now...\n" % (
+            nworkers * workers_per_task))
+        os.remove(sbatch_path)
+        counts = run_workers(queue_path, nworkers * workers_per_task)
+        print('\n%d jobs done, %d failed (see %s)' % (counts[DONE], counts[FAILED], outputdir))
+        return counts
+
+
+def main(argv=None):
+    args = parse_command_line(argv)
+    if not os.path.exists(args.queue):
+        print("ERROR: %s does not exist" % args.queue)
+        sys.exit(-1)
+    if args.status:
+        print_status(args.queue)
+        return
+    if args.workers < 1:
+        print("ERROR: --workers must be at least 1")
+        sys.exit(-1)
+    counts = run_workers(args.queue, args.workers)
+    print('\nQueue: %s' % json.dumps(counts))
+    if counts[FAILED] > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()